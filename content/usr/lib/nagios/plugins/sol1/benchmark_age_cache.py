@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Concurrency stress test and benchmark for lib.util.AgeCache
+#
+# Starts many processes at once against one cache file. Each reads the shared keys and increments their counters
+# with readWithVersion and compareAndSet, retrying on a conflict. With --churn some operations delete a key or write
+# filler entries so keys are evicted and written again while other processes hold their old versions.
+#
+# It fails (exit 1) if two compareAndSets based on the same key and version of an entry both succeeded, a lost update, or
+# without churn if the counters don't add up to the successful increments. It reports the read and write rates and
+# the read latency.
+#
+# To use:
+# - benchmark_age_cache.py                                          64 processes, 200 operations each
+# - benchmark_age_cache.py --processes 64 --operations 500 --churn 0.05 --max-entries 32
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from loguru import logger
+
+from lib.util import AgeCache
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Stress lib.util.AgeCache with many processes reading and compare and setting the same keys")
+    parser.add_argument('--processes', type=int, help='Number of processes using the cache at once', default=64)
+    parser.add_argument('--operations', type=int, help='Operations per process', default=200)
+    parser.add_argument('--keys', type=int, help='Number of shared counter keys', default=8)
+    parser.add_argument('--reads', type=int, help='Reads per increment', default=4)
+    parser.add_argument('--churn', type=float, help='Fraction of operations that delete a key or write filler entries to evict them', default=0.0)
+    parser.add_argument('--max-entries', type=int, help='Max entries of the cache, small values evict the counters with --churn', default=1000)
+    parser.add_argument('--cache-file', type=str, help='Cache file to use, default is a new file in a temporary directory', default=None)
+    parser.add_argument('--seed', type=int, help='Random seed, each process adds its index', default=1)
+    return parser.parse_args(argvals)
+
+
+def worker(index, args, cacheFile, start, results):
+    rng = random.Random(args.seed + index)
+    cache = AgeCache(cacheFile=cacheFile, age=3600, maxEntries=args.max_entries)
+    stats = {"reads": 0, "read_seconds": [], "written": 0, "conflicts": 0, "errors": 0, "deletes": 0, "seconds": 0.0, "based_on": []}
+    start.wait()
+    started = time.perf_counter()
+    for operation in range(args.operations):
+        key = f"counter{rng.randrange(args.keys)}"
+        try:
+            if args.churn and rng.random() < args.churn:
+                if rng.random() < 0.5:
+                    cache.delete(key)
+                    stats['deletes'] += 1
+                else:
+                    for filler in range(args.max_entries // 4 + 1):
+                        cache.write(f"filler{index}-{operation}-{filler}", 'x' * 64)
+                continue
+            for _ in range(args.reads):
+                read_started = time.perf_counter()
+                cache.read(f"counter{rng.randrange(args.keys)}")
+                stats['read_seconds'].append(time.perf_counter() - read_started)
+                stats['reads'] += 1
+            while True:
+                value, version = cache.readWithVersion(key)
+                if cache.compareAndSet(key, (value or 0) + 1, version):
+                    stats['written'] += 1
+                    stats['based_on'].append((key, version))
+                    break
+                stats['conflicts'] += 1
+        except OSError:
+            stats['errors'] += 1
+    stats['seconds'] = time.perf_counter() - started
+    cache.close()
+    results.put(stats)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+    cacheFile = args.cache_file or os.path.join(tempfile.mkdtemp(prefix='benchmark_age_cache_'), 'cache.sqlite')
+
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(index, args, cacheFile, start, results)) for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)
+    began = time.perf_counter()
+    start.set()
+    stats = [results.get() for _ in processes]
+    wall = time.perf_counter() - began
+    for process in processes:
+        process.join()
+
+    reads = sum(s['reads'] for s in stats)
+    written = sum(s['written'] for s in stats)
+    conflicts = sum(s['conflicts'] for s in stats)
+    errors = sum(s['errors'] for s in stats)
+    read_seconds = [seconds for s in stats for seconds in s['read_seconds']]
+    # Version 0 is a missing entry, it is created once more each time a key is deleted or evicted
+    based_on = [entry for s in stats for entry in s['based_on'] if entry[1] != 0]
+    lost = len(based_on) - len(set(based_on))
+
+    with AgeCache(cacheFile=cacheFile, age=3600, maxEntries=args.max_entries) as cache:
+        total = sum(cache.read(f"counter{key}") or 0 for key in range(args.keys))
+
+    print(f"{args.processes} processes x {args.operations} operations on {cacheFile} in {wall:.2f}s")
+    print(f"{'reads':>8} {'reads/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'writes':>7} {'writes/s':>9} {'conflicts':>10} {'errors':>7} {'lost':>5}")
+    print(f"{reads:>8} {reads / wall:>9.0f} {percentile(read_seconds, 50) * 1000:>7.2f} {percentile(read_seconds, 99) * 1000:>7.2f} "
+          f"{written:>7} {written / wall:>9.0f} {conflicts:>10} {errors:>7} {lost:>5}")
+
+    failed = False
+    if lost:
+        print(f"FAIL: {lost} compareAndSets succeeded on a version another one had already replaced")
+        failed = True
+    if not args.churn and total != written:
+        print(f"FAIL: the counters add up to {total}, {written} increments were written")
+        failed = True
+    if errors:
+        print(f"FAIL: {errors} operations raised OSError")
+        failed = True
+    raise SystemExit(1 if failed else 0)
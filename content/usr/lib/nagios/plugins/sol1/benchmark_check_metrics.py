@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmark for the statusmetrics counts
+#
+# Builds synthetic check objects in the shape the Icinga API returns for statusmetrics, counts them with the
+# column based lib.checkmetrics.checkMetrics and the per check loop checkMetricsLoop, checks the counts match
+# and reports the time of each.
+#
+# To use:
+# - benchmark_check_metrics.py                                    10k, 100k and 500k checks
+# - benchmark_check_metrics.py --sizes 100000 --repeat 5 --invalid-every 1000
+
+import argparse
+import random
+import time
+
+from loguru import logger
+
+from lib.checkmetrics import checkMetrics, checkMetricsLoop
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark the statusmetrics state x acknowledgement and overdue counts")
+    parser.add_argument('--sizes', type=str, help='Comma seperated list of the numbers of checks to count', default='10000,100000,500000')
+    parser.add_argument('--repeat', type=int, help='Times to count each set, the best time is reported', default=3)
+    parser.add_argument('--invalid-every', type=int, help='Every nth check has a string state, which the columns count one at a time, 0 for none', default=0)
+    parser.add_argument('--seed', type=int, help='Random seed for the checks', default=1)
+    return parser.parse_args(argvals)
+
+
+def checks(count, now, invalid_every = 0):
+    rng = random.Random(count)
+    objects = []
+    for i in range(count):
+        attrs = {
+            "last_check_result": {"state": float(rng.choice([0, 0, 0, 0, 0, 1, 2, 3]))},
+            "acknowledgement": float(rng.choice([0, 0, 0, 0, 1, 2])),
+            "last_check": now - rng.uniform(0, 900),
+            "check_interval": rng.choice([60.0, 300.0, 600.0])
+        }
+        if i % 97 == 0:
+            attrs['last_check_result'] = None
+        if i % 89 == 0:
+            attrs['last_check'] = -1
+        if invalid_every and i % invalid_every == 0:
+            attrs['last_check_result'] = {"state": "broken"}
+        objects.append({"name": f"host{i // 20}!svc{i}", "type": "Service", "attrs": attrs})
+    return objects
+
+
+def best(function, objects, now, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        metrics = function(objects, 60, now)
+        times.append(time.perf_counter() - start)
+    return (min(times), metrics)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+    random.seed(args.seed)
+    now = time.time()
+
+    print(f"{'checks':>8} {'loop ms':>9} {'columns ms':>11} {'speedup':>8} {'match':>6}")
+    for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        objects = checks(size, now, args.invalid_every)
+        loop_seconds, loop_metrics = best(checkMetricsLoop, objects, now, args.repeat)
+        column_seconds, column_metrics = best(checkMetrics, objects, now, args.repeat)
+        print(f"{size:>8} {loop_seconds * 1000:>9.1f} {column_seconds * 1000:>11.1f} {loop_seconds / column_seconds:>7.1f}x {str(loop_metrics == column_metrics):>6}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Connection reuse benchmark for lib.httpclient
+#
+# Starts a local TLS stand-in server with keep-alive that answers every request with a small JSON document and
+# counts the connections it accepts. Sends the same GETs with bare requests.get, a new connection and TLS handshake
+# each, and with HttpClient's shared pooled session, then runs rounds of Icinga getCheckResults followed by
+# processServiceCheckResult. Reports the time per request and the connections each needed.
+#
+# The stand-in needs a certificate, a self-signed one is made with openssl unless --cert and --key are given.
+#
+# To use:
+# - benchmark_httpclient.py                                   200 GETs each way, 50 Icinga rounds
+# - benchmark_httpclient.py --requests 1000 --rounds 200 --cert cert.pem --key key.pem
+
+import argparse
+import http.server
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+import urllib3
+from loguru import logger
+
+from lib.httpclient import HttpClient
+from lib.icinga import Icinga
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark HttpClient connection reuse against a local TLS stand-in server")
+    parser.add_argument('--requests', type=int, help='Number of GETs sent each way', default=200)
+    parser.add_argument('--rounds', type=int, help='Number of getCheckResults and processServiceCheckResult rounds', default=50)
+    parser.add_argument('--cert', type=str, help='Certificate for the stand-in server, default is a new self-signed one', default=None)
+    parser.add_argument('--key', type=str, help='Key for --cert', default=None)
+    return parser.parse_args(argvals)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Without this the keep-alive responses wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+        if 'process-check-result' in self.path:
+            body = {"results": [{"code": 200, "status": "Successfully processed check result."}]}
+        else:
+            body = {"results": []}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        # The listening socket is TLS wrapped, every accepted connection did a handshake
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+
+def self_signed(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=localhost', '-days', '1',
+                    '-keyout', key, '-out', cert], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (cert, key)
+
+
+def measure(stub, name, count, send):
+    connections = stub.connections
+    start = time.perf_counter()
+    for _ in range(count):
+        send()
+    seconds = time.perf_counter() - start
+    print(f"{name:<32} {count:>8} {seconds:>8.2f} {seconds / count * 1000:>8.2f} {stub.connections - connections:>12}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+
+    cert, key = (args.cert, args.key) if args.cert else self_signed(tempfile.mkdtemp(prefix='benchmark_httpclient_'))
+    stub = StubServer(('127.0.0.1', 0), StubHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    stub.socket = context.wrap_socket(stub.socket, server_side=True)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    url = f"https://127.0.0.1:{stub.server_address[1]}"
+
+    client = HttpClient(url)
+    icinga = Icinga(url, 'user', 'pass')
+
+    def icingaRound():
+        icinga.getCheckResults('services', 'service.name=="ping"', ['name', 'state'])
+        icinga.processServiceCheckResult('host', 'service', 0, 'OK', [])
+
+    print(f"{'method':<32} {'count':>8} {'seconds':>8} {'ms each':>8} {'connections':>12}")
+    measure(stub, 'requests.get', args.requests, lambda: requests.get(f"{url}/v1/status", verify=False, timeout=(5, 30)))
+    measure(stub, 'HttpClient.get', args.requests, lambda: client.get('/v1/status'))
+    measure(stub, 'Icinga get + process rounds', args.rounds, icingaRound)
+    stub.shutdown()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Comparison and benchmark of check_icinga2_checks.py with and without --icingadb
+#
+# Builds a SQLite stand-in of the IcingaDB tables lib.icingadb reads (STANDIN_SCHEMA) with --services services on
+# --services / 20 hosts, and starts a local stand-in of the Icinga API objects endpoint that serves the same services
+# and evaluates filters with lib.icingafilter. Then runs statusmetrics, overdue and summary for each filter through
+# the API and with --icingadb, reports the best time of each and whether the output is the same.
+#
+# With --server it compares a real Icinga API with the real IcingaDB database (--icingadb-host etc.) instead, only the
+# services are read.
+#
+# Exits 1 if any output differs.
+#
+# To use:
+# - benchmark_icingadb.py                                                2000 services in the stand-ins
+# - benchmark_icingadb.py --services 50000 --repeat 1 --filter 'host.name=="web1"'
+# - benchmark_icingadb.py -s https://icinga:5665 -u user -p pass --icingadb-host db --icingadb-password pass
+
+import argparse
+import difflib
+import http.server
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from lib.icingafilter import compileFilter
+
+CHECK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_icinga2_checks.py')
+# The IcingaDB tables and columns lib.icingadb reads
+STANDIN_SCHEMA = """
+    CREATE TABLE host (id INTEGER PRIMARY KEY, name TEXT, display_name TEXT, zone_name TEXT, command_endpoint_name TEXT, checkcommand_name TEXT,
+                       check_interval INTEGER, address TEXT);
+    CREATE TABLE host_state (id INTEGER PRIMARY KEY, host_id INTEGER, soft_state INTEGER, is_acknowledged TEXT, last_update INTEGER,
+                             check_source TEXT, output TEXT);
+    CREATE TABLE service (id INTEGER PRIMARY KEY, host_id INTEGER, name TEXT, display_name TEXT, zone_name TEXT, command_endpoint_name TEXT,
+                          checkcommand_name TEXT, check_interval INTEGER);
+    CREATE TABLE service_state (id INTEGER PRIMARY KEY, host_id INTEGER, service_id INTEGER, soft_state INTEGER, is_acknowledged TEXT,
+                                last_update INTEGER, check_source TEXT, output TEXT);
+    CREATE TABLE hostgroup (id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE hostgroup_member (id INTEGER PRIMARY KEY, host_id INTEGER, hostgroup_id INTEGER);
+    CREATE TABLE servicegroup (id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE servicegroup_member (id INTEGER PRIMARY KEY, service_id INTEGER, servicegroup_id INTEGER);
+    CREATE TABLE customvar (id INTEGER PRIMARY KEY, name TEXT, value TEXT);
+    CREATE TABLE host_customvar (id INTEGER PRIMARY KEY, host_id INTEGER, customvar_id INTEGER);
+    CREATE TABLE service_customvar (id INTEGER PRIMARY KEY, service_id INTEGER, customvar_id INTEGER);
+    CREATE UNIQUE INDEX idx_service_state_service ON service_state (service_id);
+    CREATE INDEX idx_service_host ON service (host_id);
+    CREATE INDEX idx_hostgroup_member_host ON hostgroup_member (host_id);
+    CREATE INDEX idx_servicegroup_member_service ON servicegroup_member (service_id);
+    CREATE INDEX idx_host_customvar_host ON host_customvar (host_id);
+    CREATE INDEX idx_service_customvar_service ON service_customvar (service_id);
+"""
+FILTERS = [
+    'host.name=="web1"',
+    'match("web*", host.name) && service.name!="svc3_disk"',
+    '"linux-servers" in host.groups && host.vars.os=="Linux"',
+    '"https" in service.groups || service.vars.team=="dev"',
+    '!(service.check_command=="disk") && service.check_interval>=300',
+    'match("svc1?_*", service.name) && service.zone=="zone1"',
+    # Not translated, both sides use the API
+    'regex("^web[0-9]$", host.name)'
+]
+MODES = [
+    ['statusmetrics', '--filter-check-state', '2'],
+    ['overdue', '--limit', '5'],
+    ['summary']
+]
+ACKNOWLEDGED = {0: 'n', 1: 'y', 2: 'sticky'}
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Compare and time check_icinga2_checks.py with and without --icingadb")
+    parser.add_argument('--services', type=int, help='Services in the stand-ins', default=2000)
+    parser.add_argument('--seed', type=int, help='Random seed for the stand-in states', default=1)
+    parser.add_argument('--repeat', type=int, help='Times to run each check, the best time is reported', default=3)
+    parser.add_argument('--filter', type=str, action='append', help='Filter to compare, can be repeated, default is a built in list', default=None)
+    parser.add_argument('-s', '--server', type=str, help='Real Icinga API to compare with instead of the stand-ins', default=None)
+    parser.add_argument('-u', '--username', type=str, help='Icinga API username', default='user')
+    parser.add_argument('-p', '--password', type=str, help='Icinga API password', default='pass')
+    parser.add_argument('--icingadb-host', type=str, help='IcingaDB database host, with --server', default='localhost')
+    parser.add_argument('--icingadb-port', type=int, help='IcingaDB database port, with --server', default=3306)
+    parser.add_argument('--icingadb-name', type=str, help='IcingaDB database name, with --server', default='icingadb')
+    parser.add_argument('--icingadb-user', type=str, help='IcingaDB database user, with --server', default='icingadb')
+    parser.add_argument('--icingadb-password', type=str, help='IcingaDB database password, with --server', default='')
+    return parser.parse_args(argvals)
+
+
+def standin_objects(count, seed):
+    """Services in the shape of the Icinga API, each with its host as a join for the filters
+
+    Returns:
+        tuple: (list, list) the hosts and the services
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    hosts = []
+    for h in range(max(count // 20, 1)):
+        name = f"web{h}" if h % 3 else f"db{h}"
+        hosts.append({"name": name, "display_name": name.upper(), "zone": f"zone{h % 4}" if h % 11 else "",
+                      "groups": ["linux-servers"] + (["web"] if name.startswith("web") else []),
+                      "vars": {"os": "Linux" if h % 5 else "Windows", "rack": h % 7}, "address": f"10.0.{h // 250}.{h % 250}"})
+    services = []
+    for i in range(count):
+        host = hosts[i % len(hosts)]
+        interval = rng.choice([60, 300])
+        state = None if i % 97 == 0 else rng.choice([0, 0, 0, 1, 2, 3])
+        # Most are on time, some are overdue and some were never checked. IcingaDB keeps milliseconds
+        last_check = -1 if state is None else round(now - interval - rng.choice([10, 10, 10, 10, 2000, 5000]), 3)
+        name = f"svc{i // len(hosts)}_{'http' if i % 4 == 0 else 'disk'}"
+        services.append({"name": f"{host['name']}!{name}", "type": "Service", "attrs": {
+            "name": name, "host_name": host['name'], "display_name": name.replace('_', ' '), "zone": host['zone'],
+            "command_endpoint": "sat1" if i % 13 == 0 else "", "check_command": "http" if i % 4 == 0 else "disk",
+            "check_interval": interval, "last_check": last_check, "acknowledgement": rng.choice([0, 0, 0, 1, 2]) if state else 0,
+            "last_check_result": None if state is None else {"state": state, "output": f"output of {name}", "check_source": f"master{i % 2}" if i % 7 else "",
+                                                             "performance_data": [f"conn={i};100;200;0", f"'used space'={i % 50}MB;;;0;100"] if i % 5 else [],
+                                                             "execution_end": last_check},
+            "groups": ["https"] if i % 4 == 0 else [], "vars": {"team": "ops" if i % 2 else "dev"}}, "joins": {"host": host}})
+    return (hosts, services)
+
+
+def build_standin(path, hosts, services):
+    db = sqlite3.connect(path)
+    ids = {}
+
+    def rowid(table, key, insert, values):
+        # Id of a group or customvar, inserted the first time it is seen
+        if (table, key) not in ids:
+            ids[(table, key)] = len(ids) + 1
+            db.execute(insert, (ids[(table, key)],) + values)
+        return ids[(table, key)]
+
+    def customvar(name, value):
+        encoded = json.dumps(value, separators=(',', ':'))
+        return rowid('customvar', (name, encoded), "INSERT INTO customvar VALUES (?, ?, ?)", (name, encoded))
+
+    try:
+        db.executescript(STANDIN_SCHEMA)
+        host_ids = {}
+        for host_id, host in enumerate(hosts, 1):
+            host_ids[host['name']] = host_id
+            db.execute("INSERT INTO host VALUES (?, ?, ?, ?, '', 'hostalive', 60, ?)",
+                       (host_id, host['name'], host['display_name'], host['zone'], host['address']))
+            for group in host['groups']:
+                group_id = rowid('hostgroup', group, "INSERT INTO hostgroup VALUES (?, ?)", (group,))
+                db.execute("INSERT INTO hostgroup_member (host_id, hostgroup_id) VALUES (?, ?)", (host_id, group_id))
+            for name, value in host['vars'].items():
+                db.execute("INSERT INTO host_customvar (host_id, customvar_id) VALUES (?, ?)", (host_id, customvar(name, value)))
+        for service_id, service in enumerate(services, 1):
+            attrs = service['attrs']
+            host_id = host_ids[attrs['host_name']]
+            db.execute("INSERT INTO service VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (service_id, host_id, attrs['name'], attrs['display_name'], attrs['zone'], attrs['command_endpoint'],
+                        attrs['check_command'], attrs['check_interval']))
+            result = attrs['last_check_result']
+            if result is None:
+                state = (99, 'n', None, None, None)
+            else:
+                last_update = int(attrs['last_check'] * 1000) if attrs['last_check'] != -1 else None
+                state = (result['state'], ACKNOWLEDGED[attrs['acknowledgement']], last_update, result['check_source'], result['output'])
+            db.execute("INSERT INTO service_state (host_id, service_id, soft_state, is_acknowledged, last_update, check_source, output) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", (host_id, service_id) + state)
+            for group in attrs['groups']:
+                group_id = rowid('servicegroup', group, "INSERT INTO servicegroup VALUES (?, ?)", (group,))
+                db.execute("INSERT INTO servicegroup_member (service_id, servicegroup_id) VALUES (?, ?)", (service_id, group_id))
+            for name, value in attrs['vars'].items():
+                db.execute("INSERT INTO service_customvar (service_id, customvar_id) VALUES (?, ?)", (service_id, customvar(name, value)))
+        db.commit()
+    finally:
+        db.close()
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Without this the keep-alive responses wait on delayed ACKs
+    disable_nagle_algorithm = True
+    services = []
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        query = json.loads(self.rfile.read(length) or b'{}') if length else {}
+        matches = compileFilter(query['filter'], 'services') if query.get('filter') else (lambda check: True)
+        attrs = query.get('attrs')
+        results = [{"name": service['name'], "type": "Service", "joins": {}, "meta": {},
+                    "attrs": {attr: service['attrs'][attr] for attr in attrs if attr in service['attrs']} if attrs else service['attrs']}
+                   for service in self.services if matches(service)]
+        data = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_check(command, repeat):
+    """Run the check repeat times
+
+    Returns:
+        tuple: (float, list) the best seconds and the sorted lines of the last output
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return (best, sorted(process.stdout.splitlines()))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    stub = None
+    if args.server:
+        server = args.server
+        icingadb = ['--icingadb', '--icingadb-host', args.icingadb_host, '--icingadb-port', str(args.icingadb_port),
+                    '--icingadb-name', args.icingadb_name, '--icingadb-user', args.icingadb_user, '--icingadb-password', args.icingadb_password]
+    else:
+        hosts, StubHandler.services = standin_objects(args.services, args.seed)
+        path = os.path.join(tempfile.mkdtemp(prefix='benchmark_icingadb_'), 'icingadb.sqlite')
+        build_standin(path, hosts, StubHandler.services)
+        print(f"Built a stand-in with {len(StubHandler.services)} services on {len(hosts)} hosts in {path}")
+        stub = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        stub.daemon_threads = True
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        server = f"http://127.0.0.1:{stub.server_address[1]}"
+        icingadb = ['--icingadb', '--icingadb-type', 'sqlite', '--icingadb-name', path]
+
+    base = [sys.executable, CHECK, '-s', server, '-u', args.username, '-p', args.password]
+    different = 0
+    print(f"{'mode':<14} {'api ms':>8} {'icingadb ms':>12} {'output':>7}  filter")
+    for filter in args.filter or FILTERS:
+        for mode in MODES:
+            api_seconds, api_output = run_check(base + mode + ['--filter', filter], args.repeat)
+            db_seconds, db_output = run_check(base + icingadb + mode + ['--filter', filter], args.repeat)
+            same = api_output == db_output
+            print(f"{mode[0]:<14} {api_seconds * 1000:>8.0f} {db_seconds * 1000:>12.0f} {'same' if same else 'DIFF':>7}  {filter}")
+            if not same:
+                different += 1
+                for line in difflib.unified_diff(api_output, db_output, 'api', 'icingadb', n=0, lineterm=''):
+                    print(f"    {line}")
+    if stub is not None:
+        stub.shutdown()
+    print(f"{len(args.filter or FILTERS) * len(MODES) - different} outputs are the same, {different} differ")
+    raise SystemExit(1 if different else 0)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Comparison and benchmark of lib.icingaredis against the Icinga API
+#
+# Writes the services of benchmark_icingadb.py's stand-in to Redis in the IcingaDB key layout (see lib.icingaredis) and
+# starts its stand-in of the Icinga API with the same services. Then gets each of CASES with
+# IcingaRedis.getCheckResults and Icinga.getCheckResults, reports the best time of each and whether the objects are
+# the same.
+#
+# The stand-in is written to an in-process fakeredis if it is installed, or to the Redis given with --scratch-redis,
+# which is flushed first, so never give it the icingadb-redis. With --server it instead compares a real Icinga API with
+# the real icingadb-redis (--redis-host etc.), nothing is written.
+#
+# Exits 1 if any objects differ.
+#
+# To use:
+# - benchmark_icingaredis.py                                             2000 services in fakeredis
+# - benchmark_icingaredis.py --services 50000 --scratch-redis localhost:6399
+# - benchmark_icingaredis.py -s https://icinga:5665 -u user -p pass --redis-host localhost --redis-port 6380
+
+import argparse
+import hashlib
+import http.server
+import json
+import threading
+import time
+
+from loguru import logger
+
+from benchmark_icingadb import StubHandler, standin_objects
+from lib import icingaredis
+from lib.icinga import Icinga
+from lib.icingaredis import IcingaRedis
+
+# (filter, attrs) pairs, between them they use every kind of Redis read
+CASES = [
+    ('host.name=="web1"', ['name', 'host_name', 'last_check_result']),
+    ('match("web*", host.name) && service.name=="svc3_disk"', ['name', 'host_name', 'last_check_result', 'acknowledgement', 'last_check', 'check_interval']),
+    ('"linux-servers" in host.groups && host.vars.os=="Windows" && service.vars.team=="dev"', ['name', 'vars', 'groups', 'zone', 'command_endpoint']),
+    ('"https" in service.groups && service.zone=="zone0"', ['name', 'display_name', 'check_command']),
+    ('service.vars.team=="ops"', ['vars']),
+    ('service.last_check_result.state==2 && host.name=="web2"', ['name', 'last_check_result']),
+    (None, ['name', 'host_name', 'last_check_result', 'acknowledgement', 'last_check'])
+]
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Compare and time lib.icingaredis against the Icinga API")
+    parser.add_argument('--services', type=int, help='Services in the stand-ins', default=2000)
+    parser.add_argument('--seed', type=int, help='Random seed for the stand-in states', default=1)
+    parser.add_argument('--repeat', type=int, help='Times to get each case, the best time is reported', default=3)
+    parser.add_argument('--scratch-redis', type=str, help='HOST:PORT of a Redis to write the stand-in to, it is flushed first. Default is an in-process fakeredis', default=None)
+    parser.add_argument('-s', '--server', type=str, help='Real Icinga API to compare with instead of the stand-ins', default=None)
+    parser.add_argument('-u', '--username', type=str, help='Icinga API username', default='user')
+    parser.add_argument('-p', '--password', type=str, help='Icinga API password', default='pass')
+    parser.add_argument('--redis-host', type=str, help='icingadb-redis host, with --server', default='localhost')
+    parser.add_argument('--redis-port', type=int, help='icingadb-redis port, with --server', default=icingaredis.DEFAULT_PORT)
+    parser.add_argument('--redis-password', type=str, help='icingadb-redis password, with --server', default=None)
+    return parser.parse_args(argvals)
+
+
+def object_id(*parts):
+    # IcingaDB ids are sha1 hex digests
+    return hashlib.sha1('!'.join(parts).encode()).hexdigest()
+
+
+def load_standin(client, hosts, services):
+    """Write the stand-in objects to Redis as the icingadb feature does
+
+    Args:
+        client (redis.Redis): flushed first
+        hosts (list): from standin_objects
+        services (list): from standin_objects
+    """
+    client.flushdb()
+    pipe = client.pipeline(transaction=False)
+
+    def customvar(name, value):
+        customvar_id = object_id('customvar', name, json.dumps(value))
+        pipe.hset('icinga:customvar', customvar_id, json.dumps({"name": name, "value": json.dumps(value)}))
+        return customvar_id
+
+    now = int(time.time() * 1000)
+    for host in hosts:
+        host_id = object_id(host['name'])
+        pipe.hset('icinga:host', host_id, json.dumps({"name": host['name'], "name_ci": host['name'], "display_name": host['display_name'],
+                                                      "address": host['address'], "zone_name": host['zone'] or None, "checkcommand_name": "hostalive",
+                                                      "check_interval": 60, "command_endpoint_name": None}))
+        pipe.hset('icinga:host:state', host_id, json.dumps({"host_id": host_id, "soft_state": 0, "hard_state": 0, "state_type": "hard",
+                                                            "output": "PING OK", "last_update": now, "is_acknowledged": False}))
+        for group in host['groups']:
+            pipe.hset('icinga:hostgroup', object_id('hostgroup', group), json.dumps({"name": group, "display_name": group}))
+            pipe.hset('icinga:hostgroup:member', object_id('hostgroup', group, host['name']),
+                      json.dumps({"host_id": host_id, "hostgroup_id": object_id('hostgroup', group)}))
+        for name, value in host['vars'].items():
+            pipe.hset('icinga:host:customvar', object_id('host', host['name'], name),
+                      json.dumps({"host_id": host_id, "customvar_id": customvar(name, value)}))
+    for service in services:
+        attrs = service['attrs']
+        service_id = object_id(service['name'])
+        host_id = object_id(attrs['host_name'])
+        pipe.hset('icinga:service', service_id, json.dumps({"host_id": host_id, "name": attrs['name'], "name_ci": attrs['name'],
+                                                            "display_name": attrs['display_name'], "zone_name": attrs['zone'] or None,
+                                                            "checkcommand_name": attrs['check_command'], "check_interval": attrs['check_interval'],
+                                                            "command_endpoint_name": attrs['command_endpoint'] or None}))
+        result = attrs['last_check_result']
+        state = {"host_id": host_id, "service_id": service_id, "state_type": "hard", "is_acknowledged": attrs['acknowledgement']}
+        if result is None:
+            state.update({"soft_state": 99, "hard_state": 99, "output": None})
+        else:
+            output, _, long_output = result['output'].partition('\n')
+            state.update({"soft_state": result['state'], "hard_state": result['state'], "output": output, "long_output": long_output or None,
+                          "performance_data": ' '.join(result['performance_data']), "check_source": result['check_source'],
+                          "last_update": int(round(attrs['last_check'] * 1000))})
+        pipe.hset('icinga:service:state', service_id, json.dumps(state))
+        for group in attrs['groups']:
+            pipe.hset('icinga:servicegroup', object_id('servicegroup', group), json.dumps({"name": group, "display_name": group}))
+            pipe.hset('icinga:servicegroup:member', object_id('servicegroup', group, service['name']),
+                      json.dumps({"service_id": service_id, "servicegroup_id": object_id('servicegroup', group)}))
+        for name, value in attrs['vars'].items():
+            pipe.hset('icinga:service:customvar', object_id('service', service['name'], name),
+                      json.dumps({"service_id": service_id, "customvar_id": customvar(name, value)}))
+    pipe.execute()
+
+
+def scratch_client(scratch):
+    """The Redis client the stand-in is written to, fakeredis unless a scratch Redis is given
+
+    Returns:
+        tuple: (redis.Redis, str, int) the client and the host and port IcingaRedis should use
+    """
+    if scratch:
+        import redis
+        host, _, port = scratch.rpartition(':')
+        return (redis.Redis(host=host or 'localhost', port=int(port)), host or 'localhost', int(port))
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("fakeredis isn't installed, give a Redis to write the stand-in to with --scratch-redis")
+    client = fakeredis.FakeRedis()
+    # IcingaRedis shares the client of a server, so it reads the fakeredis
+    icingaredis._connections[('fakeredis', 0)] = client
+    return (client, 'fakeredis', 0)
+
+
+def timed(get, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        objects = get()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return (best, sorted(({"name": obj['name'], "attrs": obj['attrs']} for obj in objects), key=lambda obj: obj['name']))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+    stub = None
+    if args.server:
+        server = args.server
+        redis_reader = IcingaRedis(args.redis_host, args.redis_port, args.redis_password)
+    else:
+        hosts, StubHandler.services = standin_objects(args.services, args.seed)
+        client, redis_host, redis_port = scratch_client(args.scratch_redis)
+        load_standin(client, hosts, StubHandler.services)
+        print(f"Wrote a stand-in with {len(StubHandler.services)} services on {len(hosts)} hosts to {args.scratch_redis or 'fakeredis'}")
+        redis_reader = IcingaRedis(redis_host, redis_port)
+        stub = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        stub.daemon_threads = True
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        server = f"http://127.0.0.1:{stub.server_address[1]}"
+    api = Icinga(server, args.username, args.password)
+
+    different = 0
+    print(f"{'objects':>8} {'api ms':>8} {'redis ms':>9} {'result':>8}  filter")
+    for filter, attrs in CASES:
+        api_seconds, api_objects = timed(lambda: api.getCheckResults('services', filter, attrs), args.repeat)
+        redis_seconds, redis_objects = timed(lambda: redis_reader.getCheckResults('services', filter, attrs), args.repeat)
+        same = api_objects == redis_objects
+        print(f"{len(api_objects):>8} {api_seconds * 1000:>8.0f} {redis_seconds * 1000:>9.0f} {'same' if same else 'DIFF':>8}  {filter}")
+        if not same:
+            different += 1
+            print(f"    {len(api_objects)} from the API, {len(redis_objects)} from Redis")
+            for api_object, redis_object in zip(api_objects, redis_objects):
+                if api_object != redis_object:
+                    print(f"    api   {api_object}\n    redis {redis_object}")
+                    break
+    if stub is not None:
+        stub.shutdown()
+    print(f"{len(CASES) - different} cases are the same, {different} differ")
+    raise SystemExit(1 if different else 0)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmark for the lib.util.init_logging modes with many checks logging to one file at once
+#
+# Starts --processes interpreters at once for each mode, like the checks icinga starts. Each logs --messages debug
+# dumps of a large response below the log level and --messages warnings to one shared log with a small rotation, then
+# exits. The modes are:
+# - old       the file sink init_logging used before, gzip on rotation in the check, f-string debug dumps
+# - old-lazy  the same sink with lazy debug dumps, logger.opt(lazy=True)
+# - inline    init_logging's inline mode, the rotated log is gzipped by a detached gzip
+# - queued    init_logging's queued mode, no rotation in the check
+#
+# Reports the median and max seconds per process, the processes that wrote to stderr (eg loguru's rotation races) and
+# the warnings found in the logs afterwards.
+#
+# To use:
+# - benchmark_logging.py                                          100 processes for every mode
+# - benchmark_logging.py --processes 200 --modes inline,queued --rotation "5 MB"
+
+import argparse
+import glob
+import gzip
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ['old', 'old-lazy', 'inline', 'queued']
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark the init_logging modes with many processes sharing a log")
+    parser.add_argument('--processes', type=int, help='Number of processes logging at once', default=100)
+    parser.add_argument('--modes', type=str, help=f'Comma seperated list of modes ({",".join(MODES)})', default=",".join(MODES))
+    parser.add_argument('--messages', type=int, help='Debug dumps and warnings each process logs', default=20)
+    parser.add_argument('--entries', type=int, help='Entries in the response dumped at debug', default=20000)
+    parser.add_argument('--warning-bytes', type=int, help='Size of each warning', default=20000)
+    parser.add_argument('--rotation', type=str, help='Rotation of the old and inline mode logs', default='1 MB')
+    parser.add_argument('--log-dir', type=str, help='Directory for the logs, default is a new temporary directory', default=None)
+    parser.add_argument('--timeout', type=int, help='Timeout in seconds for a single process', default=300)
+    parser.add_argument('--worker', type=str, nargs=2, metavar=('MODE', 'LOG_FILE'), help=argparse.SUPPRESS, default=None)
+    return parser.parse_args(argvals)
+
+
+def worker(args, mode, logFile):
+    # Run in its own interpreter, imports are part of a check's start up but not of what is measured here
+    from loguru import logger
+    from lib import util
+
+    started = time.perf_counter()
+    if mode in ('old', 'old-lazy'):
+        logger.remove()
+        logger.add(logFile, colorize=True, level='WARNING', rotation=args.rotation, retention='3 days', compression='gz')
+    else:
+        util.init_logging(logFile=logFile, logLevel='WARNING', logMode=mode, logRotate=args.rotation)
+
+    response = {"results": [{"name": f"host{i}", "attrs": {"state": i % 4, "output": "y" * 50}} for i in range(args.entries)]}
+    for i in range(args.messages):
+        if mode == 'old':
+            logger.debug(f"response {response}")
+        else:
+            logger.opt(lazy=True).debug("response {}", lambda: response)
+        logger.warning("benchmark warning {} {}", i, "z" * args.warning_bytes)
+    # As MonitoringPlugin.exit does, so the queued records are written before the process exits
+    logger.complete()
+    print(time.perf_counter() - started)
+
+
+def count_warnings(logDir, name):
+    count = 0
+    for path in glob.glob(os.path.join(logDir, f"{name}.*")):
+        try:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', errors='replace') as fh:
+                count += sum(1 for line in fh if 'benchmark warning' in line)
+        except (OSError, EOFError):
+            pass
+    return count
+
+
+def run_mode(args, mode, logDir):
+    logFile = os.path.join(logDir, f"{mode}.log")
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode, logFile,
+               '--messages', str(args.messages), '--entries', str(args.entries),
+               '--warning-bytes', str(args.warning_bytes), '--rotation', args.rotation]
+    began = time.perf_counter()
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) for _ in range(args.processes)]
+    seconds = []
+    stderr = 0
+    for process in processes:
+        try:
+            out, err = process.communicate(timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            out, err = process.communicate()
+        try:
+            seconds.append(float(out.strip().splitlines()[-1]))
+        except (IndexError, ValueError):
+            pass
+        if err.strip():
+            stderr += 1
+    wall = time.perf_counter() - began
+    # Let the detached gzips of the inline mode finish
+    time.sleep(1)
+    return (wall, seconds, stderr, count_warnings(logDir, mode))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.worker:
+        worker(args, *args.worker)
+        raise SystemExit(0)
+
+    logDir = args.log_dir or tempfile.mkdtemp(prefix='benchmark_logging_')
+    expected = args.processes * args.messages
+    print(f"{args.processes} processes, {args.messages} debug dumps of {args.entries} entries and warnings of {args.warning_bytes} bytes each, logs in {logDir}")
+    print(f"{'mode':>9} {'wall s':>7} {'median s':>9} {'max s':>7} {'stderr':>7} {'warnings':>9} {'expected':>9}")
+    for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+        if mode not in MODES:
+            raise SystemExit(f"Unknown mode {mode}, use one of {', '.join(MODES)}")
+        wall, seconds, stderr, warnings = run_mode(args, mode, logDir)
+        median = statistics.median(seconds) if seconds else 0
+        print(f"{mode:>9} {wall:>7.1f} {median:>9.2f} {max(seconds, default=0):>7.2f} {stderr:>7} {warnings:>9} {expected:>9}")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmark for building a large check output with lib.util.MonitoringPlugin
+#
+# Adds message lines and perfdata records to a MonitoringPlugin, which keeps them in a MonitoringResult and only joins
+# them when the result is rendered, and to ConcatResult, the string concatenation MonitoringPlugin used before. Reports
+# the time of each and the time per line, which stays flat as the output grows when building it is linear.
+#
+# To use:
+# - benchmark_monitoring_result.py                                12.5k, 25k and 50k lines
+# - benchmark_monitoring_result.py --sizes 50000,100000 --repeat 5 --perfdata-every 1
+
+import argparse
+import time
+
+from loguru import logger
+
+from lib.util import MonitoringPlugin
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark building a large check output with MonitoringPlugin")
+    parser.add_argument('--sizes', type=str, help='Comma seperated list of the numbers of message lines', default='12500,25000,50000')
+    parser.add_argument('--repeat', type=int, help='Times to build each output, the best time is reported', default=3)
+    parser.add_argument('--perfdata-every', type=int, help='Add a perfdata record every nth line, 0 for none', default=10)
+    return parser.parse_args(argvals)
+
+
+class ConcatResult:
+    # The message and perfdata as strings that every line is concatenated on to, as MonitoringPlugin kept them before
+    def __init__(self):
+        self._message = ""
+        self._perfdata = ""
+
+    def setMessage(self, msg, state = None, set_state = False):
+        self._message += "{}: {}".format("Ok", msg)
+
+    def setPerfdata(self, label, value, unit_of_measurement = "", warn = "", crit = "", minimum = "", maximum = ""):
+        self._perfdata += "{label}={value}{uom};{warn};{crit};{min};{max} ".format(label=label, value=value, uom=unit_of_measurement, warn=warn, crit=crit, min=minimum, max=maximum)
+
+    def result(self):
+        return (0, "OK: " + self._message, self._perfdata.split())
+
+
+def build(plugin, size, perfdata_every):
+    for i in range(size):
+        plugin.setMessage(f"service{i} on host{i // 20} is fine, last checked 42s ago\n", 0, True)
+        if perfdata_every and i % perfdata_every == 0:
+            plugin.setPerfdata(f"service{i}_latency", i % 1000, 'ms', 500, 900)
+    return plugin.result()
+
+
+def best(factory, size, perfdata_every, repeat):
+    times = []
+    for _ in range(repeat):
+        plugin = factory()
+        start = time.perf_counter()
+        result = build(plugin, size, perfdata_every)
+        times.append(time.perf_counter() - start)
+    return (min(times), result)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+
+    print(f"{'lines':>8} {'concat ms':>10} {'us/line':>8} {'result ms':>10} {'us/line':>8} {'speedup':>8} {'match':>6}")
+    for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        concat_seconds, concat_result = best(ConcatResult, size, args.perfdata_every, args.repeat)
+        result_seconds, result = best(lambda: MonitoringPlugin(logger), size, args.perfdata_every, args.repeat)
+        match = concat_result[1] == result[1] and concat_result[2] == result[2]
+        print(f"{size:>8} {concat_seconds * 1000:>10.1f} {concat_seconds / size * 1e6:>8.2f} {result_seconds * 1000:>10.1f} "
+              f"{result_seconds / size * 1e6:>8.2f} {concat_seconds / result_seconds:>7.1f}x {str(match):>6}")
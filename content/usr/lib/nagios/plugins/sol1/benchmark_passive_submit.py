@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Throughput benchmark for passive check result submission
+#
+# Starts a local stand-in of the Icinga API process-check-result action, with a configurable delay per request
+# to stand in for the network and Icinga, and submits the same results one at a time with
+# Icinga.processServiceCheckResult and in bulk with Icinga.processCheckResults at each worker count.
+#
+# To use:
+# - benchmark_passive_submit.py                                   1500 results, 20ms per request
+# - benchmark_passive_submit.py --count 500 --latency 50 --workers 1,10,20 --fail-every 100
+
+import argparse
+import http.server
+import json
+import threading
+import time
+
+from loguru import logger
+
+from lib.icinga import Icinga
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark passive check result submission against a stand-in Icinga API")
+    parser.add_argument('--count', type=int, help='Number of check results to submit', default=1500)
+    parser.add_argument('--latency', type=float, help='Milliseconds the stand-in API takes per request', default=20)
+    parser.add_argument('--workers', type=str, help='Comma seperated list of worker counts for the bulk submission', default='5,10,20')
+    parser.add_argument('--fail-every', type=int, help='Every nth service is unknown to the stand-in API, 0 for none', default=0)
+    parser.add_argument('--skip-serial', action='store_true', help="Don't run the one at a time submission", default=False)
+    return parser.parse_args(argvals)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Without this the keep-alive responses wait on delayed ACKs
+    disable_nagle_algorithm = True
+    latency = 0
+    fail_every = 0
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0) or 0)) or b'{}')
+        time.sleep(self.latency)
+        name = payload.get('filter', '')
+        number = int(''.join(c for c in name.rsplit('svc', 1)[-1] if c.isdigit()) or 0)
+        if self.fail_every and number % self.fail_every == 0:
+            status = 404
+            body = {"error": 404, "status": "No objects found."}
+        else:
+            status = 200
+            body = {"results": [{"code": 200, "status": f"Successfully processed check result for object '{name}'."}]}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def results(count):
+    for i in range(count):
+        yield (f"host{i // 10}", f"svc{i}", i % 3, f"OK - service {i}", [f"value={i}"])
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+
+    StubHandler.latency = args.latency / 1000
+    StubHandler.fail_every = args.fail_every
+    stub = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    stub.daemon_threads = True
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    icinga = Icinga(f"http://127.0.0.1:{stub.server_address[1]}", 'user', 'pass')
+
+    print(f"{'method':<20} {'results':>8} {'failed':>7} {'seconds':>8} {'per sec':>8}")
+    if not args.skip_serial:
+        start = time.monotonic()
+        failed = 0
+        for host, service, status, message, perfdata in results(args.count):
+            response = icinga.processServiceCheckResult(host, service, status, message, perfdata)
+            failed += 0 if "results" in response else 1
+        seconds = time.monotonic() - start
+        print(f"{'serial':<20} {args.count:>8} {failed:>7} {seconds:>8.2f} {args.count / seconds:>8.1f}")
+
+    for workers in [int(w) for w in args.workers.split(',') if w.strip()]:
+        summary = icinga.processCheckResults(results(args.count), workers=workers)
+        print(f"{f'bulk {workers} workers':<20} {summary['submitted']:>8} {summary['failed']:>7} {summary['seconds']:>8.2f} {summary['rate']:>8.1f}")
+
+    stub.shutdown()
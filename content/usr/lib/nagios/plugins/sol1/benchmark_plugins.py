@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Cold start benchmark for the python plugins
+#
+# For every python plugin this records the wall clock time, max RSS and total import time (from -X importtime)
+# of running the plugin with --help, and optionally of a stubbed run against a local stand-in http server that
+# answers every request with an empty JSON document. Results can be saved and compared with a previous run to
+# catch start up regressions.
+#
+# To use:
+# - benchmark_plugins.py                                   --help run of every python plugin
+# - benchmark_plugins.py --scenarios scenarios.json        also do the stubbed runs listed in the file
+# - benchmark_plugins.py --output now.json --baseline before.json --threshold 20
+#
+# Scenarios file, "{stub}" in an argument is replaced with the stand-in server url:
+# {"check_vast.py": ["-s", "{stub}", "-u", "user", "-p", "pass", "--disable-log-file", "clusters"]}
+
+import argparse
+import http.server
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark import time, RSS and wall clock of the python plugins")
+    parser.add_argument('--plugins', type=str, help='Comma seperated list of plugins, default is every python plugin in the plugin dir', default=None)
+    parser.add_argument('--scenarios', type=str, help='JSON file of plugin name to arguments for a stubbed run', default=None)
+    parser.add_argument('--repeat', type=int, help='Number of runs per plugin, the median is reported', default=3)
+    parser.add_argument('--timeout', type=int, help='Timeout in seconds for a single run', default=30)
+    parser.add_argument('--top', type=int, help='Number of slowest imports to show per plugin', default=3)
+    parser.add_argument('--output', type=str, help='Write the results to this JSON file', default=None)
+    parser.add_argument('--baseline', type=str, help='JSON results of a previous run to compare with', default=None)
+    parser.add_argument('--threshold', type=float, help='Percent slower than the baseline that counts as a regression', default=20)
+    return parser.parse_args(argvals)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def _reply(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_importtime(stderr):
+    """Parse -X importtime output
+
+    Returns:
+        tuple: (int, list) total import time in microseconds and [(cumulative us, module)] for top level imports
+    """
+    total = 0
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            total += int(self_us)
+            # nested imports are indented under their parent
+            if not name[1:].startswith(' '):
+                top_level.append((int(cumulative_us), name.strip()))
+        except ValueError:
+            continue
+    return (total, sorted(top_level, reverse=True))
+
+
+def run_once(plugin, argv, timeout):
+    start = time.monotonic()
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', os.path.join(PLUGIN_DIR, plugin)] + argv,
+                            cwd=PLUGIN_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        _, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        _, stderr = proc.communicate()
+    wall = time.monotonic() - start
+    import_us, imports = parse_importtime(stderr)
+    return {"wall_ms": wall * 1000, "import_ms": import_us / 1000, "imports": imports, "exit_code": proc.returncode}
+
+
+def measure(plugin, argv, repeat, timeout, top):
+    runs = []
+    for _ in range(repeat):
+        # Fork a helper per run so RUSAGE_CHILDREN only covers that plugin run
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            result = run_once(plugin, argv, timeout)
+            result['rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            with os.fdopen(write_fd, 'w') as fh:
+                json.dump(result, fh)
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fh:
+            data = fh.read()
+        os.waitpid(pid, 0)
+        runs.append(json.loads(data))
+
+    return {
+        "argv": argv,
+        "wall_ms": round(statistics.median(r['wall_ms'] for r in runs), 1),
+        "rss_kb": statistics.median(r['rss_kb'] for r in runs),
+        "import_ms": round(statistics.median(r['import_ms'] for r in runs), 1),
+        "exit_code": runs[-1]['exit_code'],
+        "slowest_imports": [[round(us / 1000, 1), name] for us, name in runs[-1]['imports'][:top]]
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        for metric in ['wall_ms', 'import_ms', 'rss_kb']:
+            if before.get(metric) and result[metric] > before[metric] * (1 + threshold / 100):
+                regressions.append(f"{key} {metric} {before[metric]} -> {result[metric]}")
+    return regressions
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    if args.plugins:
+        plugins = [p.strip() for p in args.plugins.split(',') if p.strip()]
+    else:
+        plugins = sorted(f for f in os.listdir(PLUGIN_DIR) if f.endswith('.py') and f != os.path.basename(__file__))
+
+    scenarios = {}
+    stub = None
+    if args.scenarios:
+        with open(args.scenarios) as fh:
+            scenarios = json.load(fh)
+        stub = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+
+    results = {}
+    for plugin in plugins:
+        results[f"{plugin} --help"] = measure(plugin, ['--help'], args.repeat, args.timeout, args.top)
+        if plugin in scenarios:
+            argv = [str(a).replace('{stub}', stub_url) for a in scenarios[plugin]]
+            results[f"{plugin} run"] = measure(plugin, argv, args.repeat, args.timeout, args.top)
+
+    if stub is not None:
+        stub.shutdown()
+
+    print(f"{'plugin':<50} {'wall ms':>9} {'import ms':>10} {'rss kB':>9} {'rc':>3}  slowest imports (ms)")
+    for key, result in results.items():
+        slowest = ', '.join(f"{name} {ms}" for ms, name in result['slowest_imports'])
+        print(f"{key:<50} {result['wall_ms']:>9} {result['import_ms']:>10} {result['rss_kb']:>9} {result['exit_code']:>3}  {slowest}")
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
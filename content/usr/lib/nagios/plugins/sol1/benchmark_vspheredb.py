@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmark and comparison for the check_icinga2_vspheredb passivehosts VM sources
+#
+# Without --db-type mysql it builds a SQLite stand-in of the two vspheredb tables the db source reads (STANDIN_SCHEMA)
+# with --vms VMs in random states, and times reading and evaluating all of them with VSphereDB.
+#
+# With --compare it also runs icingacli vspheredb check vm for each VM from a pool of --workers and reports the VMs the
+# two sources give a different state for. This needs icingacli and the real vspheredb database (--db-type mysql). The
+# db source only checks the overall status and power state, so a VM that fails another of icingacli's checks is
+# reported as different.
+#
+# To use:
+# - benchmark_vspheredb.py                                              5000 VMs in a SQLite stand-in
+# - benchmark_vspheredb.py --db-type mysql --db-password pass --compare --limit 200
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from collections import Counter
+from loguru import logger
+
+from check_icinga2_vspheredb import IcingaCli, VSphereDB
+
+# The columns of the vspheredb object and virtual_machine tables VSphereDB.QUERY uses
+STANDIN_SCHEMA = """
+    CREATE TABLE object (uuid BLOB PRIMARY KEY, vcenter_uuid BLOB, moref TEXT, object_name TEXT, object_type TEXT,
+                         overall_status TEXT, level INT, parent_uuid BLOB);
+    CREATE TABLE virtual_machine (uuid BLOB PRIMARY KEY, vcenter_uuid BLOB, runtime_power_state TEXT, guest_state TEXT);
+"""
+OVERALL_STATUSES = ['green'] * 90 + ['yellow'] * 6 + ['red'] * 3 + ['gray']
+POWER_STATES = ['poweredOn'] * 95 + ['poweredOff'] * 4 + ['suspended']
+STATE_NAMES = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vspheredb database VM source and compare it with icingacli")
+    parser.add_argument('--vms', type=int, help='VMs in the SQLite stand-in', default=5000)
+    parser.add_argument('--seed', type=int, help='Random seed for the stand-in VM states', default=1)
+    parser.add_argument('--repeat', type=int, help='Times to read the VMs, the best time is reported', default=3)
+    parser.add_argument('--compare', action='store_true', help='Also check each VM with icingacli and report the VMs with a different state', default=False)
+    parser.add_argument('--limit', type=int, help='Only compare this many VMs, 0 for all', default=0)
+    parser.add_argument('--workers', type=int, help='Number of icingacli checks to run at once', default=10)
+    parser.add_argument('--vm-timeout', type=float, help='Seconds an icingacli check for a single VM can take', default=20)
+    parser.add_argument('--deadline', type=float, help='Seconds the database query can take', default=50)
+    parser.add_argument('--db-type', type=str, choices=['mysql', 'sqlite'], help='vspheredb database type, sqlite builds a stand-in', default='sqlite')
+    parser.add_argument('--db-host', type=str, help='vspheredb database host', default='localhost')
+    parser.add_argument('--db-port', type=int, help='vspheredb database port', default=3306)
+    parser.add_argument('--db-name', type=str, help='vspheredb database name, or the stand-in file for sqlite (default a new temporary file)', default=None)
+    parser.add_argument('--db-user', type=str, help='vspheredb database username', default='vspheredb')
+    parser.add_argument('--db-password', type=str, help='vspheredb database password', default='')
+    return parser.parse_args(argvals)
+
+
+def build_standin(path, count, seed):
+    rng = random.Random(seed)
+    vcenter = uuid.uuid4().bytes
+    db = sqlite3.connect(path)
+    try:
+        db.executescript(STANDIN_SCHEMA)
+        for i in range(count):
+            vm_uuid = uuid.uuid4().bytes
+            db.execute("INSERT INTO object VALUES (?, ?, ?, ?, 'VirtualMachine', ?, 3, NULL)",
+                       (vm_uuid, vcenter, f"vm-{i}", f"vm{i}", rng.choice(OVERALL_STATUSES)))
+            db.execute("INSERT INTO virtual_machine VALUES (?, ?, ?, 'running')", (vm_uuid, vcenter, rng.choice(POWER_STATES)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def states(results):
+    # VM name to state name, or the error for a VM that couldn't be checked
+    checked = {}
+    for vm_name, (result, success) in results.items():
+        checked[vm_name] = STATE_NAMES.get(result.exit(do_exit=False)[0], 'UNKNOWN') if success else f"failed: {result}"
+    return checked
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.remove()
+    if args.db_type == 'sqlite' and args.db_name is None:
+        args.db_name = os.path.join(tempfile.mkdtemp(prefix='benchmark_vspheredb_'), 'vspheredb.sqlite')
+        build_standin(args.db_name, args.vms, args.seed)
+        print(f"Built a stand-in with {args.vms} VMs in {args.db_name}")
+
+    source = VSphereDB(args)
+    vm_names = list(source.getVMs())
+    if args.limit:
+        vm_names = vm_names[:args.limit]
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        db_results = source.vSphereDBVMs(vm_names)
+        times.append(time.perf_counter() - start)
+    db_states = states(db_results)
+    print(f"db source: {len(vm_names)} VMs in {min(times):.3f}s, {dict(Counter(db_states.values()))}")
+
+    if args.compare:
+        start = time.perf_counter()
+        cli_states = states(IcingaCli(args.vm_timeout).vSphereDBVMs(vm_names, workers=args.workers))
+        print(f"icingacli: {len(vm_names)} VMs in {time.perf_counter() - start:.3f}s with {args.workers} workers, {dict(Counter(cli_states.values()))}")
+        different = [vm_name for vm_name in vm_names if db_states[vm_name] != cli_states[vm_name]]
+        for vm_name in different:
+            print(f"  {vm_name}: db {db_states[vm_name]}, icingacli {cli_states[vm_name]}")
+        print(f"{len(vm_names) - len(different)} VMs have the same state, {len(different)} differ")
+        raise SystemExit(1 if different else 0)
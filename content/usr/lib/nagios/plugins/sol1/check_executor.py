@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Daemon that keeps the python plugins preloaded and runs checks sent to it by check_executor_client.py
+
+import argparse
+import os
+
+from loguru import logger
+import lib.util as util
+from lib.executor import CheckExecutor, CheckRunner, PluginCache, DEFAULT_SOCKET, DEFAULT_TIMEOUT
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Preload the python plugins and run checks requested over a unix socket")
+    parser.add_argument('--socket', type=str, help='Unix socket to listen on', default=DEFAULT_SOCKET)
+    parser.add_argument('--socket-mode', type=lambda m: int(m, 8), help='Permissions for the unix socket (octal)', default='660')
+    parser.add_argument('--plugin-dir', type=str, help='Directory the plugins are run from', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--plugins', type=str, help='Comma seperated list of plugins to preload, default is every python plugin in the plugin dir', default=None)
+    parser.add_argument('--max-workers', type=int, help='Maximum number of checks to run at the same time', default=40)
+    parser.add_argument('--timeout', type=int, help='Default timeout in seconds for a single check', default=DEFAULT_TIMEOUT)
+
+    parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--enable-screen-debug', action="store_true")
+    parser.add_argument('--log-rotate', type=str, default='1 day')
+    parser.add_argument('--log-retention', type=str, default='3 days')
+
+    return parser.parse_args(argvals)
+
+
+if __name__ == "__main__":
+    # Init args
+    args = get_args()
+
+    # Init logging
+    util.init_logging(debug=args.debug, enableScreenDebug=args.enable_screen_debug, logFile='/var/log/icinga2/check_executor.log', logRotate=args.log_rotate, logRetention=args.log_retention)
+    logger.info("Starting check executor with args [{}]".format(args))
+
+    plugins = None
+    if args.plugins:
+        plugins = [p.strip() for p in args.plugins.split(',') if p.strip()]
+
+    # Preload and serve until stopped
+    runner = CheckRunner(PluginCache(args.plugin_dir, plugins), timeout=args.timeout)
+    executor = CheckExecutor(args.socket, runner, max_workers=args.max_workers, socket_mode=args.socket_mode)
+    try:
+        executor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.server_close()
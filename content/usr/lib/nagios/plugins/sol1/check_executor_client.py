@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Thin client for check_executor.py, sends the plugin, arguments and environment to the executor and returns
+# its output and exit code. Only uses the standard library so it starts fast, if the executor can't be reached
+# the plugin is run directly instead.
+#
+# Usage: check_executor_client.py <plugin> [plugin args...]
+# e.g. check_executor_client.py check_vast.py -s https://vast.example.com -u user -p pass clusters
+
+import json
+import os
+import socket
+import sys
+
+SOCKET = os.environ.get('CHECK_EXECUTOR_SOCKET', '/run/icinga2/check_executor.sock')
+TIMEOUT = int(os.environ.get('CHECK_EXECUTOR_TIMEOUT', 60))
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STATE_UNKNOWN = 3
+
+
+def run_direct(plugin, argv):
+    path = os.path.join(PLUGIN_DIR, os.path.basename(plugin))
+    os.execv(sys.executable, [sys.executable, path] + argv)
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(f"UNKNOWN: usage {os.path.basename(argv[0])} <plugin> [plugin args...]")
+        return STATE_UNKNOWN
+    plugin = argv[1]
+    request = {
+        "plugin": plugin,
+        "argv": argv[2:],
+        "env": dict(os.environ),
+        "timeout": TIMEOUT
+    }
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET)
+    except OSError:
+        # No executor, run the check the normal way
+        client.close()
+        run_direct(plugin, argv[2:])
+
+    # Once connected the check is running so don't fall back to running it again
+    try:
+        client.settimeout(TIMEOUT + 5)
+        client.sendall((json.dumps(request) + "\n").encode())
+        client.shutdown(socket.SHUT_WR)
+        data = b""
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        response = json.loads(data)
+    except (OSError, ValueError) as e:
+        print(f"UNKNOWN: check executor error running {plugin}: {e}")
+        return STATE_UNKNOWN
+    finally:
+        client.close()
+
+    sys.stdout.write(response.get('stdout', ''))
+    sys.stderr.write(response.get('stderr', ''))
+    return int(response.get('exit_code', STATE_UNKNOWN))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
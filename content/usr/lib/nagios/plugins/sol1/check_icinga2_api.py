@@ -20,6 +20,7 @@ import sys
 
 from loguru import logger
 import lib.util as util
+from lib.trend import RingBuffer, Trend, ringFile, DEFAULT_SLOTS, DEFAULT_WINDOW, DEFAULT_HALF_LIFE, DEFAULT_MIN_SPAN
 
 from requests.packages import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -42,6 +43,19 @@ def get_args():
     parser.add_argument('--critrq', type=int, help='Maximum number for remote check queue to trigger critical', default=20)
     parser.add_argument('--warnqq', type=int, help='Maximum number for IDO query queue to trigger warning', default=50)
     parser.add_argument('--critqq', type=int, help='Maximum number for IDO query queue to trigger critical', default=200)
+    parser.add_argument('--per-component', action='store_true', help='Fetch only the /v1/status/<component> endpoints for --nodes (and CIB for the uptime) instead of the full status')
+    parser.add_argument('--trend', action='store_true', help='Keep samples of the IDO query queue and remote check queue between runs and check how fast they grow')
+    parser.add_argument('--trend-dir', type=str, help='Directory for the trend sample files', default='/tmp')
+    parser.add_argument('--trend-slots', type=int, help='Number of samples kept for each queue', default=DEFAULT_SLOTS)
+    parser.add_argument('--trend-window', type=int, help='Seconds of samples used for the growth rate', default=DEFAULT_WINDOW)
+    parser.add_argument('--trend-half-life', type=int, help='Seconds for a sample to lose half its weight in the moving average', default=DEFAULT_HALF_LIFE)
+    parser.add_argument('--trend-min-span', type=int, help='Seconds the samples must cover before there is a growth rate', default=DEFAULT_MIN_SPAN)
+    parser.add_argument('--warnqqrate', type=float, help='IDO query queue growth in items per minute to trigger warning', default=None)
+    parser.add_argument('--critqqrate', type=float, help='IDO query queue growth in items per minute to trigger critical', default=None)
+    parser.add_argument('--warnrqrate', type=float, help='Remote check queue growth in items per minute to trigger warning', default=None)
+    parser.add_argument('--critrqrate', type=float, help='Remote check queue growth in items per minute to trigger critical', default=None)
+    parser.add_argument('--warnforecast', type=int, help='Seconds until a queue is forecast to reach its critical threshold to trigger warning', default=None)
+    parser.add_argument('--critforecast', type=int, help='Seconds until a queue is forecast to reach its critical threshold to trigger critical', default=None)
     parser.add_argument('--uptime_grace', type=int, help='Grace period after Icinga2 starts before we use check results', default=60)
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--enable-screen-debug', action="store_true")
@@ -78,6 +92,46 @@ def getKeyValue (element, *keys):
         plugin.setMessage("Missing key {}\n".format(','.join(keys)), plugin.STATE_CRITICAL, True)
     return v
 
+def checkTrend(name, msg_prefix, value, crit, warn_rate, crit_rate):
+    '''
+    Add a sample of a queue to its ring buffer, check its growth rate and when it will reach `crit`.
+    '''
+    if not args.trend:
+        return
+    try:
+        ring = RingBuffer(ringFile('check_icinga2_api', name, base_url, cacheDir=args.trend_dir), slots=args.trend_slots)
+        samples = ring.add(value)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unable to keep samples for {name}: {e}")
+        plugin.message = "Info: {} trend unavailable ({})\n".format(msg_prefix, e)
+        return
+    trend = Trend(samples, window=args.trend_window, halfLife=args.trend_half_life, minSpan=args.trend_min_span)
+    logger.debug(f"{name} samples: {len(samples)}, rate: {trend.rate}, ewma: {trend.ewma}")
+    if trend.rate is None:
+        plugin.message = "Info: {} trend needs samples over {}s ({} so far)\n".format(msg_prefix, args.trend_min_span, len(samples))
+        return
+    rate = trend.rate * 60
+    plugin.setPerfdata(f"{name}_rate", round(rate, 3), "", warn_rate or "", crit_rate or "")
+    plugin.setPerfdata(f"{name}_ewma", round(trend.ewma, 3))
+    msg_prefix = "{} trend {:+.1f}/min over {:.0f}s".format(msg_prefix, rate, trend.span)
+    if crit_rate is not None and rate > crit_rate:
+        plugin.setMessage("{} is above critical rate ({}/min)\n".format(msg_prefix, crit_rate), plugin.STATE_CRITICAL, True)
+    elif warn_rate is not None and rate > warn_rate:
+        plugin.setMessage("{} is above warning rate ({}/min)\n".format(msg_prefix, warn_rate), plugin.STATE_WARNING, True)
+    else:
+        plugin.message = "Info: {}\n".format(msg_prefix)
+
+    # Only forecast while still under the threshold, above it the static check already alerts
+    eta = trend.timeTo(crit)
+    if eta is None or eta == 0:
+        return
+    plugin.setPerfdata(f"{name}_forecast", round(eta), "s", args.warnforecast or "", args.critforecast or "", 0)
+    msg_prefix = "{} forecast to reach critical threshold ({}) in {:.0f}s".format(msg_prefix, crit, eta)
+    if args.critforecast is not None and eta < args.critforecast:
+        plugin.setMessage("{}, less than {}s\n".format(msg_prefix, args.critforecast), plugin.STATE_CRITICAL, True)
+    elif args.warnforecast is not None and eta < args.warnforecast:
+        plugin.setMessage("{}, less than {}s\n".format(msg_prefix, args.warnforecast), plugin.STATE_WARNING, True)
+
 # Functions to check features of the api
 def IcingaApplication(leaf):
     # Check running
@@ -134,6 +188,7 @@ def IdoMysqlConnection(leaf):
             plugin.setMessage("{} is above warning threshold ({})\n".format(msg_prefix, args.warnqq), plugin.STATE_WARNING)
         else:
             plugin.setMessage("{}\n".format(msg_prefix), plugin.STATE_OK)
+        checkTrend('query_queue', "IDOMysql: Query queue", query_queue_items, args.critqq, args.warnqqrate, args.critqqrate)
     else: 
         plugin.setCritical()
         plugin.setMessage("{} missing query items\n".format(msg_prefix), plugin.STATE_CRITICAL)
@@ -220,6 +275,7 @@ def CIB(leaf):
             plugin.setMessage("CIB: Remote check queue ({}) is less than warn threshold ({})\n".format(remote_check_queue, args.warnrq), plugin.STATE_WARNING)
         else:
             plugin.setMessage("CIB: Remote check queue ({})\n".format(remote_check_queue), plugin.STATE_OK)
+        checkTrend('remote_check_queue', "CIB: Remote check queue", remote_check_queue, args.critrq, args.warnrqrate, args.critrqrate)
 
 
     # TODO: current_pending_callbacks may also deviate under adverse conditions, no test yet just a value in output
@@ -235,25 +291,33 @@ logger.info("Processing check_icinga2_api with args [{}]".format(args))
 # Init plugin
 plugin = util.MonitoringPlugin(logger, "Icinga2 API {}".format(args.nodes))
 
-url = args.proto + '://' + args.server + ':' + args.port + '/' + args.path
+base_url = args.proto + '://' + args.server + ':' + args.port
 headers = {
     'Accept': 'application/json ; indent=4',
     'X-HTTP-Method-Override': 'GET'
 }
 
-try:
-    result = requests.get(url, headers, auth=(args.username, args.password), verify=False)
-    logger.info("Url: {}".format(result.url))
-    logger.info("Return status: {}".format(result.status_code))
-    logger.debug("Text: {}".format(result.text))
-except requests.exceptions.RequestException as e:
-    logger.error("{0} requests.get failed with exception\n{1}\n".format(args.proto, e))
-    plugin.setMessage("{0} requests.get failed with exception\n{1}\n".format(args.proto, e), plugin.STATE_CRITICAL, True)
-    plugin.exit()
-
+def getStatus(session, path):
+    '''
+    Get the status leaves from `path`, None if the API didn't return a usable result.
+    '''
+    url = base_url + '/' + path
+    try:
+        # Sent as query params, as the check always has
+        result = session.get(url, params=headers, auth=(args.username, args.password), verify=False)
+        logger.info("Url: {}".format(result.url))
+        logger.info("Return status: {}".format(result.status_code))
+        logger.debug("Text: {}".format(result.text))
+    except requests.exceptions.RequestException as e:
+        logger.error("{0} requests.get failed with exception\n{1}\n".format(args.proto, e))
+        plugin.setMessage("{0} requests.get failed with exception\n{1}\n".format(args.proto, e), plugin.STATE_CRITICAL, True)
+        plugin.exit()
 
-# make sure we get a http result we like
-if result.status_code in [200, 301, 302]:
+    # make sure we get a http result we like
+    if result.status_code not in [200, 301, 302]:
+        logger.error("Invalid return code ({}) from http request to API\n{}".format(result.status_code, result.text))
+        plugin.setMessage("Invalid return code ({}) from http request to API\n{}".format(result.status_code, result.text), plugin.STATE_CRITICAL, True)
+        return None
     try: 
         jresult = result.json()
     except:
@@ -263,13 +327,29 @@ if result.status_code in [200, 301, 302]:
 
     if args.debug:
         logger.debug(json.dumps(jresult, indent=4, sort_keys=True))
+    return jresult['results']
 
-    # Uptime determines status so get it first
-    icinga_uptime = None
-
+# The full status has a leaf for every feature, some (eg perfdata writers) are expensive to build, the component
+# endpoints only build the ones we check. CIB is always needed for the uptime.
+if args.per_component:
+    components = list(dict.fromkeys(args.nodes.split(',') + ['CIB']))
+    paths = ['{}/{}'.format(args.path.rstrip('/'), component) for component in components]
+else:
+    paths = [args.path]
+
+# Uptime determines status so get it first
+icinga_uptime = None
+results = None
+with requests.Session() as session:
+    for path in paths:
+        leaves = getStatus(session, path)
+        if leaves is not None:
+            results = (results or []) + leaves
+
+if results is not None:
     # make sure we get api data in the result
     processed_nodes = []
-    for leaf in jresult['results']:
+    for leaf in results:
         name = getKeyValue(leaf, 'name')
         logger.debug(f"leaf name: {name}")
         try:
@@ -285,9 +365,6 @@ if result.status_code in [200, 301, 302]:
     if set(processed_nodes) != set(args.nodes.split(',')):
         logger.error("Processed nodes ({processed}) don't match required nodes ({required})\n".format(processed=','.join(processed_nodes), required=args.nodes))
         plugin.setMessage("Processed nodes ({processed}) don't match required nodes ({required})\n".format(processed=','.join(processed_nodes), required=args.nodes), plugin.STATE_CRITICAL, True)
-else:
-    logger.error("Invalid return code ({}) from http request to API\n{}".format(result.status_code, result.text))
-    plugin.setMessage("Invalid return code ({}) from http request to API\n{}".format(result.status_code, result.text), plugin.STATE_CRITICAL, True)
 
 if icinga_uptime is None: 
     plugin.message = "Info: CIB Uptime is missing"
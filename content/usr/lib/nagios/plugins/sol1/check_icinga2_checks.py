@@ -2,14 +2,46 @@
 
 import lib.jsonarg as argparse
 from datetime import datetime, timedelta
-import humanize
+import copy
+import heapq
 import json
+import math
+import os
 
+from lib.checkmetrics import checkMetrics
 from lib.icinga import Icinga
+from lib.icingadb import IcingaDB, IcingaDBError
+from lib.icingafilter import compileFilter, partition, FilterNotSupported
+from lib.icingaredis import IcingaRedis, IcingaRedisError
+from lib.lazy import lazyImport
+from lib.perfdata import parsePerfdata, parseRange, formatLabel, PerfdataAggregate, AGGREGATES
+from lib.stateindex import queryIndex, StateIndexError
 from sol1_monitoring_plugins_lib import MonitoringPlugin, initLogging, initLoggingArgparse
 
 from loguru import logger
 
+# Only needed by some modes
+humanize = lazyImport('humanize')
+
+# Object attributes each mode reads, only these are requested from the Icinga API
+MODE_ATTRS = {
+    'best': ['name', 'host_name', 'last_check_result'],
+    'redundancy': ['name', 'host_name', 'last_check_result'],
+    'sum': ['name', 'host_name', 'last_check_result'],
+    'statusmetrics': ['last_check_result', 'acknowledgement', 'last_check', 'check_interval'],
+    'overdue': ['acknowledgement', 'last_check', 'check_interval', 'zone', 'command_endpoint', 'last_check_result'],
+    'summary': ['name']
+}
+# Attributes hosts don't have, asking for an attribute the type doesn't have is an error
+SERVICE_ONLY_ATTRS = ['host_name']
+# Modes the groups mode can evaluate and the defaults for their arguments
+GROUP_MODES = {
+    'redundancy': {'degraded_state': 1},
+    'best': {},
+    'sum': {'warn': None, 'crit': None, 'aggregates': 'sum'},
+    'statusmetrics': {'buffer': 60, 'return_check_state': False, 'filter_check_state': ''}
+}
+
 
 def get_args(argvals=None):
     parser = argparse.ArgumentParser(description="Use the Icinga API to get check results and return a different check result")
@@ -18,6 +50,21 @@ def get_args(argvals=None):
     parser.add_argument('-s', '--server', type=str, help='Icinga API server url including port, eg: https://icinga.example.com:5665', required=True)
     parser.add_argument('-u', '--username', type=str, help='Icinga API username', required=True)
     parser.add_argument('-p', '--password', type=str, help='Icinga API password', required=True)
+    parser.add_argument('--state-index', type=str, help='Unix socket of check_state_index.py to get the checks from, the API is used if it is unavailable', required=False, default=None)
+    parser.add_argument('--state-index-max-age', type=float, help="Seconds since the state index's last event after which the API is used instead", default=300)
+
+    # IcingaDB settings, defaults are the stack's ICINGA2_DB_MYSQL_* environment
+    parser.add_argument('--icingadb', action="store_true", help="Count statusmetrics, summary and overdue with queries of the IcingaDB database, the API is used for filters that can't be translated", default=False)
+    parser.add_argument('--icingadb-type', type=str, choices=['mysql', 'sqlite'], help='IcingaDB database type, sqlite is for testing', default='mysql')
+    parser.add_argument('--icingadb-host', type=str, help='IcingaDB database host', default=os.environ.get('ICINGA2_DB_MYSQL_HOST', 'localhost'))
+    parser.add_argument('--icingadb-port', type=int, help='IcingaDB database port', default=int(os.environ.get('ICINGA2_DB_MYSQL_PORT') or 3306))
+    parser.add_argument('--icingadb-name', type=str, help='IcingaDB database name, or file for sqlite', default=os.environ.get('ICINGA2_DB_MYSQL_DATA', 'icingadb'))
+    parser.add_argument('--icingadb-user', type=str, help='IcingaDB database user', default=os.environ.get('ICINGA2_DB_MYSQL_USER', 'icingadb'))
+    parser.add_argument('--icingadb-password', type=str, help='IcingaDB database password', default=os.environ.get('ICINGA2_DB_MYSQL_PASS', ''))
+    parser.add_argument('--icingadb-redis', action="store_true", help="Get the objects from the IcingaDB Redis instead of the API, the API is used for what Redis can't answer", default=False)
+    parser.add_argument('--icingadb-redis-host', type=str, help='IcingaDB Redis host', default='localhost')
+    parser.add_argument('--icingadb-redis-port', type=int, help='IcingaDB Redis port', default=6380)
+    parser.add_argument('--icingadb-redis-password', type=str, help='IcingaDB Redis password', default=None)
     
     # Debug and Logging settings
     initLoggingArgparse(parser)
@@ -43,6 +90,7 @@ def get_args(argvals=None):
     parserSum.add_argument('--filter', type=str, help='Filter for checks to process', required=True)
     parserSum.add_argument('--warn', type=str, help='JSON dictionary of perfdata name regex to warning threshold, setting will ignore underlying check status of warning', required=False)
     parserSum.add_argument('--crit', type=str, help='JSON dictionary of perfdata name regex to critical threshold, setting will ignore underlying check status of critical', required=False)
+    parserSum.add_argument('--aggregates', type=str, help=f"Comma seperated list of the aggregates of each perfdata label to return ({', '.join(AGGREGATES)}), aggregates other than sum are returned as <label>_<aggregate>", default='sum', required=False)
 
     # Status Metrics
     parserStatusMetrics = subparser.add_parser("statusmetrics", help="Return the Status Metrics from a group of checks, including the perfdata.")
@@ -58,6 +106,7 @@ def get_args(argvals=None):
     parserOverdue.add_argument('--buffer', type=str, help='Seconds something can be past next check time before being counted as overdue', default=60, required=False)
     parserOverdue.add_argument('--warn', type=str, help='How many overdue before we warn', default=1, required=False)
     parserOverdue.add_argument('--crit', type=str, help='How many overdue before we crit', default=2, required=False)
+    parserOverdue.add_argument('--limit', type=int, help='Number of the most overdue objects (and zones and endpoints) to list, the counts include all of them. 0 lists everything', default=20, required=False)
 
     parserSummary = subparser.add_parser("summary", help="Summary of Services.")
     parserSummary.add_argument('--type', type=str, default='services', const='all', nargs='?', choices=['all', 'services', 'hosts'], help='Type of checks to process')
@@ -65,6 +114,12 @@ def get_args(argvals=None):
     parserSummary.add_argument('--min', type=int, help="Minimum number of results to return", default=0)
     parserSummary.add_argument('--max', type=int, help="Maximum number of results to return", default=9999)
 
+    parserGroups = subparser.add_parser("groups", help="Evaluate the groups in a group file from one fetch of the checks and submit the results passively.")
+    parserGroups.add_argument('--type', type=str, default='services', const='services', nargs='?', choices=['services', 'hosts'], help='Type of checks to process')
+    parserGroups.add_argument('--groups', type=str, help='JSON file of groups, a list of {"name", "mode", "filter", "host", "service", thresholds...}', required=True)
+    parserGroups.add_argument('--fetch-filter', type=str, help='Filter for the single fetch, default is all of the group filters or-ed together', required=False, default=None)
+    parserGroups.add_argument('--submit-workers', type=int, help='Number of passive results to submit to the Icinga API at once', default=10)
+
     args = parser.parse_args(argvals)
 
     return args
@@ -75,10 +130,91 @@ class IcingaChecker(Icinga):
         self._args = _args
         super().__init__(server, user, password)  
         logger.debug(f"Class args: {self._args}")
+        self._groupChecks = None
+        self._db = None
+        self._redis = None
+        if getattr(self._args, 'icingadb_redis', False):
+            self._redis = IcingaRedis(self._args.icingadb_redis_host, self._args.icingadb_redis_port, self._args.icingadb_redis_password)
+        if getattr(self._args, 'icingadb', False):
+            self._db = IcingaDB(self._args.icingadb_type, self._args.icingadb_host, self._args.icingadb_port, self._args.icingadb_name,
+                                self._args.icingadb_user, self._args.icingadb_password)
+
+    def _checks(self, stream = False):
+        """Get the checks for the type and filter args with only the attributes the mode needs
+
+        Args:
+            stream (bool, optional): return a generator that decodes the checks as they are read instead of a list. Defaults to False.
+
+        Returns:
+            list|generator: check result objects
+        """
+        # The groups mode has already fetched the checks for the group it is evaluating
+        if self._groupChecks is not None:
+            return self._groupChecks
+        attrs = MODE_ATTRS.get(self._args.mode)
+        if attrs is not None and self._args.type != 'services':
+            attrs = [attr for attr in attrs if attr not in SERVICE_ONLY_ATTRS]
+        return self._fetch(self._args.filter, attrs, stream=stream)
+
+    def _fetch(self, filter, attrs, joins = None, stream = False):
+        # From the IcingaDB Redis if it is set, it has the live state of every object
+        if self._redis is not None:
+            try:
+                checks = self._redis.getCheckResults(self._args.type, filter, attrs, joins)
+                logger.info(f"Got {len(checks)} {self._args.type} from IcingaDB Redis")
+                return checks
+            except (IcingaRedisError, FilterNotSupported) as e:
+                logger.warning(f"Not using IcingaDB Redis, {e}")
+        # From the state index if there is one, it answers from memory instead of a scan of every object
+        if self._args.state_index and not joins:
+            try:
+                checks = queryIndex(self._args.state_index, self._args.type, filter, attrs, max_age=self._args.state_index_max_age)
+                logger.info(f"Got {len(checks)} {self._args.type} from the state index")
+                return checks
+            except StateIndexError as e:
+                logger.warning(f"Using the Icinga API, {e}")
+        checks = self._apiChecks(filter, attrs, joins)
+        return checks if stream else list(checks)
+
+    def _apiChecks(self, filter, attrs, joins):
+        """Stream the checks from the Icinga API. A failed request or a response that ends early exits the check
+        CRITICAL, the modes would otherwise judge the checks read before the error as if they were all of them.
+
+        Yields:
+            dict: check result object
+        """
+        count = 0
+        try:
+            for check in self.iterCheckResults(self._args.type, filter, attrs, joins, raise_errors=True):
+                count += 1
+                yield check
+        except Exception as e:
+            plugin.setMessage(f"Unable to get the {self._args.type} from the Icinga API after {count} results: {e}\n", plugin.STATE_CRITICAL, True)
+            plugin.exit()
+
+    def _icingadb(self, query):
+        """Run a query of IcingaDB when --icingadb is set
+
+        Args:
+            query (function): called with the IcingaDB, eg lambda db: db.names(type, filter)
+
+        Returns:
+            any: the result of query, None if the API should be used instead
+        """
+        # The groups mode has already fetched the checks
+        if self._db is None or self._groupChecks is not None:
+            return None
+        try:
+            return query(self._db)
+        except FilterNotSupported as e:
+            logger.info(f"Using the Icinga API, the filter can't be translated for IcingaDB: {e}")
+        except IcingaDBError as e:
+            logger.warning(f"Using the Icinga API, {e}")
+        return None
     
     def best(self):
         # Get checks
-        checks = self.getCheckResults(self._args.type, self._args.filter)
+        checks = self._checks(stream=True)
 
         # Process checks
         best = False
@@ -111,14 +247,14 @@ class IcingaChecker(Icinga):
 
     def redundancy(self):
         # Get checks
-        checks = self.getCheckResults(self._args.type, self._args.filter)
+        checks = self._checks()
 
         # 0-1 results is bad
         check_count = len(checks)
         if check_count < 2:
             plugin.setMessage(f"Expected more than one check but only found {check_count}\nUnable to determine redundnacy state.\n", plugin.STATE_UNKNOWN, True, True)
             logger.warning(f"Expected more than one check but found: {checks}")
-            plugin.exit()
+            return
         
         # Process checks
         is_degraded = 0
@@ -175,98 +311,25 @@ class IcingaChecker(Icinga):
         # | UNKNOWN |       |       |              |
         # | INVALID |       |       |              |
         # | TOTAL   |       |       |              |
-        metrics = { 
-            "ok": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "warning": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "critical": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "unknown": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "invalid": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "overdue": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            },
-            "total": {
-                "total": 0,
-                "acknowledged_total": 0,
-                "acknowledged_sticky": 0
-            }
-        }
-        for check in checks:
-            try:
-                metrics['total']['total'] += 1
-                check_attrs = check.get('attrs', {})
-                last_check_result = check_attrs.get('last_check_result', {})
-                check_state = None
-                if last_check_result is not None:
-                    check_state = last_check_result.get('state', None)
-                check_ackd = check_attrs.get('acknowledgement', None)
-                check_last = check_attrs.get('last_check', None)
-                check_interval = check_attrs.get('check_interval', None)
-                
-
-                if check_state is not None and isinstance(int(check_state), int) and int(check_state) in range(0,3):
-                    metrics_label = plugin.getStateLabel(int(check_state)).lower()
-                else:
-                    metrics_label = 'invalid'
-
-                metrics[metrics_label]['total'] += 1
-                if check_ackd is not None and isinstance(int(check_ackd), int):
-                    if int(check_ackd) >= 1:
-                        metrics['total']['acknowledged_total'] += 1
-                        metrics[metrics_label]['acknowledged_total'] += 1
-                    elif int(check_ackd) == 2:
-                        metrics['total']['acknowledged_sticky'] += 1
-                        metrics[metrics_label]['acknowledged_sticky'] += 1
-
-            except Exception as e:
-                metrics['invalid']['total'] += 1
-                logger.warning(f"Error {e} for metrics on check\n{check}")
-
-            try: 
-                # Overdue metrics
-                if check_last == '-1' or (isinstance(check_last, (int,float)) and isinstance(check_interval, (int,float)) and ((check_last + check_interval + self._args.buffer) < datetime.now().timestamp())):
-                    metrics['overdue']['total'] += 1
-                    if check_ackd is not None and isinstance(int(check_ackd), int):
-                        if int(check_ackd) >= 1:
-                            metrics['overdue']['acknowledged_total'] += 1
-                        elif int(check_ackd) == 2:
-                            metrics['overdue']['acknowledged_sticky'] += 1
-            except Exception as e:
-                logger.warning(f"Error {e} for overdue metrics on check\n{check}")
-        return metrics
+        return checkMetrics(checks, float(self._args.buffer))
 
     def statusmetrics(self):
-        # Get checks
-        checks = self.getCheckResults(self._args.type, self._args.filter)
-        logger.debug(checks)
+        # Counted by IcingaDB, which only returns the checks that are listed
+        filter_state = int(self._args.filter_check_state) if self._args.filter_check_state != '' else None
+        result = self._icingadb(lambda db: (db.statusMetrics(self._args.type, self._args.filter, float(self._args.buffer)),
+                                            db.checkResults(self._args.type, self._args.filter, filter_state)))
+        if result is not None:
+            metrics, checks = result
+        else:
+            # Get checks
+            checks = self._checks()
+            logger.opt(lazy=True).debug("{}", lambda: checks)
+            metrics = self._getCheckMetrics(checks) if checks else None
 
-        if not checks: # none match
+        if not metrics or not metrics['total']['total']: # none match
             plugin.setMessage(f"No checks match type '{self._args.type}' and filter '{self._args.filter}'\n", plugin.STATE_CRITICAL, True)
             return
 
-        # Get the metrics
-        metrics = self._getCheckMetrics(checks)
         logger.debug(metrics)
 
         metric_states = ['ok', 'warning', 'critical', 'unknown']
@@ -276,7 +339,7 @@ class IcingaChecker(Icinga):
         try:
             for check in checks:
                 check_attrs = check.get('attrs', {})
-                check_state = check_attrs.get('last_check_result', {}).get('state', None)
+                check_state = (check_attrs.get('last_check_result') or {}).get('state', None)
                 if check_state is not None:
                     return_check_state = self._args.return_check_state
                     if not isinstance(return_check_state, bool):
@@ -299,21 +362,22 @@ class IcingaChecker(Icinga):
             plugin.setMessage(f"Found {metrics['invalid']['total']} invalid results\n", plugin.STATE_CRITICAL, True)
         
         for metric in metrics.keys():
-            plugin.setPerfdata(f"{metric}_total", metrics[metric]['total'])
-            plugin.setPerfdata(f"{metric}_ackd", metrics[metric]['acknowledged_total'])
-            plugin.setPerfdata(f"{metric}_ackd_sticky", metrics[metric]['acknowledged_sticky'])
+            plugin.setPerformanceData(label=f"{metric}_total", value=metrics[metric]['total'])
+            plugin.setPerformanceData(label=f"{metric}_ackd", value=metrics[metric]['acknowledged_total'])
+            plugin.setPerformanceData(label=f"{metric}_ackd_sticky", value=metrics[metric]['acknowledged_sticky'])
         
         plugin.setOk()        
 
     # Sum of performance data
     def sum(self):
         # Get checks
-        checks = self.getCheckResults(self._args.type, self._args.filter)
-        perfdata = {}
-
-        if not checks: # none match
-            plugin.setMessage(f"No checks match type '{self._args.type}' and filter '{self._args.filter}'\n", plugin.STATE_CRITICAL, True)
+        checks = self._checks(stream=True)
+        aggregates = [aggregate.strip() for aggregate in self._args.aggregates.split(',') if aggregate.strip()]
+        if set(aggregates) - set(AGGREGATES):
+            plugin.setMessage(f"Unknown aggregates {', '.join(sorted(set(aggregates) - set(AGGREGATES)))}, use {', '.join(AGGREGATES)}\n", plugin.STATE_UNKNOWN, True)
             return
+        perfdata = PerfdataAggregate(percentiles=bool({'p50', 'p95'} & set(aggregates)))
+        check_count = 0
 
         # work out warning and critical thresholds
         if self._args.warn:
@@ -327,8 +391,8 @@ class IcingaChecker(Icinga):
 
         # Process checks
         try:
-            perfdata['__TOTAL__'] = 0
             for check in checks:
+                check_count += 1
                 check_attrs = check.get('attrs', {})
                 check_state = check_attrs.get('last_check_result', {}).get('state', None)
                 if self._args.warn and check_state == plugin.STATE_WARNING:
@@ -337,51 +401,125 @@ class IcingaChecker(Icinga):
                     check_state = plugin.STATE_OK
                 if check_state is not None:
                     plugin.setMessage(f"{check.get('name', 'Unknown Host/Service')}:\n------\n{check['attrs']['last_check_result']['output']}\n-----\n\n", check_state, True)
-                    for performance_data in check['attrs']['last_check_result']['performance_data']:
-                        parts = performance_data.split(';')
-                        main = parts[0].split('=')
-                        if perfdata.get(main[0]):
-                            perfdata[main[0]] += int(main[1])
-                            if main[0] != '__TOTAL__': # don't double count nested totals
-                                perfdata['__TOTAL__'] += int(main[1])
-                        else:
-                            perfdata[main[0]] = int(main[1])
+                    try:
+                        values = parsePerfdata(check['attrs']['last_check_result']['performance_data'])
+                    except ValueError as e:
+                        plugin.setMessage(f"Unable to parse the perfdata of {check.get('name', 'Unknown Host/Service')}: {e}\n", plugin.STATE_CRITICAL, True)
+                        continue
+                    for value in values:
+                        if value.label != '__TOTAL__': # don't double count nested totals
+                            perfdata.add(value)
 
                 else:
                     logger.error(f"Error processing sum checks, state is missing from {check_attrs.get('host_name', 'Unknown Host (attr)')} {check_attrs.get('name', 'Unknown Service (attr)')} - ({check.get('name', 'Unknown Host/Service (name)')})")
         except Exception as e:
             plugin.setMessage(f"Error processing sum check for {check.get('name', 'Unknown Host/Service')}\n", plugin.STATE_CRITICAL, True)
             logger.error(f"Error processing sum checks: {e}")
-        if perfdata:
-            for performance_data in perfdata:
-                plugin.setPerformanceData(performance_data,perfdata[performance_data])
-                # do we need to alert on any perfdata #TODO handle range strings not just limits
-                if self._args.crit and critical_thresholds.get(performance_data,None) != None and perfdata[performance_data] >= critical_thresholds[performance_data]:
-                    plugin.setMessage(f"perf data {performance_data} {perfdata[performance_data]} >= {critical_thresholds[performance_data]}\n", plugin.STATE_CRITICAL, True)
-                elif self._args.warn and warning_thresholds.get(performance_data,None) != None and perfdata[performance_data] >= warning_thresholds[performance_data]:
-                    plugin.setMessage(f"perf data {performance_data} {perfdata[performance_data]} >= {warning_thresholds[performance_data]}\n", plugin.STATE_WARNING, True)
-                elif self._args.crit or self._args.warn:
-                    plugin.setMessage(f"perf data {performance_data} {perfdata[performance_data]} < {warning_thresholds.get(performance_data,critical_thresholds.get(performance_data,'[No Threshold]'))}\n", plugin.STATE_OK, True)
+
+        if not check_count: # none match
+            plugin.setMessage(f"No checks match type '{self._args.type}' and filter '{self._args.filter}'\n", plugin.STATE_CRITICAL, True)
+            return
+
+        # The sum of a label keeps the label's name, the other aggregates are label_<aggregate>, a count has no unit
+        results = {'__TOTAL__': 0}
+        units = {}
+        total_units = set()
+        for label in perfdata.labels():
+            stats = perfdata.stats(label)
+            if len(stats['uoms']) > 1:
+                plugin.message = f"Info: perf data {label} is skipped, it has values in different units ({', '.join(repr(uom) for uom in stats['uoms'])})\n"
+                logger.warning(f"Not aggregating perf data {label}, it has values in units {stats['uoms']}")
+                continue
+            results['__TOTAL__'] += stats['sum']
+            total_units.add(stats['uom'])
+            for aggregate in aggregates:
+                value = stats[aggregate]
+                name = label if aggregate == 'sum' else f"{label}_{aggregate}"
+                results[name] = round(value, 6) if isinstance(value, float) else value
+                units[name] = '' if aggregate == 'count' else stats['uom']
+        units['__TOTAL__'] = total_units.pop() if len(total_units) == 1 else ''
+
+        if isinstance(results['__TOTAL__'], float):
+            results['__TOTAL__'] = round(results['__TOTAL__'], 6)
+        for performance_data, value in results.items():
+            plugin.setPerformanceData(label=formatLabel(performance_data), value=value, unit_of_measurement=units[performance_data])
+            # do we need to alert on any perfdata, thresholds are a limit or a range string
+            if self._args.crit and critical_thresholds.get(performance_data,None) != None and self._thresholdAlert(value, critical_thresholds[performance_data]):
+                plugin.setMessage(f"perf data {performance_data} {value} {self._thresholdString(critical_thresholds[performance_data])}\n", plugin.STATE_CRITICAL, True)
+            elif self._args.warn and warning_thresholds.get(performance_data,None) != None and self._thresholdAlert(value, warning_thresholds[performance_data]):
+                plugin.setMessage(f"perf data {performance_data} {value} {self._thresholdString(warning_thresholds[performance_data])}\n", plugin.STATE_WARNING, True)
+            elif self._args.crit or self._args.warn:
+                plugin.setMessage(f"perf data {performance_data} {value} < {warning_thresholds.get(performance_data,critical_thresholds.get(performance_data,'[No Threshold]'))}\n", plugin.STATE_OK, True)
+
+    @staticmethod
+    def _thresholdAlert(value, threshold):
+        # A number is an upper limit, a string is a Nagios range
+        if isinstance(threshold, str):
+            return parseRange(threshold).alert(value)
+        return value >= threshold
+
+    @staticmethod
+    def _thresholdString(threshold):
+        if isinstance(threshold, str):
+            return f"outside {threshold}" if not threshold.startswith('@') else f"inside {threshold[1:]}"
+        return f">= {threshold}"
 
 
     def overdue(self):
-        checks = self.getCheckResults(self._args.type, self._args.filter)
-        logger.debug(checks)
+        now = datetime.now().timestamp()
+        buffer = float(self._args.buffer)
+        limit = self._args.limit
+        result = self._icingadb(lambda db: db.overdue(self._args.type, self._args.filter, buffer, limit, now))
+        if result is not None:
+            check_count, overdue = result
+        else:
+            check_count, overdue = self._overdueChecks(now, buffer, limit)
 
-        if not checks: # none match
+        if not check_count: # none match
             plugin.setMessage(f"No checks match type '{self._args.type}' and filter '{self._args.filter}'\nChecks are needed to determine if any are overdue", plugin.STATE_CRITICAL, True)
             return
+        
+        logger.debug(f"{overdue['total']} of {check_count} {self._args.type} overdue, zones {overdue['zones']}, endpoints {overdue['endpoints']}")
+        plugin.setPerformanceData(label='checks', value=check_count)
+        plugin.setPerformanceData(label='overdue', value=overdue['total'])
+        plugin.setPerformanceData(label='overdue_ackd', value=overdue['acknowledged_total'])
 
-        # Process checks
+        # Test metrics
+        if overdue['total'] == 0:
+            plugin.setMessage(f"No overdue {self._args.type} found.\n", plugin.STATE_OK, True)
+            plugin.setOk()
+        else: 
+            plugin.setMessage(f"{overdue['total']} overdue {self._args.type} found, {overdue['acknowledged_total']} have been acknowledged:\n", plugin.STATE_CRITICAL, True)
+            for label, counts in [('zone', overdue['zones']), ('endpoint', overdue['endpoints'])]:
+                ranked_counts = sorted(counts.items(), key=lambda k: (-k[1], k[0]))
+                shown = ranked_counts[:limit] if limit else ranked_counts
+                plugin.message = f"By {label}: {', '.join(f'{name} {count}' for name, count in shown)}{f' and {len(ranked_counts) - len(shown)} more' if len(shown) < len(ranked_counts) else ''}\n"
+            if len(overdue['objects']) < overdue['total']:
+                plugin.message = f"The {len(overdue['objects'])} most overdue:\n"
+            for seconds, name in sorted(overdue['objects'], reverse=True):
+                plugin.message = f"{name} is overdue {self._age_string(now - seconds if seconds != math.inf else -1)}\n"
+
+    def _overdueChecks(self, now, buffer, limit):
+        """Count the overdue checks from the API or state index
+
+        Returns:
+            tuple: (int, dict) checks and the overdue counts, see lib.icingadb.IcingaDB.overdue
+        """
+        checks = self._checks(stream=True)
+        check_count = 0
+
+        # Process checks, the counts are exact but only the most overdue objects are kept for the output
         overdue = {
             "total": 0,
             "acknowledged_total": 0,
-            "acknowledged_sticky": 0,
-            "objects": []
+            "zones": {},
+            "endpoints": {},
+            "objects": []   # heap of (seconds overdue, name), least overdue first
         }
     
         try:
             for check in checks:
+                check_count += 1
                 # Ref: https://icinga.com/docs/icinga-2/latest/doc/09-object-types/
                 check_attrs = check.get('attrs', {})
                 check_ackd = check_attrs.get('acknowledgement', None)
@@ -392,18 +530,24 @@ class IcingaChecker(Icinga):
                 # Overdue metrics builder
                 overdue_time = None
                 if isinstance(check_last, (int,float)) and isinstance(check_interval, (int,float)):
-                    overdue_time = float(check_last) + float(check_interval) + float(self._args.buffer)
+                    overdue_time = float(check_last) + float(check_interval) + buffer
 
                 # check_last == '-1' is never been checked
-                if overdue_time is None or overdue_time < datetime.now().timestamp():
-                    logger.debug(f"{check.get('name')} last checked {check_last} has overdue_time [{overdue_time}] < now [{datetime.now().timestamp()}]")
+                if overdue_time is None or overdue_time < now:
                     overdue['total'] += 1
-                    overdue['objects'].append({"name": check.get('name', 'Unknown Host/Service'), "last_check": check_last, "overdue_time": overdue_time})
-                    if check_ackd is not None and isinstance(int(check_ackd), int):
-                        if int(check_ackd) >= 1:
-                            overdue['acknowledged_total'] += 1
-                        elif int(check_ackd) == 2:
-                            overdue['acknowledged_sticky'] += 1
+                    if check_ackd is not None and int(check_ackd) >= 1:
+                        overdue['acknowledged_total'] += 1
+                    zone = check_attrs.get('zone') or 'none'
+                    overdue['zones'][zone] = overdue['zones'].get(zone, 0) + 1
+                    endpoint = self._checkEndpoint(check_attrs)
+                    overdue['endpoints'][endpoint] = overdue['endpoints'].get(endpoint, 0) + 1
+
+                    # Never checked ranks as the most overdue
+                    ranked = (now - overdue_time if overdue_time is not None else math.inf, check.get('name', 'Unknown Host/Service'))
+                    if not limit or len(overdue['objects']) < limit:
+                        heapq.heappush(overdue['objects'], ranked)
+                    elif ranked > overdue['objects'][0]:
+                        heapq.heapreplace(overdue['objects'], ranked)
         except Exception as e:
             plugin.setMessage(f"Error processing overdue check for {check.get('name', 'Unknown Host/Service')}\n", plugin.STATE_CRITICAL, True)
             logger.error(f"Error processing redundancy checks: {e}")
@@ -414,29 +558,27 @@ class IcingaChecker(Icinga):
             logger.debug(f"check_interval: {check_interval}")
             logger.debug(f"overdue time = {overdue_time}")
             plugin.exit()
-        
-        logger.debug(overdue)
 
-        # Test metrics
-        if overdue['total'] == 0:
-            plugin.setMessage(f"No overdue {self._args.type} found.\n", plugin.STATE_OK, True)
-            plugin.setOk()
-        else: 
-            plugin.setMessage(f"Overdue {self._args.type} found:\n", plugin.STATE_CRITICAL, True)
-            for object in sorted(overdue['objects'], key=lambda k: k['name'].lower()):
-                plugin.message = f"{object['name']} is overdue {self._age_string(object['overdue_time'])}\n"
+        return (check_count, overdue)
+
+    @staticmethod
+    def _checkEndpoint(check_attrs):
+        # The endpoint that last ran the check, or the one it is pinned to
+        last_check_result = check_attrs.get('last_check_result') or {}
+        return last_check_result.get('check_source') or check_attrs.get('command_endpoint') or 'unknown'
 
     def summary(self):
-        checks = self.getCheckResults(self._args.type, self._args.filter)
-        logger.debug(checks)
+        found = self._icingadb(lambda db: db.names(self._args.type, self._args.filter))
+        if found is None:
+            checks = self._checks(stream=True)
 
-        found = []        
-        try:
-            for check in checks:
-                found.append(check.get('attrs', {}).get('name', 'No name found'))
+            found = []
+            try:
+                for check in checks:
+                    found.append(check.get('attrs', {}).get('name', 'No name found'))
 
-        except Exception as e:
-            logger.error(f"Error in loop for {self._args.type}: {e}")
+            except Exception as e:
+                logger.error(f"Error in loop for {self._args.type}: {e}")
 
         if len(found) > self._args.min and len(found) < self._args.max:
             plugin.setMessage(f"Found {len(found)} {self._args.type} which is more than min ({self._args.min}) and less than max ({self._args.max})\n", plugin.STATE_OK, True)
@@ -450,6 +592,126 @@ class IcingaChecker(Icinga):
         plugin.setOk()
 
 
+    def _loadGroups(self, group_file):
+        """Read and validate the group file
+
+        Args:
+            group_file (str): JSON file of a list of groups, or {"groups": [...]}
+
+        Returns:
+            tuple: (list, list) valid groups and error messages for the invalid ones
+        """
+        with open(group_file, 'r') as fh:
+            groups = json.load(fh)
+        if isinstance(groups, dict):
+            groups = groups.get('groups', [])
+        valid = []
+        errors = []
+        for index, group in enumerate(groups):
+            name = group.get('name', f"group {index}") if isinstance(group, dict) else f"group {index}"
+            if not isinstance(group, dict):
+                errors.append(f"{name} is not a JSON object")
+            elif group.get('mode') not in GROUP_MODES:
+                errors.append(f"{name} mode '{group.get('mode')}' is not one of {', '.join(GROUP_MODES)}")
+            elif not group.get('filter') or not group.get('host'):
+                errors.append(f"{name} needs a filter and the host (and service) to submit the result to")
+            else:
+                group['name'] = name
+                valid.append(group)
+        return (valid, errors)
+
+    def _groupArgs(self, group):
+        group_args = copy.copy(self._args)
+        group_args.mode = group['mode']
+        group_args.filter = group['filter']
+        for arg, default in GROUP_MODES[group['mode']].items():
+            value = group.get(arg, default)
+            # sum takes its thresholds as JSON strings
+            if arg in ['warn', 'crit'] and isinstance(value, dict):
+                value = json.dumps(value)
+            setattr(group_args, arg, value)
+        return group_args
+
+    def _evaluateGroup(self, group, checks):
+        """Run a group's mode against its checks with a plugin of its own
+
+        Returns:
+            tuple: (int, str, list) state, message and perfdata of the group
+        """
+        global plugin
+        meta_plugin = plugin
+        args = self._args
+        plugin = MonitoringPlugin(group['mode'])
+        self._args = self._groupArgs(group)
+        self._groupChecks = checks
+        try:
+            getattr(self, group['mode'])()
+            return plugin.exit(do_exit = False)
+        finally:
+            plugin = meta_plugin
+            self._args = args
+            self._groupChecks = None
+
+    def groups(self):
+        groups, errors = self._loadGroups(self._args.groups)
+        for error in errors:
+            plugin.setMessage(f"Invalid group: {error}\n", plugin.STATE_WARNING, True)
+
+        # Groups with filters that can be compiled are split from one fetch, the rest are fetched on their own
+        attrs = set()
+        joins = set()
+        shared = []
+        for group in groups:
+            attrs.update(MODE_ATTRS[group['mode']])
+            try:
+                group['predicate'] = compileFilter(group['filter'], self._args.type)
+                attrs.update(group['predicate'].attrs)
+                joins.update(group['predicate'].joins)
+                shared.append(group)
+            except FilterNotSupported as e:
+                group['predicate'] = None
+                logger.info(f"Group {group['name']} is fetched on its own, its filter can't be compiled: {e}")
+        if self._args.type != 'services':
+            attrs.difference_update(SERVICE_ONLY_ATTRS)
+        attrs = sorted(attrs)
+        joins = sorted(joins) or None
+
+        fetches = 0
+        checks = []
+        if shared:
+            fetch_filter = self._args.fetch_filter or ' || '.join(f"({group['filter']})" for group in shared)
+            checks = self._fetch(fetch_filter, attrs, joins)
+            fetches += 1
+        for group, group_checks in zip(shared, partition(checks, [group['predicate'] for group in shared])):
+            group['checks'] = group_checks
+
+        passive_results = []
+        states = {}
+        for group in groups:
+            try:
+                if group['predicate'] is None:
+                    group['checks'] = self._fetch(group['filter'], attrs, joins)
+                    fetches += 1
+                state, message, performance_data = self._evaluateGroup(group, group['checks'])
+            except Exception as e:
+                logger.error(f"Error evaluating group {group['name']}: {e}")
+                state, message, performance_data = (plugin.STATE_UNKNOWN, f"Error evaluating group {group['name']}: {e}\n", None)
+            states[group['name']] = state
+            passive_results.append((group['host'], group.get('service'), state, message, performance_data))
+
+        # Submit the group results together
+        submitted = self.processCheckResults(passive_results, workers=self._args.submit_workers)
+        plugin.message = f"Evaluated {len(groups)} groups from {len(checks)} checks with {fetches} API requests, submitted in {submitted['seconds']:.2f}s\n"
+        for result, group in zip(submitted['results'], groups):
+            if result['success']:
+                plugin.message = f"{group['name']}: {plugin.getStateLabel(states[group['name']])}\n"
+            else:
+                plugin.setMessage(f"{group['name']}: submitting the result to {result['host']} {result['service'] or ''} failed, {result['status']}\n", plugin.STATE_CRITICAL, True)
+        plugin.setPerformanceData(label="groups", value=len(groups))
+        plugin.setPerformanceData(label="checks", value=len(checks))
+        plugin.setPerformanceData(label="fetches", value=fetches)
+        plugin.setPerformanceData(label="submit_failed", value=submitted['failed'])
+
     def _age_string(self, epoch_val):
         if str(epoch_val) == "-1":
             return "never"
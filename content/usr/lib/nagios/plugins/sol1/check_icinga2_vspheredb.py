@@ -2,6 +2,9 @@
 
 import subprocess
 import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from lib.icinga import Icinga
 from sol1_monitoring_plugins_lib import MonitoringPlugin, initLogging, initLoggingArgparse
@@ -28,6 +31,17 @@ class InitArgs:
     # Passive Hosts
     parserStatus = subparser.add_parser("passivehosts", help="Find all services matching the filter and return passive results from vsphere for their hosts to each service")
     parserStatus.add_argument('--filter', type=str, help='Filter for checks to process', required=True)
+    parserStatus.add_argument('--submit-workers', type=int, help='Number of passive results to submit to the Icinga API at once', default=10)
+    parserStatus.add_argument('--source', type=str, choices=['icingacli', 'db'], help='Get VM health from icingacli vspheredb check vm per VM, or only the overall status and power state of every VM from one query of the vspheredb database', default='icingacli')
+    parserStatus.add_argument('--workers', type=int, help='Number of icingacli checks to run at once', default=10)
+    parserStatus.add_argument('--vm-timeout', type=float, help='Seconds an icingacli check for a single VM can take', default=20)
+    parserStatus.add_argument('--deadline', type=float, help='Seconds all of the VMs can take, VMs not checked by then fail', default=50)
+    parserStatus.add_argument('--db-type', type=str, choices=['mysql', 'sqlite'], help='vspheredb database type, sqlite is for testing', default='mysql')
+    parserStatus.add_argument('--db-host', type=str, help='vspheredb database host', default='localhost')
+    parserStatus.add_argument('--db-port', type=int, help='vspheredb database port', default=3306)
+    parserStatus.add_argument('--db-name', type=str, help='vspheredb database name, or the file for sqlite', default='vspheredb')
+    parserStatus.add_argument('--db-user', type=str, help='vspheredb database username', default='vspheredb')
+    parserStatus.add_argument('--db-password', type=str, help='vspheredb database password', default='')
 
     @classmethod
     def parse_args(cls, _args = None):
@@ -46,34 +60,58 @@ class IcingaChecker(Icinga):
     
     def passivehosts(self):
         # Get checks
-        checks = self.getCheckResults('services', self._args.filter)
+        checks = self.getCheckResults('services', self._args.filter, ['__name', 'name', 'host_name'])
         if not checks:
             plugin.setMessage(f"No services found matching filter: {self._args.filter}", plugin.STATE_WARNING, True)
             plugin.exit()
 
         try:
-            icingacli = IcingaCli()
+            if self._args.source == 'db':
+                vspheredb = VSphereDB(self._args)
+            else:
+                vspheredb = IcingaCli(self._args.vm_timeout)
             hosts_worked = []
             hosts_failed = []
+            passive_results = []
+            services = []
             for check in checks:
                 host_name = check.get('attrs', {}).get('host_name', "")
                 service_name = check.get('attrs', {}).get('name', "")
                 if host_name and service_name:
-                    try:
-                        result, result_success = icingacli.vSphereDBVM(host_name)
-                        state, message, performance_data = result.exit(do_exit = False)
-                        if result_success:
-                            logger.debug(f"host={host_name}, service={service_name}, status={state}, message={message}, perfdata={performance_data}")
-                            self.processServiceCheckResult(host=host_name, service=service_name, status=state, message=message, perfdata=performance_data)
-                            hosts_worked.append(host_name)
-                        else:
-                            hosts_failed.append(host_name)
-                    except Exception as e:
-                        hosts_failed.append(host_name)
+                    services.append((host_name, service_name))
                 else:
                     plugin.setMessage(f"Unable to determine host and service name for {check.get('attrs', {}).get('__name', 'Unknown')}\n")
                     logger.warning(f"Unable to determine host and service name for {check}")
+
+            # Get the health of every VM at once
+            vm_results = vspheredb.vSphereDBVMs([host_name for host_name, _ in services], workers=self._args.workers, deadline=self._args.deadline)
+            for host_name, service_name in services:
+                try:
+                    result, result_success = vm_results[host_name]
+                    if result_success:
+                        state, message, performance_data = result.exit(do_exit = False)
+                        logger.debug(f"host={host_name}, service={service_name}, status={state}, message={message}, perfdata={performance_data}")
+                        passive_results.append((host_name, service_name, state, message, performance_data))
+                    else:
+                        logger.warning(f"vSphereDB check failed for {host_name}: {result}")
+                        hosts_failed.append(host_name)
+                except Exception as e:
+                    logger.warning(f"vSphereDB check failed for {host_name}: {e}")
+                    hosts_failed.append(host_name)
+
+            # Submit the results together
+            submitted = self.processCheckResults(passive_results, workers=self._args.submit_workers)
+            for result in submitted['results']:
+                if result['success']:
+                    hosts_worked.append(result['host'])
+                else:
+                    hosts_failed.append(result['host'])
+            plugin.setPerformanceData(label="submitted", value=submitted['submitted'])
+            plugin.setPerformanceData(label="submit_failed", value=submitted['failed'])
+            plugin.setPerformanceData(label="submit_rate", value=round(submitted['rate'], 1))
+
             plugin.message = f"Passive updates for services on hosts matching filter {self._args.filter}\n"
+            plugin.message = f"Submitted {submitted['submitted']} results in {submitted['seconds']:.2f}s ({submitted['rate']:.1f}/s)\n"
             if hosts_worked:
                 plugin.setMessage(f"Successful: {', '.join(hosts_worked)}\n", plugin.STATE_OK, True)
             if hosts_failed:
@@ -84,17 +122,57 @@ class IcingaChecker(Icinga):
             plugin.exit()
 
 class IcingaCli:
-    def __init__(self):
-        pass
+    def __init__(self, timeout = None):
+        self.timeout = timeout
 
-    def vSphereDBVM(self, vm_name):
+    def vSphereDBVM(self, vm_name, timeout = None):
         command = ["icingacli", "vspheredb", "check", "vm", "--name", vm_name]
         try:
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
+            result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=timeout or self.timeout)
             logger.debug(result)
             return (self.parseOutput(result.stdout, "vSphereDB passive"), True)
         except subprocess.CalledProcessError as e:
             return (f"Command failed with error: {e}", False)
+        except subprocess.TimeoutExpired as e:
+            return (f"Command timed out after {e.timeout:.0f}s", False)
+
+    def vSphereDBVMs(self, vm_names, workers = 10, deadline = None):
+        """Check VMs with a pool of icingacli processes
+
+        Args:
+            vm_names (list): VM names
+            workers (int, optional): checks to run at once. Defaults to 10.
+            deadline (float, optional): seconds all of the checks can take, checks that haven't finished fail. Defaults to None.
+
+        Returns:
+            dict: VM name to (result plugin or error message, success)
+        """
+        vm_names = list(dict.fromkeys(vm_names))
+        end = time.monotonic() + deadline if deadline else None
+
+        def check(vm_name):
+            # No VM check runs past the deadline
+            timeout = self.timeout
+            if end is not None:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return (f"Deadline of {deadline}s reached before the check started", False)
+                timeout = min(timeout, remaining) if timeout else remaining
+            return self.vSphereDBVM(vm_name, timeout)
+
+        results = {}
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        futures = {executor.submit(check, vm_name): vm_name for vm_name in vm_names}
+        done, not_done = wait(futures, timeout=end - time.monotonic() if end is not None else None)
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future, vm_name in futures.items():
+            if future in done:
+                results[vm_name] = future.result()
+            else:
+                results[vm_name] = (f"Deadline of {deadline}s reached", False)
+        logger.info(f"Checked {len(vm_names)} VMs with {workers} icingacli workers in {time.monotonic() - start:.2f}s, {len(not_done)} past the deadline")
+        return results
 
     def parseOutput(self, output, type = ""):
         _plugin = MonitoringPlugin(type)
@@ -109,6 +187,85 @@ class IcingaCli:
             _plugin.message = f"{line}\n"                     
         return _plugin
 
+class VSphereDB(IcingaCli):
+    """VM health for every VM from one query of the vspheredb database instead of an icingacli process per VM.
+    Only the overall status and power state of the VM are checked, none of the other checks icingacli vspheredb check vm
+    runs, so a VM can be OK here and not with icingacli. benchmark_vspheredb.py compares the two.
+    """
+    # overall_status is the vCenter health of the object
+    OVERALL_STATES = {'green': 'OK', 'yellow': 'WARNING', 'red': 'CRITICAL', 'gray': 'UNKNOWN'}
+    QUERY = """
+        SELECT o.object_name, o.overall_status, vm.runtime_power_state
+          FROM object o
+          JOIN virtual_machine vm ON vm.uuid = o.uuid
+         WHERE o.object_type = 'VirtualMachine'
+    """
+
+    def __init__(self, _args):
+        self._args = _args
+
+    def connect(self):
+        if self._args.db_type == 'sqlite':
+            import sqlite3
+            return sqlite3.connect(self._args.db_name)
+        import pymysql
+        return pymysql.connect(host=self._args.db_host, port=self._args.db_port, user=self._args.db_user, password=self._args.db_password,
+                               database=self._args.db_name, connect_timeout=10, read_timeout=self._args.deadline)
+
+    def getVMs(self):
+        """Get the health of every VM
+
+        Returns:
+            dict: VM name to (overall status, power state)
+        """
+        db = self.connect()
+        try:
+            cursor = db.cursor()
+            cursor.execute(self.QUERY)
+            vms = {}
+            for name, overall_status, power_state in cursor.fetchall():
+                name = name.decode() if isinstance(name, bytes) else name
+                vms[name] = (overall_status, power_state)
+            return vms
+        finally:
+            db.close()
+
+    def evaluate(self, vm_name, overall_status, power_state):
+        lines = [f"[{self.OVERALL_STATES.get(overall_status, 'UNKNOWN')}] Overall status is {overall_status}"]
+        if power_state == 'poweredOn':
+            lines.append(f"[OK] Power state is {power_state}")
+        else:
+            lines.append(f"[CRITICAL] Power state is {power_state}")
+        return self.parseOutput(f"Virtual Machine: {vm_name}\n" + "\n".join(lines), "vSphereDB passive")
+
+    def vSphereDBVM(self, vm_name, timeout = None):
+        return self.vSphereDBVMs([vm_name])[vm_name]
+
+    def vSphereDBVMs(self, vm_names, workers = None, deadline = None):
+        """Check VMs from one query of the vspheredb database, workers and deadline are ignored
+
+        Args:
+            vm_names (list): VM names
+
+        Returns:
+            dict: VM name to (result plugin or error message, success)
+        """
+        start = time.monotonic()
+        try:
+            vms = self.getVMs()
+        except Exception as e:
+            logger.error(f"Unable to read VMs from the vspheredb database: {e}")
+            return {vm_name: (f"Unable to read VMs from the vspheredb database: {e}", False) for vm_name in vm_names}
+
+        results = {}
+        for vm_name in vm_names:
+            if vm_name in vms:
+                results[vm_name] = (self.evaluate(vm_name, *vms[vm_name]), True)
+            else:
+                results[vm_name] = (f"VM {vm_name} not found in the vspheredb database", False)
+        logger.info(f"Checked {len(results)} of {len(vms)} VMs from the vspheredb database in {time.monotonic() - start:.2f}s")
+        return results
+
 if __name__ == "__main__":
     # Init args
     args = InitArgs().parse_args()
@@ -102,7 +102,7 @@ class Isilon:
     def _post(self, url, headers, payload):
         try:
             response = self.session.post(url, headers=headers, json=payload, verify=False)
-            logger.debug(f"response ({response.status_code}): {response.text}")
+            logger.opt(lazy=True).debug("response ({}): {}", lambda: response.status_code, lambda: response.text)
             return response
         except Exception as e:
             logger.error(f"Error posting to {url}: {e}")
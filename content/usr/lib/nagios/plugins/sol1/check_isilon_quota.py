@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import requests
-import argparse
+import sys
+import lib.jsonarg as argparse
 
 from lib.util import MonitoringPlugin, init_logging
 from loguru import logger
@@ -13,8 +14,10 @@ API_VERSION = '13'
 QUOTAS_URI = '/quota/quotas/'
 SESSION_URI = '/session/1/session'
 
-def get_args(argvals=None):
-    parser = argparse.ArgumentParser(description='Check Isilon Quota')
+def get_parser():
+    # The login is shared by every batch argument set, so the connection can't change between them
+    parser = argparse.ArgumentParser(description='Check Isilon Quota', batch=True,
+                                     batch_shared=['server', 'port', 'proto', 'proxy', 'username', 'password'])
     parser.add_argument('--server', type=str, help='Isilon server', required=True)
     parser.add_argument('--port', type=int, help='Isilon Server port', default=8080)
     parser.add_argument('--proto', type=str, help='Isilon Server protocol', default='https')
@@ -36,8 +39,10 @@ def get_args(argvals=None):
     parserQuota.add_argument('--warning', help="Greater than value for warning", default=None)
     parserQuota.add_argument('--critical', help="Greater than value for critical", default=None)
 
-    args = parser.parse_args(argvals)
-    return args
+    return parser
+
+def get_args(argvals=None):
+    return get_parser().parse_args(argvals)
 
 
 class Isilon:
@@ -93,7 +98,7 @@ class Isilon:
     def _post(self, url, headers, payload):
         try:
             response = self.session.post(url, headers=headers, json=payload, verify=False)
-            logger.debug(f"response ({response.status_code}): {response.text}")
+            logger.opt(lazy=True).debug("response ({}): {}", lambda: response.status_code, lambda: response.text)
             return response
         except Exception as e:
             logger.error(f"Error posting to {url}: {e}")
@@ -105,10 +110,10 @@ class Isilon:
         headers = {"Content-Type": "application/json"}
         payload = {"username": self._username, "password": self._password, "services": ["platform"]}
         response = self._post(auth_endpoint, headers=headers, payload=payload)
-        logger.debug(response.cookies)
         if response is None:
             logger.error(f"Request failed to get a response")
         elif response.status_code in [200, 201]:
+            logger.debug(response.cookies)
             self._sessionid = response.cookies.get('isisessid')
             self._csrf = response.cookies.get('isicsrf')
             logger.debug(f"SessionID is: {self._sessionid}")
@@ -182,21 +187,37 @@ class Isilon:
             plugin.setMessage("Failed to get any information from the Isilon\n", plugin.STATE_CRITICAL, True)
 
 
-args = get_args()
+def run_check(_args):
+    global plugin
+    # MonitoringPlugin initalizes with STATE_UNKNOWN
+    plugin = MonitoringPlugin(logger, f"Isilon {_args.mode}")
+
+    # The login is shared, only the quota and thresholds change between batch argument sets
+    isilon._quotaID = _args.quotaID
+    isilon.warning = _args.warning
+    isilon.critical = _args.critical
+    logger.debug("Running check for {}".format(_args.mode))
+    try:
+        eval(f'isilon.{_args.mode}()')
+    except Exception as e:
+        plugin.setMessage("Unable to evaluate arguments\n", plugin.STATE_CRITICAL, True)
+        logger.error(f"Unable to evaluate arguments with error {e}")
+
+    plugin.exit()
+
+
+parser = get_parser()
+args = parser.parse_args()
 logfile = "/var/log/icinga2/check_isilon_quota.log"
 init_logging(debug=args.debug, enableScreenDebug=args.enable_screen_debug, logFile=logfile, logRotate=args.log_rotate, logRetention=args.log_retention)
 logger.info(f"Isilon check called with: {args}")
 
-# MonitoringPlugin initalizes with STATE_UNKNOWN
-plugin = MonitoringPlugin(logger, f"Isilon {args.mode}")
-
 isilon = Isilon(server=args.server, port=args.port, proto=args.proto, proxy=args.proxy, username=args.username, password=args.password, quotaID=args.quotaID, warning=args.warning, critical=args.critical)
 logger.debug(isilon)
-logger.debug("Running check for {}".format(args.mode))
-try:
-    eval(f'isilon.{args.mode}()')
-except Exception as e:
-    plugin.setMessage("Unable to evaluate arguments\n", plugin.STATE_CRITICAL, True)
-    logger.error(f"Unable to evaluate arguments with error {e}")
-
-plugin.exit()
\ No newline at end of file
+
+if args.batch:
+    # One login for every quota read from stdin, one JSON result per line
+    argparse.run_batch(parser, args, run_check)
+    sys.exit(0)
+
+run_check(args)
\ No newline at end of file
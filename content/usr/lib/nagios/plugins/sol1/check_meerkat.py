@@ -2,13 +2,13 @@
 
 import humanize
 import json
-import requests
 
 from argparse import ArgumentParser
 from datetime import datetime, timedelta
 from loguru import logger
 
 from lib.util import init_logging, MonitoringPlugin
+from lib.httpclient import HttpClient
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -41,6 +41,7 @@ class Meerkat:
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
+        self._client = HttpClient(headers=self._headers)
     
     def get(self, url, decode_json = False):
         return self.__request('GET', url, decode_json)
@@ -52,9 +53,9 @@ class Meerkat:
         try:
             logger.debug(f"Request to {url} using {reqtype}\n")
             if reqtype == 'GET':
-                response = requests.get(url=url, headers=self._headers, verify=False)
+                response = self._client.get(url)
             elif reqtype == 'POST':
-                response = requests.post(url=url, headers=self._headers, json=payload, verify=False)
+                response = self._client.post(url, json=payload)
             else:
                 logger.error(f"Meerkat request not GET or POST, this shouldn't happen.")
             logger.debug(f"Meerkat {reqtype} response {response}")
@@ -8,7 +8,7 @@ import requests_cache
 
 
 from sol1_monitoring_plugins_lib import MonitoringPlugin, initLogging, initLoggingArgparse
-from lib.util import initRequestsCache
+from lib.util import addTimingArgs, initRequestsCache, initTiming, requestsCacheFile
 from datetime import datetime
 from loguru import logger
 
@@ -22,6 +22,7 @@ def get_args(argvals=None):
     parser.add_argument('--timeout', type=int, help='Http request timeout', default=15)
     
     initLoggingArgparse(parser, log_file='/var/log/icinga2/check_prismon.log')
+    addTimingArgs(parser)
 
     # Connection type
     subparser = parser.add_subparsers(title='Mode', dest='mode', help='Help for mode', required=True)
@@ -80,19 +81,21 @@ class Prismon:
             s = "&"
         return self.__request('get', "{url}{seperator}username={user}&token={token}".format(url=url, seperator=s, user=self.__username, token=self.__token), None, parseresult)
 
-    def __request(self, reqtype, url, payload = None, parseresult: bool = True, retry: bool = False):
+    def __request(self, reqtype, url, payload = None, parseresult: bool = True, retry: bool = False, phase = 'fetch'):
         try:
             logger.debug("Request to {url} using {type}\n".format(url=url, type=reqtype.upper()))
             if reqtype == 'get':
-                if retry:
-                    with requests_cache.disabled():           
+                with timer.phase(phase):
+                    if retry:
+                        with requests_cache.disabled():           
+                            response = self.__session.get(url=url, headers=self.__headers, verify=False, timeout=self.timeout)
+                    else:
                         response = self.__session.get(url=url, headers=self.__headers, verify=False, timeout=self.timeout)
-                else:
-                    response = self.__session.get(url=url, headers=self.__headers, verify=False, timeout=self.timeout)
                 plugin.message = "Result from cache: {cache}\n".format(cache=response.from_cache)
             elif reqtype == 'post':
-                response = self.__session.post(url=url, headers=self.__headers, data=payload, verify=False, timeout=self.timeout)
-                logger.debug("Result from {url} using headers {headers} is {result}\n".format(url=url, headers=self.__headers, result=response))
+                with timer.phase(phase):
+                    response = self.__session.post(url=url, headers=self.__headers, data=payload, verify=False, timeout=self.timeout)
+                logger.debug("Result from {} using headers {} is {}\n", url, self.__headers, response)
             else:
                 plugin.message = "This shouldn't happen, code gone bad\n"
                 plugin.exit(plugin.STATE_CRITICAL)
@@ -108,7 +111,7 @@ class Prismon:
         # if the request fails as unauthorised the retry once after a non cached login
         if response.status_code in [401] and not retry:
             self.__getAccessToken(True)
-            self.__request(reqtype, url, payload, parseresult, True)
+            self.__request(reqtype, url, payload, parseresult, True, phase)
             logger.debug("Auth error, retrying request to {url}".format(url=url))
 
         else:
@@ -117,10 +120,11 @@ class Prismon:
                 plugin.exit(plugin.STATE_CRITICAL)
 
             try:
-                if parseresult:
-                    result = response.json()
-                else:
-                    result = response.text
+                with timer.phase('parse'):
+                    if parseresult:
+                        result = response.json()
+                    else:
+                        result = response.text
             except Exception as e:
                 plugin.message = "Unable to parse json data from request {}\n Response text: \n{}".format(url, response.text)
                 logger.error("Parse error for {url}: {error}".format(url=url, error=e))
@@ -194,7 +198,7 @@ class Prismon:
                 logger.info(f"Getting access token using api call to {url}")
                 request_time = datetime.now().timestamp()
                 try:
-                    results = self.post(url, payload, True)
+                    results = self.__request('post', url, payload, True, phase='auth')
                 except Exception as e:
                     logger.error(f"Token request failed with: {e}")
                     plugin.message(f"Auth error accessing Prismon2: token\nSee {os.getpid()} in logs for more details\n")
@@ -248,15 +252,18 @@ logger.info("Processing Prismon check with args [{}]".format(args))
 
 # Init plugin
 plugin = MonitoringPlugin(args.mode)
+timer = initTiming(args, f"check_prismon {args.mode}", plugin)
 
-_requests_cache = initRequestsCache(cache_file=f'/tmp/prismon_{args.server}.cache',expire_after=10)
+_requests_cache = initRequestsCache(cache_file=requestsCacheFile('prismon', args.server), expire_after=10)
 if _requests_cache[0]:
     logger.debug(_requests_cache[1])
 else:
     logger.error(_requests_cache[1])
 
 # Run and exit
-prismon = Prismon(args.server, args.username, args.password, args)
+with timer.phase('auth'):
+    prismon = Prismon(args.server, args.username, args.password, args)
 logger.debug("Running check for {}".format(args.mode))
-eval('prismon.{}()'.format(args.mode))
+with timer.phase('evaluate'):
+    eval('prismon.{}()'.format(args.mode))
 plugin.exit()
\ No newline at end of file
@@ -25,9 +25,13 @@
 
 """Proxmox VE monitoring check command for various monitoring systems like Icinga and others."""
 
+import copy
+import json
 import re
 import sys
-from typing import Callable, Dict, Optional, Union, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Union, List, Tuple
 
 try:
     import argparse
@@ -38,6 +42,15 @@ try:
     from packaging import version
     from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+    from loguru import logger
+
+    from lib import jsonarg
+    from lib.httpclient import HttpClient
+    from lib.snapshot import DEFAULT_TTL as RESOURCES_TTL, ResourceSnapshot, findResource
+    from lib.taskstore import TaskStore
+    from lib.ticketcache import TicketCache, ticketFile
+    from lib.util import PhaseTimer, addTimingArgs, initTiming
+
 except ImportError as e:
     print(f"Missing python module: {str(e)}")
     sys.exit(255)
@@ -45,6 +58,41 @@ except ImportError as e:
 # Timeout for API requests in seconds
 CHECK_API_TIMEOUT = 30
 
+# Tasks asked for per request when paging through a node's task list
+TASKS_PAGE_SIZE = 500
+
+# Per guest settings for vm-fleet, from the overrides file or tags
+VM_OVERRIDE_KEYS = (
+    "skip",
+    "expected_vm_status",
+    "node",
+    "ignore_vm_status",
+    "only_status",
+    "warning",
+    "critical",
+    "host",
+    "service",
+)
+VM_STATES = ("running", "stopped", "paused")
+
+# Modes of one node that --mode nodes can run on every node of the cluster
+NODE_MODES = (
+    "cpu",
+    "memory",
+    "swap",
+    "io_wait",
+    "services",
+    "updates",
+    "disk-health",
+    "replication",
+    "zfs-health",
+    "zfs-fragmentation",
+)
+DEFAULT_NODE_MODES = [mode for mode in NODE_MODES if mode != "swap"]
+
+# Everything is reported in the check output, don't let lib/ log to stderr
+logger.remove()
+
 
 def compare_thresholds(
     threshold_warning: Dict, threshold_critical: Dict, comparator: Callable
@@ -136,6 +184,16 @@ class RequestError(Exception):
         super().__init__(self.message)
 
 
+class CheckExit(Exception):
+    """Raised instead of printing and exiting by a check run inside another one."""
+
+    def __init__(self, rc: "CheckState", message: str) -> None:
+        self.rc = rc
+        self.message = message
+
+        super().__init__(self.message)
+
+
 class CheckPVE:
     """Check command for Proxmox VE."""
 
@@ -154,14 +212,19 @@ class CheckPVE:
     def check_output(self) -> None:
         """Print check command output with perfdata and return code."""
         message = self.check_message
+        if self.timer.enablePerfdata:
+            self.perfdata.extend(f"{label}={value}s" for label, value in self.timer.perfdata())
+
         if self.perfdata:
             message += self.get_perfdata()
 
         self.output(self.check_result, message)
 
-    @staticmethod
-    def output(rc: CheckState, message: str) -> None:
+    def output(self, rc: CheckState, message: str) -> None:
         """Print message to stdout and exit with given return code."""
+        if self.raise_output:
+            raise CheckExit(rc, message)
+
         prefix = rc.name
         print(f"{prefix} - {message}")
         sys.exit(rc.value)
@@ -173,25 +236,31 @@ class CheckPVE:
         )
 
     def request(self, url: str, method: str = "get", **kwargs: Dict) -> Union[Dict, None]:
-        """Execute request against Proxmox VE API and return json data."""
+        """Execute request against Proxmox VE API and return json data, the request is timed as phase (default fetch)."""
+        if method == "get" and self.request_memo is not None and kwargs.get("memo", True):
+            return self.memo_request(url, **kwargs)
+
         response = None
+        phase = kwargs.get("phase", "fetch")
         try:
             if method == "post":
-                response = requests.post(
-                    url,
-                    verify=not self.options.api_insecure,
-                    data=kwargs.get("data", None),
-                    timeout=5,
-                )
+                with self.timer.phase(phase):
+                    response = self.http.post(
+                        url,
+                        verify=not self.options.api_insecure,
+                        data=kwargs.get("data", None),
+                        timeout=5,
+                    )
             elif method == "get":
-                response = requests.get(
-                    url,
-                    verify=not self.options.api_insecure,
-                    cookies=self.__cookies,
-                    headers=self.__headers,
-                    params=kwargs.get("params", None),
-                    timeout=CHECK_API_TIMEOUT,
-                )
+                with self.timer.phase(phase):
+                    response = self.http.get(
+                        url,
+                        verify=not self.options.api_insecure,
+                        cookies=self.__cookies,
+                        headers=self.__headers,
+                        params=kwargs.get("params", None),
+                        timeout=CHECK_API_TIMEOUT,
+                    )
             else:
                 self.output(CheckState.CRITICAL, f"Unsupport request method: {method}")
         except requests.exceptions.ConnectTimeout:
@@ -206,7 +275,20 @@ class CheckPVE:
             )
 
         if response.ok:
-            return response.json()["data"]
+            with self.timer.phase("parse"):
+                return response.json()["data"]
+
+        if (
+            response.status_code == 401
+            and method == "get"
+            and self.ticket_cache is not None
+            and not kwargs.get("relogin", False)
+        ):
+            # The shared ticket was revoked or has expired early, log in again and retry once
+            self.ticket_cache.invalidate(self.__cookies["PVEAuthCookie"])
+            with self.timer.phase("auth"):
+                self.__cookies["PVEAuthCookie"] = self.get_ticket()
+            return self.request(url, method, relogin=True, **kwargs)
 
         message = "Could not fetch data from API: "
         if response.status_code == 401:
@@ -224,11 +306,46 @@ class CheckPVE:
 
         self.output(CheckState.UNKNOWN, message)
 
-    def get_ticket(self) -> str:
-        """Perform login and fetch ticket for further API calls."""
+    def memo_request(self, url: str, **kwargs: Dict) -> Union[Dict, None]:
+        """GET url once for every check sharing the memo, e.g. the cpu, memory and io_wait checks of a node."""
+        memo, lock = self.request_memo
+        key = (url, json.dumps(kwargs.get("params", None), sort_keys=True))
+        with lock:
+            entry = memo.setdefault(key, {"lock": threading.Lock()})
+
+        # Checks of the same url wait for the first one's response instead of sending their own,
+        # a failed request fails them all rather than each one waiting for its own timeout
+        with entry["lock"]:
+            if "data" not in entry and "error" not in entry:
+                try:
+                    entry["data"] = self.request(url, memo=False, **kwargs)
+                except CheckExit as e:
+                    entry["error"] = (e.rc, e.message)
+            if "error" in entry:
+                raise CheckExit(*entry["error"])
+            return entry["data"]
+
+    def login(self, ticket: Optional[str] = None) -> Dict:
+        """Perform login, or renew a still valid ticket, and return the ticket data."""
         url = self.get_url("access/ticket")
+        if ticket is not None:
+            # A valid ticket is accepted as the password, this skips the realm's password check
+            data = {"username": self.options.api_user, "password": ticket}
+            try:
+                return self.request(url, "post", data=data, raise_error=True, phase="auth")
+            except RequestError:
+                pass
+
         data = {"username": self.options.api_user, "password": self.options.api_password}
-        result = self.request(url, "post", data=data)
+        return self.request(url, "post", data=data, phase="auth")
+
+    def get_ticket(self) -> str:
+        """Perform login and fetch ticket for further API calls."""
+        if self.ticket_cache is None:
+            result = self.login()
+        else:
+            result = self.ticket_cache.get(self.login)
+        self.csrf_token = result.get("CSRFPreventionToken")
 
         return result["ticket"]
 
@@ -262,78 +379,231 @@ class CheckPVE:
 
         self.check_thresholds(value, message)
 
-    def check_vm_status(self, idx: Union[str, int], **kwargs: str) -> None:
-        """Check status of virtual machine by vmid or name."""
+    def cluster_key(self) -> str:
+        """Key for what is cached about the cluster, per endpoint and user."""
+        # The view of the cluster depends on the user's permissions, never share it between users
+        user = self.options.api_user
+        if self.options.api_token is not None:
+            user += "!" + self.options.api_token.split("=", 1)[0]
+
+        return f"{self.options.api_endpoint}:{self.options.api_port}:{user}"
+
+    def get_cluster_vm(self, idx: Union[str, int]) -> Optional[Dict]:
+        """Find a virtual machine or container in the cluster resources by vmid or name."""
         url = self.get_url(
             "cluster/resources",
         )
-        data = self.request(url, params={"type": "vm"})
 
-        expected_state = kwargs.get("expected_state", "running")
-        only_status = kwargs.get("only_status", False)
+        def fetch() -> List[Dict]:
+            return self.request(url, params={"type": "vm"})
 
-        found = False
-        for vm in data:
-            if idx in (vm.get("name", None), vm.get("vmid", None)):
-                # Check if VM (default) or LXC
-                vm_type = "VM"
-                if vm["type"] == "lxc":
-                    vm_type = "LXC"
+        if not self.options.resources_ttl:
+            return findResource(fetch(), idx)
 
-                if vm["status"] != expected_state:
-                    self.check_message = (
-                        f"{vm_type} '{vm['name']}' is {vm['status']} (expected: {expected_state})"
-                    )
-                    if not self.options.ignore_vm_status:
-                        self.check_result = CheckState.CRITICAL
-                else:
-                    if self.options.node and self.options.node != vm["node"]:
-                        self.check_message = (
-                            f"{vm_type} '{vm['name']}' is {expected_state}, "
-                            f"but located on node '{vm['node']}' instead of '{self.options.node}'"
-                        )
-                        self.check_result = CheckState.WARNING
-                    else:
-                        self.check_message = (
-                            f"{vm_type} '{vm['name']}' is {expected_state} on node '{vm['node']}'"
-                        )
-
-                if vm["status"] == "running" and not only_status:
-                    cpu = round(vm["cpu"] * 100, 2)
-                    self.add_perfdata("cpu", cpu)
-
-                    if self.options.values_mb:
-                        memory = self.scale_value(vm["mem"])
-                        self.add_perfdata(
-                            "memory",
-                            memory,
-                            unit=self.options.unit,
-                            max=self.scale_value(vm["maxmem"]),
-                        )
-                        disk = self.scale_value(vm["disk"])
-                        self.add_perfdata(
-                            "disk",
-                            disk,
-                            unit=self.options.unit,
-                            max=self.scale_value(vm["maxdisk"]),
-                        )
+        if self.snapshot is None:
+            self.snapshot = ResourceSnapshot(
+                self.options.resources_cache, self.cluster_key(), ttl=self.options.resources_ttl
+            )
 
-                    else:
-                        memory = self.get_value(vm["mem"], vm["maxmem"])
-                        self.add_perfdata("memory", memory)
-                        disk = self.get_value(vm["disk"], vm["maxdisk"])
-                        self.add_perfdata("disk", disk)
+        with self.timer.phase("fetch"):
+            return self.snapshot.lookup(idx, fetch)
 
-                    self.check_thresholds(
-                        {"cpu": cpu, "memory": memory, "disk": disk}, message=self.check_message
-                    )
+    def check_vm_status(self, idx: Union[str, int], **kwargs: str) -> None:
+        """Check status of virtual machine by vmid or name."""
+        self.check_vm(self.get_cluster_vm(idx), idx, **kwargs)
 
-                found = True
-                break
+    def check_vm(self, vm: Optional[Dict], idx: Union[str, int], **kwargs: str) -> None:
+        """Check status of a virtual machine from its cluster resources entry."""
+        expected_state = kwargs.get("expected_state", "running")
+        only_status = kwargs.get("only_status", False)
 
-        if not found:
+        if vm is None:
             self.check_message = f"VM or LXC '{idx}' not found"
             self.check_result = CheckState.WARNING
+            return
+
+        # Check if VM (default) or LXC
+        vm_type = "VM"
+        if vm["type"] == "lxc":
+            vm_type = "LXC"
+
+        if vm["status"] != expected_state:
+            self.check_message = (
+                f"{vm_type} '{vm['name']}' is {vm['status']} (expected: {expected_state})"
+            )
+            if not self.options.ignore_vm_status:
+                self.check_result = CheckState.CRITICAL
+        else:
+            if self.options.node and self.options.node != vm["node"]:
+                self.check_message = (
+                    f"{vm_type} '{vm['name']}' is {expected_state}, "
+                    f"but located on node '{vm['node']}' instead of '{self.options.node}'"
+                )
+                self.check_result = CheckState.WARNING
+            else:
+                self.check_message = (
+                    f"{vm_type} '{vm['name']}' is {expected_state} on node '{vm['node']}'"
+                )
+
+        if vm["status"] == "running" and not only_status:
+            cpu = round(vm["cpu"] * 100, 2)
+            self.add_perfdata("cpu", cpu)
+
+            if self.options.values_mb:
+                memory = self.scale_value(vm["mem"])
+                self.add_perfdata(
+                    "memory",
+                    memory,
+                    unit=self.options.unit,
+                    max=self.scale_value(vm["maxmem"]),
+                )
+                disk = self.scale_value(vm["disk"])
+                self.add_perfdata(
+                    "disk",
+                    disk,
+                    unit=self.options.unit,
+                    max=self.scale_value(vm["maxdisk"]),
+                )
+
+            else:
+                memory = self.get_value(vm["mem"], vm["maxmem"])
+                self.add_perfdata("memory", memory)
+                disk = self.get_value(vm["disk"], vm["maxdisk"])
+                self.add_perfdata("disk", disk)
+
+            self.check_thresholds(
+                {"cpu": cpu, "memory": memory, "disk": disk}, message=self.check_message
+            )
+
+    def load_vm_overrides(self) -> Dict[str, Dict]:
+        """Load the per guest overrides for vm-fleet, keyed by vmid or name."""
+        if not self.options.fleet_overrides:
+            return {}
+
+        try:
+            with open(self.options.fleet_overrides, encoding="utf-8") as fh:
+                overrides = json.load(fh)
+        except (OSError, ValueError) as e:
+            self.output(CheckState.UNKNOWN, f"Could not read overrides {self.options.fleet_overrides}: {e}")
+
+        if not isinstance(overrides, dict):
+            self.output(CheckState.UNKNOWN, "Overrides must be a JSON object keyed by vmid or name")
+        for key, override in overrides.items():
+            unknown = set(override) - set(VM_OVERRIDE_KEYS) if isinstance(override, dict) else None
+            if unknown is None or unknown:
+                message = f"Invalid overrides for '{key}', allowed keys are {', '.join(VM_OVERRIDE_KEYS)}"
+                self.output(CheckState.UNKNOWN, message)
+            for threshold in ("warning", "critical"):
+                if threshold in override:
+                    try:
+                        override[threshold] = CheckThreshold.threshold_type(override[threshold])
+                    except argparse.ArgumentTypeError as e:
+                        self.output(CheckState.UNKNOWN, f"Invalid {threshold} for '{key}': {e}")
+        return overrides
+
+    def get_vm_override(self, vm: Dict, overrides: Dict[str, Dict]) -> Dict:
+        """Settings for one guest, tags first then the overrides file by name and by vmid."""
+        override = {}
+        prefix = self.options.fleet_tag_prefix
+        for tag in re.split(r"[;, ]+", vm.get("tags") or ""):
+            if not prefix or not tag.startswith(prefix):
+                continue
+            tag = tag[len(prefix):]
+            if tag == "skip":
+                override["skip"] = True
+            elif tag == "ignore-status":
+                override["ignore_vm_status"] = True
+            elif tag == "status-only":
+                override["only_status"] = True
+            elif tag.startswith("expected-") and tag[len("expected-"):] in VM_STATES:
+                override["expected_vm_status"] = tag[len("expected-"):]
+            elif tag.startswith("node-"):
+                override["node"] = tag[len("node-"):]
+
+        override.update(overrides.get(str(vm.get("name")), {}))
+        override.update(overrides.get(str(vm.get("vmid")), {}))
+        return override
+
+    def check_vm_fleet(self) -> None:
+        """Check every virtual machine and container in one run and submit the results passively to Icinga."""
+        from lib.icinga import Icinga
+
+        options = self.options
+        overrides = self.load_vm_overrides()
+        vms = self.request(self.get_url("cluster/resources"), params={"type": "vm"})
+
+        results = []
+        states = {state: 0 for state in CheckState}
+        skipped = 0
+        try:
+            for vm in vms:
+                override = self.get_vm_override(vm, overrides)
+                if override.get("skip") or vm.get("template") or vm.get("pool") in options.ignore_pools:
+                    skipped += 1
+                    continue
+                try:
+                    # An override can be there because the template doesn't format for this guest
+                    if "host" in override:
+                        host = override["host"]
+                    else:
+                        host = options.fleet_host.format_map(vm)
+                    if "service" in override:
+                        service = override["service"]
+                    else:
+                        service = options.fleet_service.format_map(vm)
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"Skipping {vm.get('id')}, no Icinga object name: {e}")
+                    skipped += 1
+                    continue
+
+                # Evaluate the guest as `--mode vm` would with its own settings
+                self.options = argparse.Namespace(**vars(options))
+                self.options.node = override.get("node")
+                self.options.ignore_vm_status = override.get("ignore_vm_status", options.ignore_vm_status)
+                self.options.threshold_warning = override.get("warning", options.threshold_warning)
+                self.options.threshold_critical = override.get("critical", options.threshold_critical)
+                self.perfdata = []
+                self.check_result = CheckState.OK
+                self.check_message = ""
+                self.check_vm(
+                    vm,
+                    vm.get("vmid"),
+                    expected_state=override.get(
+                        "expected_vm_status", options.expected_vm_status or "running"
+                    ),
+                    only_status=override.get("only_status", False),
+                )
+                states[self.check_result] += 1
+                results.append(
+                    (host, service, self.check_result.value, self.check_message, self.perfdata)
+                )
+        finally:
+            self.options = options
+            self.perfdata = []
+            self.check_result = CheckState.OK
+
+        icinga = Icinga(options.icinga_server, options.icinga_user, options.icinga_password)
+        with self.timer.phase("submit"):
+            submitted = icinga.processCheckResults(results, workers=options.submit_workers)
+
+        failed = [f"{r['host']}!{r['service']}: {r['status']}" for r in submitted["results"] if not r["success"]]
+        self.check_message = (
+            f"Checked {len(results)} guests ({states[CheckState.OK]} ok, "
+            f"{states[CheckState.WARNING]} warning, {states[CheckState.CRITICAL]} critical, "
+            f"{states[CheckState.UNKNOWN]} unknown), skipped {skipped}. "
+            f"Submitted {submitted['submitted']} results in {submitted['seconds']:.2f}s "
+            f"({submitted['rate']:.1f}/s), {submitted['failed']} failed"
+        )
+        if failed:
+            self.check_result = CheckState.CRITICAL
+            self.check_message += "\n" + "\n".join(failed)
+
+        # Counts, not guest metrics, so the -w/-c thresholds don't apply
+        for state in CheckState:
+            self.perfdata.append(f"guests_{state.name.lower()}={states[state]};;;0;")
+        self.perfdata.append(f"skipped={skipped};;;0;")
+        self.perfdata.append(f"submit_failed={submitted['failed']};;;0;")
+        self.perfdata.append(f"submit_rate={round(submitted['rate'], 1)};;;0;")
 
     def check_disks(self) -> None:
         """Check disk health on specific Proxmox VE node."""
@@ -516,6 +786,89 @@ class CheckPVE:
             self.check_result = CheckState.CRITICAL
             self.check_message = "Cluster is unhealthy - no quorum"
 
+    def worker(
+        self, http: HttpClient, memo: Optional[Tuple[Dict, threading.Lock]] = None
+    ) -> "CheckPVE":
+        """Copy of the check for a thread, with its own options and result and raising CheckExit instead of exiting."""
+        check = copy.copy(self)
+        check.options = argparse.Namespace(**vars(self.options))
+        check.perfdata = []
+        check.check_result = CheckState.OK
+        check.check_message = ""
+        check.raise_output = True
+        check.http = http
+        check.request_memo = memo
+        # The timer isn't thread safe, the caller times the threads as a whole
+        check.timer = PhaseTimer()
+
+        return check
+
+    def check_node(
+        self, node: str, mode: str, http: HttpClient, memo: Tuple[Dict, threading.Lock]
+    ) -> Tuple[CheckState, str, List[str]]:
+        """Run a node mode on one node as its own check and return its state, message and perfdata."""
+        check = self.worker(http, memo)
+        check.options.node = node
+        check.options.mode = mode
+
+        try:
+            check.check_mode()
+        except CheckExit as e:
+            return (e.rc, e.message, [])
+        except Exception as e:
+            logger.exception(f"{mode} check of node {node} failed")
+            return (CheckState.UNKNOWN, f"Check failed: {e}", [])
+
+        return (check.check_result, check.check_message, check.perfdata)
+
+    def check_nodes(self) -> None:
+        """Run the node modes on every node of the cluster at once, with one result per node and mode."""
+        options = self.options
+        data = self.request(self.get_url("cluster/status"))
+        nodes = {elem["name"]: elem.get("online", 1) for elem in data if elem["type"] == "node"}
+
+        results = {}
+        for node, online in nodes.items():
+            if not online:
+                results[(node, None)] = (CheckState.CRITICAL, "Node is offline", [])
+        # Mode by mode, the checks of a node that share a url find it in the memo instead of waiting on each other
+        tasks = [(node, mode) for mode in options.node_modes for node in nodes if nodes[node]]
+
+        # The requests all go to the api endpoint, keep a connection per worker alive
+        http = HttpClient(pool_size=options.node_workers)
+        memo = ({}, threading.Lock())
+        with self.timer.phase("fetch"), ThreadPoolExecutor(max_workers=options.node_workers) as executor:
+            futures = {
+                executor.submit(self.check_node, node, mode, http, memo): (node, mode) for node, mode in tasks
+            }
+            for future, task in futures.items():
+                results[task] = future.result()
+
+        states = {state: 0 for state in CheckState}
+        lines = []
+        for node in sorted(nodes):
+            for mode in [None, *options.node_modes]:
+                if (node, mode) not in results:
+                    continue
+                state, message, perfdata = results[(node, mode)]
+                states[state] += 1
+                message = "\n  ".join(line for line in message.strip().splitlines() if line.strip())
+                lines.append(f"[{state.name}] {node}{' ' + mode if mode else ''}: {message}")
+                prefix = f"{node}_{mode.replace('-', '_')}_" if mode else f"{node}_"
+                self.perfdata.extend(prefix + metric for metric in perfdata)
+
+        # A critical result outweighs an unknown one
+        for state in (CheckState.CRITICAL, CheckState.UNKNOWN, CheckState.WARNING):
+            if states[state]:
+                self.check_result = state
+                break
+
+        self.check_message = (
+            f"{len(nodes)} nodes, {len(results)} checks: {states[CheckState.OK]} ok, "
+            f"{states[CheckState.WARNING]} warning, {states[CheckState.CRITICAL]} critical, "
+            f"{states[CheckState.UNKNOWN]} unknown\n" + "\n".join(lines)
+        )
+
     def check_zfs_fragmentation(self, name: Optional[str] = None) -> None:
         """Check all or one specific ZFS pool for fragmentation."""
         url = self.get_url(f"nodes/{self.options.node}/disks/zfs")
@@ -697,18 +1050,74 @@ class CheckPVE:
 
         return members
 
+    def get_node_tasks(self, node: str, since: int) -> List[Dict]:
+        """Get the vzdump tasks, finished and running, a node started since the given time."""
+        url = self.get_url(f"nodes/{node}/tasks")
+        params = {"typefilter": "vzdump", "source": "all", "since": since, "limit": TASKS_PAGE_SIZE}
+
+        # Newest first, a task started while paging shifts the pages and is listed twice rather than missed
+        tasks = []
+        while True:
+            page = self.request(url, params=dict(params, start=len(tasks)))
+            tasks.extend(page)
+            if len(page) < TASKS_PAGE_SIZE:
+                return tasks
+
+    def get_vzdump_tasks(self, delta: Optional[CheckThreshold]) -> List[Dict]:
+        """Get the vzdump tasks of the cluster, from the task store when there is one that covers delta.
+
+        Without a delta the check counts what cluster/tasks returns, as the store's retention would be a different window.
+        """
+        retention = self.options.tasks_retention * 86400
+        if not retention or delta is None or delta.value > retention:
+            tasks = self.request(self.get_url("cluster/tasks"))
+            return [t for t in tasks if t["type"] == "vzdump"]
+
+        if self.options.node is not None:
+            nodes = [self.options.node]
+        else:
+            # An offline node can't be asked, its stored tasks are used until it is back
+            nodes = [n["node"] for n in self.request(self.get_url("nodes")) if n.get("status") == "online"]
+
+        import sqlite3
+
+        def fetch(cursors: Dict[str, int]) -> Dict[str, List[Dict]]:
+            # One request chain per node, at the same time over one connection pool
+            http = HttpClient(pool_size=self.options.node_workers)
+            with self.timer.phase("fetch"), ThreadPoolExecutor(
+                max_workers=self.options.node_workers
+            ) as executor:
+                futures = {
+                    node: executor.submit(self.worker(http).get_node_tasks, node, since)
+                    for node, since in cursors.items()
+                }
+            try:
+                return {node: future.result() for node, future in futures.items()}
+            except CheckExit as e:
+                self.output(e.rc, e.message)
+
+        store = TaskStore(self.options.tasks_cache, self.cluster_key(), retention=retention)
+        try:
+            store.update(nodes, fetch)
+            since = int(datetime.now(timezone.utc).timestamp() - delta.value)
+            return store.tasks(node=self.options.node, since=since)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Unable to use task store {self.options.tasks_cache}: {e}")
+            tasks = self.request(self.get_url("cluster/tasks"))
+            return [t for t in tasks if t["type"] == "vzdump"]
+        finally:
+            store.close()
+
     def check_vzdump_backup(self, name: Optional[str] = None) -> None:
         """Check for failed vzdump backup jobs."""
-        tasks_url = self.get_url("cluster/tasks")
-        tasks = self.request(tasks_url)
-        tasks = [t for t in tasks if t["type"] == "vzdump"]
+        delta = self.threshold_critical("delta")
+        tasks = self.get_vzdump_tasks(delta)
 
         # Filter by node id, if one is provided
         if self.options.node is not None:
             tasks = [t for t in tasks if t["node"] == self.options.node]
 
         # Filter by timestamp, if provided
-        delta = self.threshold_critical("delta")
         if delta is not None:
             now = datetime.now(timezone.utc).timestamp()
 
@@ -872,8 +1281,17 @@ class CheckPVE:
         """Execute the real check command."""
         self.check_result = CheckState.OK
 
+        with self.timer.phase("evaluate"):
+            self.check_mode()
+
+        self.check_output()
+
+    def check_mode(self) -> None:
+        """Run the check for the selected mode."""
         if self.options.mode == "cluster":
             self.check_cluster_status()
+        elif self.options.mode == "nodes":
+            self.check_nodes()
         elif self.options.mode == "version":
             self.check_version()
         elif self.options.mode == "memory":
@@ -908,6 +1326,8 @@ class CheckPVE:
                 )
             else:
                 self.check_vm_status(idx, only_status=only_status)
+        elif self.options.mode == "vm-fleet":
+            self.check_vm_fleet()
         elif self.options.mode == "replication":
             self.check_replication()
         elif self.options.mode == "ceph-health":
@@ -922,11 +1342,23 @@ class CheckPVE:
             message = f"Check mode '{self.options.mode}' not known"
             self.output(CheckState.UNKNOWN, message)
 
-        self.check_output()
-
     def parse_args(self) -> None:
         """Parse CLI arguments."""
-        p = argparse.ArgumentParser(description="Check command for PVE hosts via API")
+        # The login and connection pool are shared by every batch argument set, so the API options can't change between them
+        p = jsonarg.ArgumentParser(
+            description="Check command for PVE hosts via API",
+            batch=True,
+            batch_shared=[
+                "api_endpoint",
+                "api_port",
+                "api_user",
+                "api_password",
+                "api_token",
+                "api_insecure",
+                "ticket_cache_dir",
+                "ticket_cache",
+            ],
+        )
 
         api_opts = p.add_argument_group("API Options")
 
@@ -966,6 +1398,20 @@ class CheckPVE:
             help="Don't verify HTTPS certificate",
         )
 
+        api_opts.add_argument(
+            "--ticket-cache-dir",
+            dest="ticket_cache_dir",
+            default="/tmp",
+            help="Directory for the login ticket shared by checks with the same endpoint and user",
+        )
+        api_opts.add_argument(
+            "--no-ticket-cache",
+            dest="ticket_cache",
+            action="store_false",
+            default=True,
+            help="Log in with the password on every run instead of sharing a ticket",
+        )
+
         api_opts.set_defaults(api_port=8006)
 
         check_opts = p.add_argument_group("Check Options")
@@ -975,6 +1421,7 @@ class CheckPVE:
             "--mode",
             choices=(
                 "cluster",
+                "nodes",
                 "version",
                 "cpu",
                 "memory",
@@ -988,6 +1435,7 @@ class CheckPVE:
                 "vm",
                 "vm_status",
                 "vm-status",
+                "vm-fleet",
                 "replication",
                 "disk-health",
                 "ceph-health",
@@ -1003,7 +1451,26 @@ class CheckPVE:
             "-n",
             "--node",
             dest="node",
-            help="Node to check (necessary for all modes except cluster, version and backup)",
+            help="Node to check (necessary for all modes except cluster, nodes, version and backup)",
+        )
+
+        check_opts.add_argument(
+            "--node-mode",
+            dest="node_modes",
+            action="append",
+            choices=NODE_MODES,
+            metavar="MODE",
+            help="Mode the nodes mode runs on every node, can be repeated (default: "
+            + ", ".join(DEFAULT_NODE_MODES)
+            + ")",
+        )
+
+        check_opts.add_argument(
+            "--node-workers",
+            dest="node_workers",
+            type=int,
+            default=10,
+            help="Number of node checks the nodes mode, or node task lists the backup mode, fetches at once",
         )
 
         check_opts.add_argument("--name", dest="name", help="Name of storage, vm, or container")
@@ -1098,17 +1565,108 @@ class CheckPVE:
             help="Unit which is used for performance data and other values",
         )
 
+        fleet_opts = p.add_argument_group("VM Fleet Options")
+
+        fleet_opts.add_argument(
+            "--icinga-server",
+            dest="icinga_server",
+            help="Icinga API url for vm-fleet results, eg: https://icinga.example.com:5665",
+        )
+        fleet_opts.add_argument("--icinga-user", dest="icinga_user", help="Icinga API user")
+        fleet_opts.add_argument("--icinga-password", dest="icinga_password", help="Icinga API password")
+        fleet_opts.add_argument(
+            "--submit-workers",
+            dest="submit_workers",
+            type=int,
+            default=10,
+            help="Number of passive results to submit to the Icinga API at once",
+        )
+        fleet_opts.add_argument(
+            "--fleet-host",
+            dest="fleet_host",
+            default="{name}",
+            help="Icinga host for each guest, formatted with its cluster resources fields (e.g. {name}, {vmid}, {node})",
+        )
+        fleet_opts.add_argument(
+            "--fleet-service",
+            dest="fleet_service",
+            default="pve-vm",
+            help="Icinga service for each guest, formatted like --fleet-host",
+        )
+        fleet_opts.add_argument(
+            "--fleet-overrides",
+            dest="fleet_overrides",
+            metavar="FILE",
+            help="JSON object of per guest settings keyed by vmid or name, keys: " + ", ".join(VM_OVERRIDE_KEYS),
+        )
+        fleet_opts.add_argument(
+            "--fleet-tag-prefix",
+            dest="fleet_tag_prefix",
+            default="icinga-",
+            help="Prefix of the guest tags read by vm-fleet: skip, ignore-status, status-only, "
+            "expected-<state> and node-<node>",
+        )
+
+        cache_opts = p.add_argument_group("Cache Options")
+
+        cache_opts.add_argument(
+            "--resources-cache",
+            dest="resources_cache",
+            default="/tmp/check_pve_resources.sqlite",
+            help="File for the cluster resources snapshot shared by the vm checks",
+        )
+        cache_opts.add_argument(
+            "--resources-ttl",
+            dest="resources_ttl",
+            type=int,
+            default=RESOURCES_TTL,
+            help="Seconds the vm checks use the cluster resources snapshot for, 0 fetches it for every check",
+        )
+        cache_opts.add_argument(
+            "--tasks-cache",
+            dest="tasks_cache",
+            default="/tmp/check_pve_tasks.sqlite",
+            help="File for the vzdump tasks the backup check keeps between runs",
+        )
+        cache_opts.add_argument(
+            "--tasks-retention",
+            dest="tasks_retention",
+            type=int,
+            default=7,
+            help="Days of vzdump tasks the backup check keeps and only fetches new tasks for, used with a "
+            "delta threshold up to this long, 0 fetches cluster/tasks for every check",
+        )
+
+        addTimingArgs(p.add_argument_group("Timing Options"))
+
         options = p.parse_args()
+        self.parser = p
+
+        if not options.node_modes:
+            options.node_modes = list(DEFAULT_NODE_MODES)
+
+        # In batch mode each argument set is checked when it is run
+        if not options.batch:
+            self.check_options(options)
+
+        self.options = options
+
+    def check_options(self, options: argparse.Namespace) -> None:
+        """Check the option combinations the parser can't."""
+        p = self.parser
 
         if not options.node and options.mode not in [
             "cluster",
+            "nodes",
             "vm",
             "vm_status",
+            "vm-fleet",
             "version",
             "ceph-health",
             "backup",
         ]:
-            p.print_usage()
+            if not options.batch:
+                p.print_usage()
             message = f"{p.prog}: error: --mode {options.mode} requires node name (--node)"
             self.output(CheckState.UNKNOWN, message)
 
@@ -1117,15 +1675,28 @@ class CheckPVE:
             and not options.name
             and options.mode in ("vm", "vm_status", "vm-status")
         ):
-            p.print_usage()
+            if not options.batch:
+                p.print_usage()
             message = (
                 f"{p.prog}: error: --mode {options.mode} requires either "
                 "vm name (--name) or id (--vmid)",
             )
             self.output(CheckState.UNKNOWN, message)
 
+        if options.mode == "vm-fleet" and not (
+            options.icinga_server and options.icinga_user and options.icinga_password
+        ):
+            if not options.batch:
+                p.print_usage()
+            message = (
+                f"{p.prog}: error: --mode {options.mode} requires "
+                "--icinga-server, --icinga-user and --icinga-password"
+            )
+            self.output(CheckState.UNKNOWN, message)
+
         if not options.name and options.mode == "storage":
-            p.print_usage()
+            if not options.batch:
+                p.print_usage()
             message = f"{p.prog}: error: --mode {options.mode} requires storage name (--name)"
             self.output(CheckState.UNKNOWN, message)
 
@@ -1139,30 +1710,64 @@ class CheckPVE:
             ):
                 p.error("Critical value must be lower than warning value")
 
-        self.options = options
+    def check_batch(self) -> None:
+        """Run the check for each argument set on stdin with one login, one JSON result per line."""
+
+        def run(options: argparse.Namespace) -> None:
+            self.perfdata = []
+            self.check_result = CheckState.UNKNOWN
+            self.check_message = ""
+            self.check_options(options)
+            self.options = options
+            self.check()
+
+        jsonarg.run_batch(self.parser, self.options, run)
+        sys.exit(0)
 
     def __init__(self) -> None:
         self.options = {}
+        self.raise_output = False
         self.ticket = None
         self.perfdata = []
         self.check_result = CheckState.UNKNOWN
         self.check_message = ""
+        self.snapshot = None
+        self.request_memo = None
+        self.ticket_cache = None
+        self.csrf_token = None
 
         self.__headers = {}
         self.__cookies = {}
+        # Pooled keep-alive connections, shared by every check in a batch
+        self.http = HttpClient()
 
         self.parse_args()
+        self.timer = initTiming(self.options, f"check_pve {self.options.mode}")
 
         if self.options.api_insecure:
             # disable urllib3 warning about insecure requests
             requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
         if self.options.api_password is not None:
-            self.__cookies["PVEAuthCookie"] = self.get_ticket()
+            if self.options.ticket_cache:
+                self.ticket_cache = TicketCache(
+                    ticketFile(
+                        "check_pve",
+                        self.options.api_endpoint,
+                        self.options.api_port,
+                        self.options.api_user,
+                        cacheDir=self.options.ticket_cache_dir,
+                    ),
+                    secret=self.options.api_password,
+                )
+            with self.timer.phase("auth"):
+                self.__cookies["PVEAuthCookie"] = self.get_ticket()
         elif self.options.api_token is not None:
             token = f"{self.options.api_user}!{self.options.api_token}"
             self.__headers["Authorization"] = f"PVEAPIToken={token}"
 
 
 pve = CheckPVE()
+if pve.options.batch:
+    pve.check_batch()
 pve.check()
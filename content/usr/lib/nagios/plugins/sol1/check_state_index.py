@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Daemon that keeps an index of Icinga object state from the event stream and answers queries from
+# check_icinga2_checks.py --state-index over a unix socket
+
+import argparse
+import threading
+
+from loguru import logger
+import lib.util as util
+from lib.icinga import Icinga
+from lib.stateindex import StateIndex, StateIndexServer, EventFeeder, DEFAULT_SOCKET, DEFAULT_STALE_AFTER, DEFAULT_RESYNC_INTERVAL
+
+def get_args(argvals=None):
+    parser = argparse.ArgumentParser(description="Keep an index of Icinga object state from the event stream and answer queries over a unix socket")
+    parser.add_argument('-s', '--server', type=str, help='Icinga API server url including port, eg: https://icinga.example.com:5665', required=True)
+    parser.add_argument('-u', '--username', type=str, help='Icinga API username, needs events/* and objects/query/* permissions', required=True)
+    parser.add_argument('-p', '--password', type=str, help='Icinga API password', required=True)
+    parser.add_argument('--types', type=str, help='Comma seperated list of object types to index', default='services')
+    parser.add_argument('--socket', type=str, help='Unix socket to listen on', default=DEFAULT_SOCKET)
+    parser.add_argument('--socket-mode', type=lambda m: int(m, 8), help='Permissions for the unix socket (octal)', default='660')
+    parser.add_argument('--stale-after', type=float, help='Seconds without an event before the stream is reconnected and the index reseeded', default=DEFAULT_STALE_AFTER)
+    parser.add_argument('--resync-interval', type=float, help='Seconds between full reseeds of the index', default=DEFAULT_RESYNC_INTERVAL)
+
+    parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--enable-screen-debug', action="store_true")
+    parser.add_argument('--log-rotate', type=str, default='1 day')
+    parser.add_argument('--log-retention', type=str, default='3 days')
+
+    return parser.parse_args(argvals)
+
+
+if __name__ == "__main__":
+    # Init args
+    args = get_args()
+
+    # Init logging
+    util.init_logging(debug=args.debug, enableScreenDebug=args.enable_screen_debug, logFile='/var/log/icinga2/check_state_index.log', logRotate=args.log_rotate, logRetention=args.log_retention)
+    logger.info(f"Starting state index for {args.types} from {args.server}")
+
+    index = StateIndex([t.strip() for t in args.types.split(',') if t.strip()])
+    feeder = EventFeeder(Icinga(args.server, args.username, args.password), index, stale_after=args.stale_after, resync_interval=args.resync_interval)
+    threading.Thread(target=feeder.run, daemon=True).start()
+
+    # Serve until stopped
+    server = StateIndexServer(args.socket, index, socket_mode=args.socket_mode)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        feeder.stop()
+        server.server_close()
@@ -10,9 +10,9 @@ from lib.util import init_logging, MonitoringPlugin
 from loguru import logger
 
 
-import requests
 from requests.auth import HTTPBasicAuth
 from json import loads
+from lib.httpclient import HttpClient
 
 import urllib3
 # because certificates cannot be verified
@@ -72,6 +72,7 @@ class Titan:
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
+        self.__client = HttpClient(headers=self.__headers, auth=HTTPBasicAuth(self.__user, self.__password))
         logger.debug(f"Titan object properties: server={self.server}, user={self.__user}")
 
     def get(self, url, decode_json = False):
@@ -84,9 +85,9 @@ class Titan:
         try:
             logger.debug(f"Request to {url} using {reqtype}\n")
             if reqtype == 'GET':
-                response = requests.get(url=url, headers=self.__headers, auth = HTTPBasicAuth(self.__user, self.__password), verify=False)
+                response = self.__client.get(url)
             elif reqtype == 'POST':
-                response = requests.post(url=url, headers=self.__headers, auth = HTTPBasicAuth(self.__user, self.__password), json=payload, verify=False)
+                response = self.__client.post(url, json=payload)
             else:
                 logger.error(f"Titan request not GET or POST, this shouldn't happen.")
             logger.debug(f"Titan {reqtype} response {response}")
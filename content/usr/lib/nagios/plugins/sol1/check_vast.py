@@ -6,13 +6,17 @@ import os
 import requests
 import re
 import urllib.parse
-import humanize
 
 from sol1_monitoring_plugins_lib import MonitoringPlugin, initLogging, initLoggingArgparse
 from datetime import datetime
 from loguru import logger
 from urllib3.exceptions import InsecureRequestWarning
 from pathlib import Path
+from lib.lazy import lazyImport
+from lib.util import addTimingArgs, initTiming
+
+# Only needed by some modes
+humanize = lazyImport('humanize')
 
 # Suppress only the single warning from urllib3 needed.
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
@@ -37,6 +41,7 @@ def get_args(argvals=None):
     parser.add_argument('--timeout', type=int, help='Http request timeout', default=15)
     
     initLoggingArgparse(parser, log_file='/var/log/icinga2/check_vast.log')
+    addTimingArgs(parser)
 
     # Connection type
     subparser = parser.add_subparsers(title='Mode', dest='mode', help='Help for mode', required=True)
@@ -101,14 +106,16 @@ class Vast:
         """
         return self.__request('get', url, None, parseresult)
 
-    def __request(self, reqtype, url, payload = None, parseresult: bool = True):
+    def __request(self, reqtype, url, payload = None, parseresult: bool = True, phase = 'fetch'):
         try:
             logger.debug("Request to {url} using {type}\n".format(url=url, type=reqtype.upper()))
             if reqtype == 'get':
-                response = self.__session.get(url=url, headers=self.__headers, verify=False, timeout=self.timeout)
+                with timer.phase(phase):
+                    response = self.__session.get(url=url, headers=self.__headers, verify=False, timeout=self.timeout)
             elif reqtype == 'post':
-                response = self.__session.post(url=url, headers=self.__headers, json=payload, verify=False, timeout=self.timeout)
-                logger.debug(f"Result from {reqtype} {url} using headers {self.__headers} is {response}\n")
+                with timer.phase(phase):
+                    response = self.__session.post(url=url, headers=self.__headers, json=payload, verify=False, timeout=self.timeout)
+                logger.debug("Result from {} {} using headers {} is {}\n", reqtype, url, self.__headers, response)
             else:
                 plugin.message = "This shouldn't happen, code gone bad\n"
                 plugin.exit(plugin.STATE_CRITICAL)
@@ -122,7 +129,7 @@ class Vast:
         if response.status_code in [401,403]:
             self.__getAccessToken(True)
             logger.debug("Auth error ({code}), retrying request to {url}".format(url=url,code=response.status_code))
-            result = self.__request(reqtype, url, payload, parseresult)
+            result = self.__request(reqtype, url, payload, parseresult, phase)
             logger.debug("Auth error ({code}), retried request to {url}".format(url=url,code=response.status_code))
             return result
 
@@ -132,10 +139,11 @@ class Vast:
                 plugin.exit(plugin.STATE_CRITICAL)
 
             try:
-                if parseresult:
-                    result = response.json()
-                else:
-                    result = response.text
+                with timer.phase('parse'):
+                    if parseresult:
+                        result = response.json()
+                    else:
+                        result = response.text
             except Exception as e:
                 plugin.message = "Unable to parse json data from request {}\n Response text: \n{}".format(url, response.text)
                 logger.error("Parse error for {url}: {error}".format(url=url, error=e))
@@ -194,7 +202,7 @@ class Vast:
             logger.info(f"Getting access token using api call to {url}")
             request_time = datetime.now().timestamp()
             try:
-                results = self.post(url, payload, True)
+                results = self.__request('post', url, payload, True, phase='auth')
             except Exception as e:
                 logger.error(f"Token request failed with: {e}")
                 plugin.message(f"Auth error accessing Vast: token\nSee {os.getpid()} in logs for more details\n")
@@ -344,9 +352,12 @@ logger.info("Processing Vast check with args [{}]".format(args))
 
 # Init plugin
 plugin = MonitoringPlugin(args.mode)
+timer = initTiming(args, f"check_vast {args.mode}", plugin)
 
 # Run and exit
-vast = Vast(args.server, args.username, args.password, args)
+with timer.phase('auth'):
+    vast = Vast(args.server, args.username, args.password, args)
 logger.debug("Running check for {}".format(args.mode))
-eval('vast.{}()'.format(args.mode))
+with timer.phase('evaluate'):
+    eval('vast.{}()'.format(args.mode))
 plugin.exit()
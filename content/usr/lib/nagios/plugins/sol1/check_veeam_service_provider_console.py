@@ -2,18 +2,23 @@
 
 #Imports
 import argparse
-import humanize
 import json
 import re
-import requests
 import traceback
 
 from loguru import logger
 from sol1_monitoring_plugins_lib import MonitoringPlugin, initLogging, initLoggingArgparse
-from lib.util import initRequestsCache
+from lib.util import addTimingArgs, initRequestsCache, initTiming, requestsCacheFile
 from lib.icinga import Icinga
+from lib.icingafilter import FilterNotSupported
+from lib.icingaredis import IcingaRedis, IcingaRedisError
+from lib.httpclient import HttpClient, HeaderAuth
+from lib.lazy import lazyImport
 from datetime import datetime, timedelta, timezone
-from dateutil.parser import parse
+
+# Only needed by some modes
+humanize = lazyImport('humanize')
+dateutil_parser = lazyImport('dateutil.parser')
 
 from requests.packages import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -28,6 +33,7 @@ def get_args(argvals=None):
     parser.add_argument('--cacheage', type=int, help='Maximum age for cached API data (in seconds)', required=False, default=120)
 
     initLoggingArgparse(parser)
+    addTimingArgs(parser)
 
     # Connection type
     subparser = parser.add_subparsers(title='Mode', dest='mode', help='Help for mode', required=True)
@@ -45,6 +51,9 @@ def get_args(argvals=None):
     parserOrganisationMonitoring.add_argument('--service-filter', type=str, help='Service filter used in find services and extract the Org names from the service name', required=True)
     parserOrganisationMonitoring.add_argument('--service-org-var', type=str, help='Service var that contains the service name', default='veeamspc_organization')
     parserOrganisationMonitoring.add_argument('--exclude', type=str, action='append', help="Organization names that don't need a backup check")
+    parserOrganisationMonitoring.add_argument('--icingadb-redis', action="store_true", help="Find the services in the IcingaDB Redis instead of the Icinga API, the API is used if Redis can't answer", default=False)
+    parserOrganisationMonitoring.add_argument('--icingadb-redis-host', type=str, help='IcingaDB Redis host', default='localhost')
+    parserOrganisationMonitoring.add_argument('--icingadb-redis-port', type=int, help='IcingaDB Redis port', default=6380)
     
     parserBackup365 = subparser.add_parser("Backup365Jobs", help="Backup Microsoft 365 Jobs")
     parserBackup365.add_argument('--organization', type=str, help='Organization name for backup job', required=True)
@@ -63,9 +72,9 @@ class VeeamServiceProviderConsole():
         self._backup_365_jobs = None
         self._organizations = None
         self.__headers = {
-            'Accept': 'application/json', 
-            'Authorization': token
+            'Accept': 'application/json'
         }
+        self.__client = HttpClient(auth=HeaderAuth('Authorization', token))
     
     # API Calls
     def post(self, url, payload, parseresult = True):
@@ -97,11 +106,13 @@ class VeeamServiceProviderConsole():
         try:
             logger.debug("Request to {url} using {type}\n".format(url=url, type=reqtype))
             if reqtype == 'GET':
-                response = requests.get(url=url, headers=self.__headers, verify=False)
-                logger.debug("{reqtype} result from {url} using headers {headers} is {result}\n".format(url=url, headers=self.__headers, result=response, reqtype=reqtype))
+                with timer.phase('fetch'):
+                    response = self.__client.get(url, headers=self.__headers)
+                logger.debug("{} result from {} using headers {} is {}\n", reqtype, url, self.__headers, response)
             elif reqtype == 'POST':
-                response = requests.post(url=url, headers=self.__headers, json=payload, verify=False)
-                logger.debug("{reqtype} of {payload} result from {url} using headers {headers} is {result}\n".format(url=url, headers=self.__headers, result=response, reqtype=reqtype, payload=payload))
+                with timer.phase('fetch'):
+                    response = self.__client.post(url, headers=self.__headers, json=payload)
+                logger.debug("{} of {} result from {} using headers {} is {}\n", reqtype, payload, url, self.__headers, response)
             else:
                 plugin.message = "This shouldn't happen, code gone bad\n"
                 plugin.exit(plugin.STATE_CRITICAL)
@@ -117,10 +128,11 @@ class VeeamServiceProviderConsole():
                 plugin.exit(plugin.STATE_CRITICAL)
 
             try:
-                if parseresult:
-                    result = response.json()
-                else:
-                    result = response.text
+                with timer.phase('parse'):
+                    if parseresult:
+                        result = response.json()
+                    else:
+                        result = response.text
             except Exception as e:
                 plugin.message = "Unable to parse json data from request {}\n Response text: \n{}".format(url, response.text)
                 logger.error("Parse error for {url}: {error}".format(url=url, error=e))
@@ -189,7 +201,7 @@ class VeeamServiceProviderConsole():
     @staticmethod
     def toUTC(dt):
         if not isinstance(dt, datetime):
-            dt = parse(dt)
+            dt = dateutil_parser.parse(dt)
         if dt.tzinfo is None:  # if it's naive, assume it's in UTC
             return dt.replace(tzinfo=timezone.utc)
         return dt.astimezone(timezone.utc)      
@@ -377,8 +389,16 @@ class VeeamServiceProviderConsole():
             
 
     def OrganisationMonitoring(self):
-        icinga = Icinga(server=self._args.icinga_url, user=self._args.icinga_user, password=self._args.icinga_password)
-        icinga_checks = icinga.getCheckResults('services', f'{self._args.service_filter}')
+        icinga_checks = None
+        if self._args.icingadb_redis:
+            try:
+                with timer.phase('fetch'):
+                    icinga_checks = IcingaRedis(self._args.icingadb_redis_host, self._args.icingadb_redis_port).getCheckResults('services', self._args.service_filter, attrs=['vars'])
+            except (IcingaRedisError, FilterNotSupported) as e:
+                logger.warning(f"Using the Icinga API, {e}")
+        if icinga_checks is None:
+            icinga = Icinga(server=self._args.icinga_url, user=self._args.icinga_user, password=self._args.icinga_password)
+            icinga_checks = icinga.getCheckResults('services', f'{self._args.service_filter}')
         if not icinga_checks:
             plugin.setMessage(f"No Icinga services found matching {self._args.service_filter}*", plugin.STATE_CRITICAL, True)
             plugin.exit()
@@ -428,13 +448,19 @@ if __name__ == "__main__":
     initLogging(debug=args.debug, enable_screen_debug=args.enable_screen_debug, log_file='/var/log/icinga2/check_veeam_service_provider_console.log', log_rotate=args.log_rotate, log_retention=args.log_retention)
     logger.info("Processing Veeam Service Provider Console check with args [{}]".format(args))
 
-    initRequestsCache(cache_file = f"/tmp/vspc{hash(args.url)}.cache", expire_after=args.cacheage)
+    _requests_cache = initRequestsCache(cache_file=requestsCacheFile('vspc', args.url), expire_after=args.cacheage)
+    if _requests_cache[0]:
+        logger.debug(_requests_cache[1])
+    else:
+        logger.error(_requests_cache[1])
 
     # Init plugin
     plugin = MonitoringPlugin(args.mode)
+    timer = initTiming(args, f"check_veeam_service_provider_console {args.mode}", plugin)
 
     # run and exit
     vspc = VeeamServiceProviderConsole(args.url, args.token, args)
     logger.debug("Running check for {}".format(args.mode))
-    eval('vspc.{}()'.format(args.mode))
+    with timer.phase('evaluate'):
+        eval('vspc.{}()'.format(args.mode))
     plugin.exit()
\ No newline at end of file
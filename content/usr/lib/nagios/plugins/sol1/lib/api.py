@@ -1,13 +1,12 @@
-import requests
-
 from json import loads
 from loguru import logger
+from lib.httpclient import HttpClient, DEFAULT_TIMEOUT
 
 class SimpleAPI:
-    def __init__(self, server):
-        self.__session = requests.Session()     # Holds the session including cookies
+    def __init__(self, server, auth = None, timeout = DEFAULT_TIMEOUT):
         self.server = server
         self.__headers = {'Accept': '*/*'}
+        self.__client = HttpClient(auth=auth, timeout=timeout)     # Pooled keep-alive connections with retries
     
     # API Calls
     def post(self, url, payload, parseresult = True):
@@ -40,11 +39,11 @@ class SimpleAPI:
         try:
             logger.debug("Request to {url} using {type}\n".format(url=url, type=reqtype))
             if reqtype == 'GET':
-                response = self.__session.get(url=url, headers=self.__headers, verify=False)
-                logger.debug("{reqtype} result from {url} using headers {headers} is {result}\n".format(url=url, headers=self.__headers, result=response, reqtype=reqtype))
+                response = self.__client.get(url, headers=self.__headers)
+                logger.debug("{} result from {} using headers {} is {}\n", reqtype, url, self.__headers, response)
             elif reqtype == 'POST':
-                response = self.__session.post(url=url, headers=self.__headers, json=payload, verify=False)
-                logger.debug("{reqtype} of {payload} result from {url} using headers {headers} is {result}\n".format(url=url, headers=self.__headers, result=response, reqtype=reqtype, payload=payload))
+                response = self.__client.post(url, headers=self.__headers, json=payload)
+                logger.debug("{} of {} result from {} using headers {} is {}\n", reqtype, payload, url, self.__headers, response)
             else:
                 plugin.message = "This shouldn't happen, code gone bad\n"
                 plugin.exit(plugin.STATE_CRITICAL)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# State x acknowledgement and overdue counts for a set of Icinga check objects
+#
+# check_icinga2_checks.py statusmetrics counts every check by state and acknowledgement. With 100k checks a loop
+# over the check dicts spends most of its time casting and testing each value. checkMetrics() instead copies the
+# state, acknowledgement, last check and interval of every check into array columns, then counts them with map()
+# and bytes.count() so the per check work is done in C. Checks with values that don't fit in the columns (strings,
+# nested objects) are counted by checkMetricsLoop(), the per check loop, which gives the same counts.
+#
+# The counts follow the rules the statusmetrics perfdata has always used:
+# - only states 0-2 are counted by state, anything else (including unknown and a missing state) is invalid
+# - an acknowledgement >= 1 is counted as acknowledged, sticky acknowledgements are counted as acknowledged
+# - a check is overdue when last_check + check_interval + buffer is in the past, or last_check is '-1'
+
+from array import array
+from datetime import datetime
+from itertools import compress, repeat
+import math
+import operator
+
+from loguru import logger
+
+METRIC_LABELS = ['ok', 'warning', 'critical', 'unknown', 'invalid', 'overdue', 'total']
+# Column state code -> metrics label, codes other than 0-2 are invalid
+STATE_LABELS = ['ok', 'warning', 'critical', 'invalid']
+STATE_CODES = {0: 0, 1: 1, 2: 2}
+INVALID_CODE = 3
+# Checks counted from each set of columns
+COLUMN_BLOCK = 8192
+_EMPTY = {}
+
+
+def emptyMetrics():
+    """Metrics with every count at 0
+
+    Returns:
+        dict: {label: {"total", "acknowledged_total", "acknowledged_sticky"}} for each METRIC_LABELS
+    """
+    return {label: {"total": 0, "acknowledged_total": 0, "acknowledged_sticky": 0} for label in METRIC_LABELS}
+
+
+def checkColumns(checks):
+    """Copy the attributes the metrics are counted from into columns
+
+    Args:
+        checks (iterable): check objects from the Icinga API
+
+    Raises:
+        ValueError: a check has a value that doesn't fit in the columns
+
+    Returns:
+        tuple: (states, acks, last_checks, intervals) arrays with an item per check, a missing state is -1, a
+            missing acknowledgement 0 and a missing last check or interval infinity (never overdue)
+    """
+    try:
+        # The API returns every attribute that is asked for, so try without the defaults first
+        attrs = list(map(operator.itemgetter('attrs'), checks))
+        results = map(operator.itemgetter('last_check_result'), attrs)
+        states = array('d', [-1 if result is None else result['state'] for result in results])
+        acks = array('d', map(operator.itemgetter('acknowledgement'), attrs))
+        last_checks = array('d', map(operator.itemgetter('last_check'), attrs))
+        intervals = array('d', map(operator.itemgetter('check_interval'), attrs))
+        return (states, acks, last_checks, intervals)
+    except (KeyError, TypeError, AttributeError, OverflowError):
+        pass
+    try:
+        attrs = [check.get('attrs', _EMPTY) for check in checks]
+        states = [(check_attrs.get('last_check_result', _EMPTY) or _EMPTY).get('state') for check_attrs in attrs]
+        states = array('d', [-1 if state is None else state for state in states])
+        acks = array('d', [check_attrs.get('acknowledgement') or 0 for check_attrs in attrs])
+        last_checks = [check_attrs.get('last_check') for check_attrs in attrs]
+        last_checks = array('d', [math.inf if last_check is None else last_check for last_check in last_checks])
+        intervals = [check_attrs.get('check_interval') for check_attrs in attrs]
+        intervals = array('d', [math.inf if interval is None else interval for interval in intervals])
+    except (AttributeError, TypeError, OverflowError) as e:
+        raise ValueError(f"checks can't be counted as columns: {e}")
+    return (states, acks, last_checks, intervals)
+
+
+def checkMetrics(checks, buffer = 0, now = None):
+    """Count checks by state and acknowledgement, and the overdue checks. The checks are counted in blocks of
+    COLUMN_BLOCK so a check that has to be counted one at a time only slows down its own block.
+
+    Args:
+        checks (iterable): check objects from the Icinga API with last_check_result, acknowledgement,
+            last_check and check_interval attributes
+        buffer (float, optional): seconds a check can be past its next check before it is overdue. Defaults to 0.
+        now (float, optional): timestamp to test overdue against. Defaults to None (now).
+
+    Returns:
+        dict: metrics, see emptyMetrics
+    """
+    if now is None:
+        now = datetime.now().timestamp()
+    checks = checks if isinstance(checks, list) else list(checks)
+    metrics = emptyMetrics()
+    for start in range(0, len(checks), COLUMN_BLOCK):
+        block = checks[start:start + COLUMN_BLOCK]
+        try:
+            block_metrics = _columnMetrics(block, buffer, now)
+        except ValueError as e:
+            logger.debug(f"Counting checks {start}-{start + len(block)} one at a time, {e}")
+            block_metrics = checkMetricsLoop(block, buffer, now)
+        for label, counts in block_metrics.items():
+            for key, count in counts.items():
+                metrics[label][key] += count
+    return metrics
+
+
+def _columnMetrics(checks, buffer, now):
+    try:
+        states, acks, last_checks, intervals = checkColumns(checks)
+        codes = bytes(map(STATE_CODES.get, map(int, states), repeat(INVALID_CODE)))
+    except OverflowError as e:
+        raise ValueError(f"a state isn't a number: {e}")
+    if not math.isfinite(sum(acks)):
+        raise ValueError("an acknowledgement isn't a number")
+
+    metrics = emptyMetrics()
+    acknowledged = bytes(map(operator.ge, acks, repeat(1)))
+    # State code, plus 4 when acknowledged, so each cell of the state x acknowledgement matrix is one count()
+    cells = bytes(map(operator.add, codes, map(operator.mul, acknowledged, repeat(4))))
+    for code, label in enumerate(STATE_LABELS):
+        metrics[label]['acknowledged_total'] = cells.count(code + 4)
+        metrics[label]['total'] = cells.count(code) + metrics[label]['acknowledged_total']
+    metrics['total']['total'] = len(cells)
+    metrics['total']['acknowledged_total'] = acknowledged.count(1)
+
+    overdue = bytes(map(operator.lt, map(operator.add, last_checks, intervals), repeat(now - buffer)))
+    metrics['overdue']['total'] = overdue.count(1)
+    metrics['overdue']['acknowledged_total'] = sum(compress(acknowledged, overdue))
+    return metrics
+
+
+def checkMetricsLoop(checks, buffer = 0, now = None):
+    """Count checks one at a time, see checkMetrics. Handles any value the API can return, a check that can't
+    be counted is logged and counted as invalid.
+
+    Returns:
+        dict: metrics, see emptyMetrics
+    """
+    if now is None:
+        now = datetime.now().timestamp()
+    metrics = emptyMetrics()
+    for check in checks:
+        check_last = None
+        check_interval = None
+        check_ackd = None
+        try:
+            metrics['total']['total'] += 1
+            check_attrs = check.get('attrs', {})
+            last_check_result = check_attrs.get('last_check_result', {})
+            check_state = None
+            if last_check_result is not None:
+                check_state = last_check_result.get('state', None)
+            check_ackd = check_attrs.get('acknowledgement', None)
+            check_last = check_attrs.get('last_check', None)
+            check_interval = check_attrs.get('check_interval', None)
+
+            if check_state is not None and int(check_state) in range(0, 3):
+                metrics_label = STATE_LABELS[int(check_state)]
+            else:
+                metrics_label = 'invalid'
+
+            metrics[metrics_label]['total'] += 1
+            if check_ackd is not None and int(check_ackd) >= 1:
+                metrics['total']['acknowledged_total'] += 1
+                metrics[metrics_label]['acknowledged_total'] += 1
+
+        except Exception as e:
+            metrics['invalid']['total'] += 1
+            logger.warning(f"Error {e} for metrics on check\n{check}")
+
+        try:
+            # Overdue metrics
+            if check_last == '-1' or (isinstance(check_last, (int, float)) and isinstance(check_interval, (int, float)) and ((check_last + check_interval + buffer) < now)):
+                metrics['overdue']['total'] += 1
+                if check_ackd is not None and int(check_ackd) >= 1:
+                    metrics['overdue']['acknowledged_total'] += 1
+        except Exception as e:
+            logger.warning(f"Error {e} for overdue metrics on check\n{check}")
+    return metrics
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Persistent check executor for the python plugins
+#
+# Each check normally starts a new interpreter, imports loguru, requests, etc., runs the plugin and exits.
+# The executor does the imports and compiles the plugins once, then forks a worker for every check request
+# received on a unix socket. The worker starts from the warm interpreter so only the check itself is run, and
+# because each check gets its own process the module level `plugin` objects and `exit()` calls work as normal.
+#
+# To use:
+# - run check_executor.py (the daemon) as the same user icinga runs checks as
+# - call checks via check_executor_client.py <plugin> <args...>, the client runs the plugin directly if the
+#   executor isn't available
+#
+# Protocol (one request per connection, both sides are a single line of JSON):
+# - request:  {"plugin": "check_vast.py", "argv": ["-s", "..."], "env": {...}, "timeout": 60}
+# - response: {"exit_code": 0, "stdout": "...", "stderr": "...", "output": "...", "perfdata": "..."}
+
+import ast
+import importlib
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import time
+import traceback
+
+from contextlib import redirect_stdout, redirect_stderr
+from loguru import logger
+
+DEFAULT_SOCKET = '/run/icinga2/check_executor.sock'
+DEFAULT_TIMEOUT = 60
+PRELOAD_MODULES = ['lib.util', 'lib.httpclient', 'lib.icinga', 'lib.api', 'lib.jsonarg']
+
+STATE_UNKNOWN = 3
+
+
+def split_perfdata(stdout):
+    """Split plugin output into the message and the perfdata
+
+    Args:
+        stdout (str): output printed by the plugin
+
+    Returns:
+        tuple: (str, str) the message and the perfdata (empty if there isn't any)
+    """
+    output, seperator, perfdata = stdout.rstrip('\n').rpartition('|')
+    if not seperator:
+        return (perfdata, "")
+    return (output, perfdata.strip())
+
+
+class PluginCache:
+    def __init__(self, plugin_dir, plugins = None):
+        self.plugin_dir = os.path.abspath(plugin_dir)
+        self._code = {}
+
+        if self.plugin_dir not in sys.path:
+            sys.path.insert(0, self.plugin_dir)
+        for module in PRELOAD_MODULES:
+            self._import(module)
+
+        if plugins is None:
+            plugins = sorted(f for f in os.listdir(self.plugin_dir) if f.endswith('.py'))
+        for plugin in plugins:
+            try:
+                self.load(plugin)
+            except Exception as e:
+                logger.warning(f"Unable to preload plugin {plugin}: {e}")
+
+    def _import(self, module):
+        try:
+            importlib.import_module(module)
+            return True
+        except Exception as e:
+            logger.debug(f"Unable to preload module {module}: {e}")
+            return False
+
+    def _path(self, plugin):
+        # Only plugins in the plugin dir can be run
+        return os.path.join(self.plugin_dir, os.path.basename(plugin))
+
+    def load(self, plugin):
+        """Compile a plugin and import everything it imports so the workers don't have to
+
+        Args:
+            plugin (str): plugin file name in the plugin dir
+
+        Returns:
+            code: compiled plugin
+        """
+        path = self._path(plugin)
+        with open(path, 'r') as fh:
+            source = fh.read()
+        tree = ast.parse(source, path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    self._import(alias.name)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                self._import(node.module)
+            elif isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'lazyImport' and node.args and isinstance(node.args[0], ast.Constant):
+                # Lazy imports are only deferred in a normal run, the workers should get them for free
+                self._import(node.args[0].value)
+        code = compile(tree, path, 'exec')
+        self._code[os.path.basename(plugin)] = (os.stat(path).st_mtime, code)
+        logger.info(f"Preloaded plugin {path}")
+        return code
+
+    def get(self, plugin):
+        path = self._path(plugin)
+        cached = self._code.get(os.path.basename(plugin))
+        # Recompile if the plugin has changed since it was loaded
+        if cached is None or cached[0] != os.stat(path).st_mtime:
+            return self.load(plugin)
+        return cached[1]
+
+
+class CheckRunner:
+    def __init__(self, plugins: PluginCache, timeout = DEFAULT_TIMEOUT):
+        self.plugins = plugins
+        self.timeout = timeout
+
+    @staticmethod
+    def _timeout(signum, frame):
+        raise TimeoutError("check timed out")
+
+    def run(self, request):
+        """Run a check request, this replaces the process environment so it must be run in a worker process
+
+        Args:
+            request (dict): plugin, argv, env and timeout for the check
+
+        Returns:
+            dict: exit_code, stdout, stderr, output and perfdata of the check
+        """
+        plugin = str(request.get('plugin', ''))
+        argv = [str(arg) for arg in request.get('argv', [])]
+        env = request.get('env', None)
+        timeout = int(request.get('timeout', self.timeout))
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        exit_code = 0
+        start = time.monotonic()
+        try:
+            code = self.plugins.get(plugin)
+        except Exception as e:
+            logger.error(f"Unable to load plugin {plugin}: {e}")
+            return self._response(STATE_UNKNOWN, f"UNKNOWN: Unable to load plugin {plugin}: {e}\n", "")
+
+        path = self.plugins._path(plugin)
+        sys.argv = [path] + argv
+        if env is not None:
+            os.environ.clear()
+            os.environ.update({str(k): str(v) for k, v in env.items()})
+
+        signal.signal(signal.SIGALRM, self._timeout)
+        signal.alarm(timeout)
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                exec(code, {'__name__': '__main__', '__file__': path, '__builtins__': __builtins__})
+        except SystemExit as e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                stderr.write(f"{e.code}\n")
+                exit_code = 1
+        except TimeoutError:
+            stdout.write(f"UNKNOWN: {plugin} timed out after {timeout} seconds\n")
+            exit_code = STATE_UNKNOWN
+        except Exception:
+            stderr.write(traceback.format_exc())
+            exit_code = STATE_UNKNOWN
+        finally:
+            signal.alarm(0)
+
+        # The worker leaves with os._exit so the plugin's atexit handlers never run, finish its timing here
+        util = sys.modules.get('lib.util')
+        if util is not None:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                util.finishTiming()
+
+        logger.info(f"Ran {plugin} with exit code {exit_code} in {time.monotonic() - start:.3f}s")
+        return self._response(exit_code, stdout.getvalue(), stderr.getvalue())
+
+    @staticmethod
+    def _response(exit_code, stdout, stderr):
+        output, perfdata = split_perfdata(stdout)
+        return {
+            "exit_code": exit_code,
+            "stdout": stdout,
+            "stderr": stderr,
+            "output": output,
+            "perfdata": perfdata
+        }
+
+
+class CheckRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict):
+                raise ValueError("request is not a JSON object")
+            response = self.server.runner.run(request)
+        except Exception as e:
+            logger.error(f"Invalid check request: {e}")
+            response = CheckRunner._response(STATE_UNKNOWN, f"UNKNOWN: Invalid check request: {e}\n", "")
+        self.wfile.write((json.dumps(response) + "\n").encode())
+        # The worker leaves with os._exit, write the log records a queued sink still holds first
+        logger.complete()
+
+
+class CheckExecutor(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server that forks a worker per check from the preloaded interpreter"""
+
+    def __init__(self, socket_path, runner: CheckRunner, max_workers = 40, socket_mode = 0o660):
+        self.runner = runner
+        self.max_children = max_workers
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, CheckRequestHandler)
+        os.chmod(socket_path, socket_mode)
+        logger.info(f"Check executor listening on {socket_path} with {max_workers} workers")
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Shared HTTP client for the python plugins
+#
+# All clients in a process share one requests Session (per retry/pool setting), so connections are pooled and
+# kept alive between requests, eg getCheckResults then processCheckResult reuse the same TLS connection.
+# Every request gets a connect and read timeout, connection errors and 502/503/504 responses are retried with
+# jittered exponential backoff. Auth is anything requests accepts (tuple, HTTPBasicAuth, ...) or BearerAuth and
+# HeaderAuth below.
+#
+# If a requests cache has been installed (lib.util.initRequestsCache) before the first request the shared
+# session is a cached session.
+
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util.retry import Retry
+from loguru import logger
+
+DEFAULT_TIMEOUT = (5, 30)           # (connect, read) seconds
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5               # seconds, doubled for each retry then jittered
+DEFAULT_POOL_HOSTS = 10             # hosts to keep a connection pool for
+DEFAULT_POOL_SIZE = 10              # connections kept alive per host
+RETRY_STATUS = (502, 503, 504)
+
+_sessions = {}
+_sessionsLock = threading.Lock()
+
+
+class JitteredRetry(Retry):
+    """Retry with full jitter, a random backoff between 0 and the exponential backoff, so checks that
+    failed together don't retry together
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+class BearerAuth(AuthBase):
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f"Bearer {self.token}"
+        return request
+
+
+class HeaderAuth(AuthBase):
+    """Auth sent as a single header, eg an api key or a token that already includes its scheme"""
+
+    def __init__(self, header, value):
+        self.header = header
+        self.value = value
+
+    def __call__(self, request):
+        request.headers[self.header] = self.value
+        return request
+
+
+def getSession(retries = DEFAULT_RETRIES, backoff = DEFAULT_BACKOFF, pool_hosts = DEFAULT_POOL_HOSTS, pool_size = DEFAULT_POOL_SIZE):
+    """Get the process wide session for these retry and pool settings, creating it on first use
+
+    Args:
+        retries (int, optional): retries for connection errors and 502/503/504 responses. Defaults to DEFAULT_RETRIES.
+        backoff (float, optional): backoff factor in seconds. Defaults to DEFAULT_BACKOFF.
+        pool_hosts (int, optional): number of hosts to keep a connection pool for. Defaults to DEFAULT_POOL_HOSTS.
+        pool_size (int, optional): connections kept alive per host. Defaults to DEFAULT_POOL_SIZE.
+
+    Returns:
+        requests.Session: shared session
+    """
+    # requests.Session is replaced when a requests cache is installed, a new session is made so it is cached
+    key = (retries, backoff, pool_hosts, pool_size, requests.Session)
+    with _sessionsLock:
+        session = _sessions.get(key)
+        if session is None:
+            retry = JitteredRetry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                                  status_forcelist=RETRY_STATUS, respect_retry_after_header=True, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+            logger.debug(f"New http session with {retries} retries, backoff {backoff}, {pool_size} connections for {pool_hosts} hosts")
+    return session
+
+
+class HttpClient:
+    """Requests with the shared session and this client's base url, headers, auth, timeout and verify
+
+    Args:
+        base_url (str, optional): prefixed to relative urls. Defaults to ''.
+        headers (dict, optional): headers sent with every request. Defaults to None.
+        auth (optional): any requests auth, eg (user, password), BearerAuth(token). Defaults to None.
+        timeout (tuple, optional): (connect, read) timeout in seconds. Defaults to DEFAULT_TIMEOUT.
+        verify (bool, optional): verify the server certificate. Defaults to False.
+        retries, backoff, pool_hosts, pool_size: see getSession
+    """
+
+    def __init__(self, base_url = '', headers = None, auth = None, timeout = DEFAULT_TIMEOUT, verify = False, retries = DEFAULT_RETRIES,
+                 backoff = DEFAULT_BACKOFF, pool_hosts = DEFAULT_POOL_HOSTS, pool_size = DEFAULT_POOL_SIZE):
+        self.base_url = str(base_url or '').rstrip('/')
+        self.headers = dict(headers or {})
+        self.auth = auth
+        self.timeout = timeout
+        self.verify = verify
+        self._sessionArgs = (retries, backoff, pool_hosts, pool_size)
+
+    @property
+    def session(self):
+        return getSession(*self._sessionArgs)
+
+    def url(self, url):
+        if self.base_url and not url.startswith(('http://', 'https://')):
+            return f"{self.base_url}/{url.lstrip('/')}"
+        return url
+
+    def request(self, method, url, headers = None, **kwargs):
+        """Send a request, exceptions are left to the caller as with requests
+
+        Args:
+            method (str): http method
+            url (str): absolute url or relative to base_url
+            headers (dict, optional): headers for this request, added to the client headers. Defaults to None.
+            **kwargs: passed on to requests, eg params, json, data, timeout
+
+        Returns:
+            requests.Response: the response
+        """
+        kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', self.verify)
+        return self.session.request(method, self.url(url), headers={**self.headers, **(headers or {})}, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
@@ -1,17 +1,83 @@
 
-import requests
 from requests.auth import HTTPBasicAuth
 from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import codecs
+import re
+import time
 
 from loguru import logger
 from lib.util import logError
-from json import loads
+from lib.httpclient import HttpClient, DEFAULT_TIMEOUT, DEFAULT_POOL_SIZE
+from json import loads, JSONDecoder, JSONDecodeError
 
 import urllib3
 # because certificates cannot be verified
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+STREAM_CHUNK_SIZE = 65536
+DEFAULT_BULK_WORKERS = 10
+RESULTS_PREFIX = re.compile(r'\s*\{\s*"results"\s*:\s*\[')
+_decoder = JSONDecoder()
+
+
+def iterResults(chunks):
+    """Incrementally decode an Icinga API {"results": [...]} document, yielding each result as soon as it has
+    been read so the whole document is never held in memory
+
+    Args:
+        chunks (iterable): bytes chunks of the document, eg response.iter_content()
+
+    Raises:
+        ValueError: the document isn't a results document or it ended early
+
+    Yields:
+        dict: each item of results
+    """
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = None  # position of the next result in the buffer, None until the start of the results list is found
+    eof = False
+    while True:
+        if pos is None:
+            match = RESULTS_PREFIX.match(buffer)
+            if match:
+                pos = match.end()
+                continue
+            if eof or '[' in buffer or len(buffer) > 4096:
+                # Probably an error document, eg {"error": 404, "status": "..."}
+                for chunk in chunks:
+                    buffer += text.decode(chunk)
+                raise ValueError(f"not a results document: {buffer[:500]}")
+        else:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] == ']':
+                    return
+                try:
+                    result, pos = _decoder.raw_decode(buffer, pos)
+                    yield result
+                    continue
+                except JSONDecodeError as e:
+                    # Most likely the result isn't complete yet, read more and try again
+                    if eof:
+                        raise ValueError(f"invalid results document: {e}")
+            if eof:
+                raise ValueError("results document ended early")
+            buffer = buffer[pos:]
+            pos = 0
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer += text.decode(b'', final=True)
+        else:
+            buffer += text.decode(chunk)
+
 class Icinga:
-    def __init__(self, server, user, password):
+    def __init__(self, server, user, password, timeout = DEFAULT_TIMEOUT):
         logger.info(f"init Icinga object")
         self.server = server.rstrip('/')
         self.__user = user
@@ -20,6 +86,8 @@ class Icinga:
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
+        # Pooled keep-alive connections shared with any other client in the process
+        self.__client = HttpClient(auth=HTTPBasicAuth(self.__user, self.__password), timeout=timeout)
         logger.debug(f"Icinga object properties: server={self.server}, user={self.__user}")
 
     def get(self, url, decode_json = False):
@@ -32,9 +100,9 @@ class Icinga:
         try:
             logger.debug(f"Request to {url} using {reqtype}\n")
             if reqtype == 'GET':
-                response = requests.get(url=url, headers=self.__headers, auth = HTTPBasicAuth(self.__user, self.__password), verify=False)
+                response = self.__client.get(url, headers=self.__headers)
             elif reqtype == 'POST':
-                response = requests.post(url=url, headers=self.__headers, auth = HTTPBasicAuth(self.__user, self.__password), json=payload, verify=False)
+                response = self.__client.post(url, headers=self.__headers, json=payload)
             else:
                 logger.error(f"Icinga request not GET or POST, this shouldn't happen.")
             logger.debug(f"Icinga {reqtype} response {response}")
@@ -67,28 +135,110 @@ class Icinga:
             url = f"{url}&{k}={v}" 
         return url
 
-    def getCheckResults(self, obj_type, filter):
-        """_summary_
+    def _objectsPayload(self, filter = None, attrs = None, joins = None):
+        payload = {}
+        if filter is not None:
+            payload["filter"] = filter
+        if attrs is not None:
+            payload["attrs"] = list(attrs)
+        if joins is not None:
+            payload["joins"] = list(joins)
+        return payload
+
+    def getCheckResults(self, obj_type, filter, attrs = None, joins = None):
+        """Get check result objects as a list, see iterCheckResults
 
         Args:
-            type (string): object type to get ['services', 'hosts']
-            filter (_type_): filter required to get services or hosts
+            obj_type (string): object type to get ['services', 'hosts']
+            filter (string): filter required to get services or hosts
+            attrs (list, optional): only return these attributes, eg ['last_check_result', 'acknowledgement']. Defaults to None (all attributes).
+            joins (list, optional): joined object attributes to return, eg ['host.address']. Defaults to None.
 
         Returns:
             array: array of check result objects
-        """        
-        checks = []
-        url = url = f"{self.server}/v1/objects/{obj_type}"
-        payload = {}
+        """
+        return list(self.iterCheckResults(obj_type, filter, attrs, joins))
+
+    def iterCheckResults(self, obj_type, filter, attrs = None, joins = None, raise_errors = False):
+        """Get check result objects, decoding the response as it is read. Ask for only the attributes that are
+        needed, without attrs Icinga returns every attribute of every object.
+
+        Args:
+            obj_type (string): object type to get ['services', 'hosts']
+            filter (string): filter required to get services or hosts
+            attrs (list, optional): only return these attributes, eg ['last_check_result', 'acknowledgement']. Defaults to None (all attributes).
+            joins (list, optional): joined object attributes to return, eg ['host.address']. Defaults to None.
+            raise_errors (bool, optional): raise request and decode errors instead of logging them and stopping. Defaults to False.
+
+        Yields:
+            dict: check result object
+        """
+        url = f"{self.server}/v1/objects/{obj_type}"
+        payload = self._objectsPayload(filter, attrs, joins)
+        headers = {**self.__headers, 'X-HTTP-Method-Override': "GET"}
+        logger.debug(f"iterCheckResults payload: {payload}, headers: {headers}")
+        try:
+            response = self.__client.post(url, headers=headers, json=payload, stream=True)
+        except Exception as e:
+            logger.error(f"Icinga request error for {url}: {e}")
+            if raise_errors:
+                raise
+            return
+
+        count = 0
+        with response:
+            if response.status_code not in [200,201,202,300,301]:
+                logger.error(f"Icinga request bad return code for {url}. Response code: {response.status_code}\n Response text: \n{response.text}")
+                if raise_errors:
+                    raise ValueError(f"Icinga request bad return code for {url}: {response.status_code}")
+                return
+            try:
+                for result in iterResults(response.iter_content(chunk_size=STREAM_CHUNK_SIZE)):
+                    count += 1
+                    yield result
+            except Exception as e:
+                logger.error(f"Icinga request parse error for {url} after {count} results: {e}")
+                if raise_errors:
+                    raise
+        logger.info(f"Icinga {obj_type} returned {count} results")
+
+    def eventStream(self, types, queue, filter = None, timeout = None):
+        """Subscribe to the Icinga event stream
+
+        # object ApiUser "username" {
+        #         permissions = [ "events/*", "objects/query/*" ]
+        # }
+
+        Args:
+            types (list): event types, eg ['CheckResult', 'StateChange']
+            queue (string): unique name for the subscription
+            filter (string, optional): filter for the events, eg 'event.host=="web1"'. Defaults to None.
+            timeout (tuple, optional): (connect, read) timeout in seconds, a read timeout ends a stream that has
+                gone quiet. Defaults to the client timeout.
+
+        Raises:
+            ValueError: the subscription was refused
+
+        Returns:
+            tuple: (requests.Response, generator) the open response, close it to end the stream, and the events as dicts
+        """
+        url = f"{self.server}/v1/events"
+        payload = {"types": list(types), "queue": queue}
         if filter is not None:
             payload["filter"] = filter
-        self.__headers['X-HTTP-Method-Override'] = "GET"
-        logger.debug(f"getCheckResults payload: {payload}, headers: {self.__headers}")
-        result = self.post(url, payload, True)
-        del self.__headers['X-HTTP-Method-Override']
-        if result is not None and "results" in result:
-            checks = result["results"]
-        return checks
+        logger.info(f"Icinga event stream {url} for {', '.join(types)} as queue {queue}")
+        response = self.__client.post(url, headers=self.__headers, json=payload, stream=True, timeout=timeout or self.__client.timeout)
+        if response.status_code != 200:
+            text = response.text
+            response.close()
+            raise ValueError(f"Icinga event stream refused, response code: {response.status_code} {text}")
+
+        def events():
+            # One JSON event per line
+            for line in response.iter_lines(chunk_size=1024):
+                if line:
+                    yield loads(line)
+        return (response, events())
 
     def processServiceCheckResult(self, host, service, status, message, perfdata = None, command_endpoint = None):
         filter = f'host.name=="{host}" && service.name=="{service}"'
@@ -98,7 +248,7 @@ class Icinga:
         filter = f'host.name=="{host}"'
         return self.processCheckResult("Host", filter, status, message, perfdata, command_endpoint)
 
-    def processCheckResult(self, type, filter, status, message, perfdata = None, command_endpoint = None):
+    def _checkResultPayload(self, type, filter, status, message, perfdata = None, command_endpoint = None):
         # object ApiUser "username" {
         #         password = "password"
         #         permissions = [ "actions/process-check-result" ]
@@ -113,7 +263,6 @@ class Icinga:
         #    "performance_data": ["pl=100%;80;100;0"],                                                          # Optional
         #    "check_source": "example.localdomain",                                                             # Optional. Usually the name of the command_endpoint
         #}        
-        url = f"{self.server}/v1/actions/process-check-result"
         ## Required fields
         payload = {
             "type": type,
@@ -128,17 +277,20 @@ class Icinga:
         # The name of the command endpoint if required
         if command_endpoint is not None:
             payload['check_source'] = command_endpoint
-        logger.info(f"Icinga check result to url: {url} with filter {filter}")
-        logger.debug(f"Icinga check result to url: {url} with payload {payload}")
+        return payload
 
-        # Send the check results
-        result = self.post(url, payload, True)
+    def _checkResultStatus(self, result):
+        """Split a process-check-result response into the success and error messages
 
-        # Process response and return the result 
-        # Additional logging result details
+        Args:
+            result (dict|str): decoded response, or the response text if it wasn't JSON
+
+        Returns:
+            tuple: (list, list) success messages and error messages
+        """
         check_results = []
         errors = []
-        if "results" in result:
+        if isinstance(result, dict) and "results" in result:
             for check in result['results']:
                 if 'status' in check:
                     if check['status'].startswith("Successfully processed check result for object"):
@@ -146,16 +298,97 @@ class Icinga:
                     else:
                         errors.append(check['status'])
                 else:
-                    errors.append[check]
+                    errors.append(str(check))
+        elif isinstance(result, dict) and "status" in result:
+            # Error document, eg {"error": 404, "status": "No objects found."}
+            errors.append(f"{result.get('error', '')} {result['status']}".strip())
         else:
-            errors.append(result)
+            errors.append(str(result))
+        return (check_results, errors)
+
+    def processCheckResult(self, type, filter, status, message, perfdata = None, command_endpoint = None):
+        url = f"{self.server}/v1/actions/process-check-result"
+        payload = self._checkResultPayload(type, filter, status, message, perfdata, command_endpoint)
+        logger.info(f"Icinga check result to url: {url} with filter {filter}")
+        logger.opt(lazy=True).debug("Icinga check result to url: {} with payload {}", lambda: url, lambda: payload)
+
+        # Send the check results
+        result = self.post(url, payload, True)
+
+        # Process response and return the result 
+        # Additional logging result details
+        check_results, errors = self._checkResultStatus(result)
         if check_results:
             logger.info(f"Icinga recheck success for {type} with filter {filter}: {', '.join(check_results)}")
         if errors:
             logger.error(f"Icinga recheck errors for {type} with filter {filter}: {', '.join(errors)}")
         return result
 
+    def processCheckResults(self, results, workers = DEFAULT_BULK_WORKERS, command_endpoint = None):
+        """Submit many passive check results concurrently, at most workers requests are in flight at once and
+        each worker keeps its connection alive for the next result
+
+        Args:
+            results (iterable): (host, service, status, message, perfdata) tuples, service None for a host check result
+            workers (int, optional): concurrent requests. Defaults to DEFAULT_BULK_WORKERS.
+            command_endpoint (str, optional): check_source for every result. Defaults to None.
 
+        Returns:
+            dict: submitted, succeeded and failed counts, seconds, rate (results per second) and results, a list of
+                {"host", "service", "success", "status"} in the same order as the input
+        """
+        workers = max(1, int(workers))
+        url = f"{self.server}/v1/actions/process-check-result"
+        # A pool per worker, the default pool would discard the extra connections
+        client = HttpClient(auth=self.__client.auth, timeout=self.__client.timeout, pool_size=max(workers, DEFAULT_POOL_SIZE))
+
+        def submit(item):
+            host, service, status, message, perfdata = item
+            if service is None:
+                payload = self._checkResultPayload("Host", f'host.name=="{host}"', status, message, perfdata, command_endpoint)
+            else:
+                payload = self._checkResultPayload("Service", f'host.name=="{host}" && service.name=="{service}"', status, message, perfdata, command_endpoint)
+            try:
+                response = client.post(url, headers=self.__headers, json=payload)
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = f"{response.status_code} {response.text}"
+                check_results, errors = self._checkResultStatus(result)
+            except Exception as e:
+                check_results, errors = ([], [str(e)])
+            success = bool(check_results) and not errors
+            return {"host": host, "service": service, "success": success, "status": ', '.join(errors or check_results)}
+
+        submitted = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for item in results:
+                # Don't read more of the input than can be sent, it may be a generator
+                if len(pending) >= workers * 2:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(submit, tuple(item))
+                submitted.append(future)
+                pending.add(future)
+        seconds = time.monotonic() - start
+
+        summary = {
+            "submitted": len(submitted),
+            "succeeded": 0,
+            "failed": 0,
+            "seconds": seconds,
+            "rate": len(submitted) / seconds if seconds > 0 else 0,
+            "results": [future.result() for future in submitted]
+        }
+        for result in summary['results']:
+            if result['success']:
+                summary['succeeded'] += 1
+            else:
+                summary['failed'] += 1
+                logger.error(f"Icinga check result failed for {result['host']} {result['service'] or ''}: {result['status']}")
+        logger.info(f"Icinga submitted {summary['submitted']} check results with {workers} workers in {seconds:.2f}s ({summary['rate']:.1f}/s), {summary['failed']} failed")
+        return summary
 
     def rescheduleCheck(self, host):
         # object ApiUser "username" {
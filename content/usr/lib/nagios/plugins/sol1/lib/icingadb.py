@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Aggregate queries of the IcingaDB database for the meta checks
+#
+# Counting states through the REST API moves every object into python to compute a few integers. IcingaDB
+# keeps the same state in SQL (host/service with host_state/service_state), so the counts can be a GROUP BY in
+# the database instead. Icinga filters are translated to SQL, only the common forms are supported:
+# - host.name, service.name, display_name, zone, command_endpoint, check_command ==/!= a string
+# - service.state, check_interval ==, !=, <, >, <=, >= a number
+# - match("web*", host.name), "linux-servers" in host.groups, host.vars.os == "Linux" (top level vars only)
+# - &&, ||, !, ( ), true, false
+# Anything else raises FilterNotSupported and the caller should use the REST API.
+#
+# Connections are kept per database for the life of the process, so batch and groups runs share one.
+#
+# To use:
+# - icingadb = IcingaDB('mysql', host='localhost', name='icingadb', user='icingadb', password='...')
+# - metrics = icingadb.statusMetrics('services', 'host.name=="web1"', buffer=60)
+
+import json
+import threading
+import time
+
+from loguru import logger
+from lib.checkmetrics import emptyMetrics, STATE_LABELS
+from lib.icingafilter import FilterNotSupported, LITERALS, _tokenize
+
+DEFAULT_TIMEOUT = 30
+# FROM clause per type, the object is always o, its state st and a service's host h
+TABLES = {
+    'services': "service o JOIN host h ON h.id = o.host_id LEFT JOIN service_state st ON st.service_id = o.id",
+    'hosts': "host o LEFT JOIN host_state st ON st.host_id = o.id"
+}
+# Most overdue ties are listed by name as the API path lists them
+NAME_ORDER = {'services': "h.name DESC, o.name DESC", 'hosts': "o.name DESC"}
+# Filter field -> (column, numeric), the object's own columns
+COLUMNS = {
+    'name': ('{alias}.name', False),
+    'display_name': ('{alias}.display_name', False),
+    'zone': ('{alias}.zone_name', False),
+    'command_endpoint': ('{alias}.command_endpoint_name', False),
+    'check_command': ('{alias}.checkcommand_name', False),
+    'check_interval': ('{alias}.check_interval', True),
+    'state': ('st.soft_state', True)
+}
+HOST_COLUMNS = dict(COLUMNS, address=('{alias}.address', False))
+# Seconds past last_check + check_interval + buffer (the parameters are now and buffer). last_update is in
+# milliseconds and an object that was never checked has no state, -1 as the API's last_check is
+OVERDUE_SECONDS = "(? - (COALESCE(st.last_update, -1000) / 1000.0 + o.check_interval + ?))"
+# soft_state of an object that hasn't been checked yet
+PENDING_STATE = 99
+ACKNOWLEDGED = "CASE WHEN st.is_acknowledged IS NOT NULL AND st.is_acknowledged <> 'n' THEN 1 ELSE 0 END"
+ORDERED = {'<': '<', '>': '>', '<=': '<=', '>=': '>='}
+SWAPPED = {'<': '>', '>': '<', '<=': '>=', '>=': '<=', '==': '==', '!=': '!='}
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class IcingaDBError(Exception):
+    pass
+
+
+class SqlFilter:
+    """An Icinga filter translated to a SQL condition on the IcingaDB tables, see TABLES for the aliases
+
+    Args:
+        filter (str): Icinga filter expression, None for everything
+        obj_type (str): 'services' or 'hosts'
+        dialect (str, optional): 'mysql' or 'sqlite'. Defaults to 'mysql'.
+
+    Raises:
+        FilterNotSupported: the filter can't be translated
+    """
+
+    def __init__(self, filter, obj_type = 'services', dialect = 'mysql'):
+        if obj_type not in TABLES:
+            raise FilterNotSupported(f"filters for {obj_type} can't be translated to IcingaDB")
+        self.filter = filter
+        self.obj_type = obj_type
+        # MySQL compares names without case by default, Icinga doesn't
+        self._binary = ' COLLATE utf8mb4_bin' if dialect == 'mysql' else ''
+        self.params = []
+        if not filter or not filter.strip():
+            self.where = '1=1'
+            return
+        self._tokens = _tokenize(filter)
+        self._pos = 0
+        self.where = self._or()
+        if self._pos != len(self._tokens):
+            raise FilterNotSupported(f"unexpected '{self._tokens[self._pos][1]}' in filter")
+        del self._tokens
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _take(self, value = None):
+        kind, token = self._peek()
+        if kind is None:
+            raise FilterNotSupported("unexpected end of filter")
+        if value is not None and token != value:
+            raise FilterNotSupported(f"expected '{value}' in filter but found '{token}'")
+        self._pos += 1
+        return (kind, token)
+
+    def _or(self):
+        parts = [self._and()]
+        while self._peek() == ('op', '||'):
+            self._take()
+            parts.append(self._and())
+        return parts[0] if len(parts) == 1 else '(' + ' OR '.join(parts) + ')'
+
+    def _and(self):
+        parts = [self._not()]
+        while self._peek() == ('op', '&&'):
+            self._take()
+            parts.append(self._not())
+        return parts[0] if len(parts) == 1 else '(' + ' AND '.join(parts) + ')'
+
+    def _not(self):
+        if self._peek() == ('op', '!'):
+            self._take()
+            return f"(NOT {self._not()})"
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._operand()
+        kind, token = self._peek()
+        if kind == 'op' and (token in ['==', '!='] or token in ORDERED):
+            self._take()
+            right = self._operand()
+            if left[0] == 'literal' and right[0] != 'literal':
+                left, right, token = right, left, SWAPPED[token]
+            return self._compare(left, token, right)
+        if kind == 'name' and token == 'in':
+            self._take()
+            right = self._operand()
+            if left[0] != 'literal' or right[0] != 'groups':
+                raise FilterNotSupported("only \"group\" in host.groups or service.groups can be translated")
+            return self._member(right[1], left[1])
+        if left[0] == 'condition':
+            return left[1]
+        if left[0] == 'literal' and isinstance(left[1], bool):
+            return '1=1' if left[1] else '1=0'
+        raise FilterNotSupported("only comparisons can be translated")
+
+    def _operand(self):
+        kind, token = self._take()
+        if kind in ['string', 'number']:
+            return ('literal', token)
+        if kind == 'op' and token == '(':
+            condition = self._or()
+            self._take(')')
+            return ('condition', condition)
+        if kind == 'name' and token in LITERALS:
+            if LITERALS[token] is None:
+                raise FilterNotSupported("null can't be translated")
+            return ('literal', LITERALS[token])
+        if kind == 'name' and token == 'match':
+            return ('condition', self._match())
+        if kind == 'name' and token == 'regex':
+            raise FilterNotSupported("regex() can't be translated, the database's regular expressions aren't Icinga's")
+        if kind == 'name':
+            return self._field(token)
+        raise FilterNotSupported(f"'{token}' can't be translated")
+
+    def _field(self, path):
+        scope, _, rest = path.partition('.')
+        keys = rest.split('.') if rest else []
+        if not keys:
+            raise FilterNotSupported(f"unsupported field '{path}'")
+        if self.obj_type == 'services' and scope == 'service':
+            alias, columns = 'o', COLUMNS
+        elif scope == 'host':
+            alias, columns = ('h' if self.obj_type == 'services' else 'o'), HOST_COLUMNS
+        else:
+            raise FilterNotSupported(f"unsupported field '{path}' for {self.obj_type}")
+        if self.obj_type == 'services' and scope == 'service' and keys == ['host_name']:
+            return ('column', 'h.name', False)
+        if keys[0] == 'groups' and len(keys) == 1:
+            return ('groups', (scope, alias))
+        if keys[0] == 'vars' and len(keys) == 2:
+            return ('var', (scope, alias, keys[1]))
+        if len(keys) == 1 and keys[0] in columns:
+            # The state of the host of a service is in host_state, which isn't joined
+            if keys[0] == 'state' and alias == 'h':
+                raise FilterNotSupported("host.state can't be translated for services")
+            column, numeric = columns[keys[0]]
+            return ('column', column.format(alias=alias), numeric)
+        raise FilterNotSupported(f"unsupported field '{path}'")
+
+    def _compare(self, left, op, right):
+        if right[0] != 'literal':
+            raise FilterNotSupported("only comparisons with a literal can be translated")
+        value = right[1]
+        if left[0] == 'var' and op in ['==', '!=']:
+            scope, alias, name = left[1]
+            # customvar.value is the JSON of the value
+            self.params.extend([name, json.dumps(value, ensure_ascii=False, separators=(',', ':'))])
+            exists = f"EXISTS (SELECT 1 FROM {scope}_customvar ocv JOIN customvar cv ON cv.id = ocv.customvar_id WHERE ocv.{scope}_id = {alias}.id AND cv.name = ? AND cv.value = ?{self._binary})"
+            return exists if op == '==' else f"(NOT {exists})"
+        if left[0] != 'column':
+            raise FilterNotSupported("only comparisons of a field can be translated")
+        _, column, numeric = left
+        if op in ORDERED:
+            if not numeric or isinstance(value, (bool, str)):
+                raise FilterNotSupported(f"only numbers can be compared with {op}")
+            self.params.append(value)
+            return f"{column} {ORDERED[op]} ?"
+        if isinstance(value, bool) or numeric != (not isinstance(value, str)):
+            raise FilterNotSupported(f"{column} can't be compared with {value!r}")
+        self.params.append(value)
+        collate = '' if numeric else self._binary
+        if op == '==':
+            return f"{column} = ?{collate}"
+        return f"({column} IS NULL OR {column} <> ?{collate})"
+
+    def _member(self, group, name):
+        scope, alias = group
+        self.params.append(name)
+        return f"EXISTS (SELECT 1 FROM {scope}group_member gm JOIN {scope}group g ON g.id = gm.{scope}group_id WHERE gm.{scope}_id = {alias}.id AND g.name = ?{self._binary})"
+
+    def _match(self):
+        self._take('(')
+        kind, pattern = self._take()
+        if kind != 'string':
+            raise FilterNotSupported("match() needs a string pattern")
+        self._take(',')
+        field = self._operand()
+        self._take(')')
+        if field[0] != 'column' or field[2]:
+            raise FilterNotSupported("match() can only be translated for a name")
+        # Icinga match() only has * and ?, ! escapes LIKE's own wildcards as a backslash is an escape in MySQL strings
+        like = pattern.replace('!', '!!').replace('%', '!%').replace('_', '!_').replace('*', '%').replace('?', '_')
+        self.params.append(like)
+        return f"{field[1]} LIKE ?{self._binary} ESCAPE '!'"
+
+
+class IcingaDB:
+    """Read only aggregate queries of the IcingaDB database
+
+    Args:
+        db_type (str, optional): 'mysql' or 'sqlite' (for testing). Defaults to 'mysql'.
+        host (str, optional): Defaults to 'localhost'.
+        port (int, optional): Defaults to 3306.
+        name (str, optional): database name, or the file for sqlite. Defaults to 'icingadb'.
+        user (str, optional): Defaults to 'icingadb'.
+        password (str, optional): Defaults to ''.
+        timeout (int, optional): seconds to wait for the connection and each query. Defaults to DEFAULT_TIMEOUT.
+    """
+
+    def __init__(self, db_type = 'mysql', host = 'localhost', port = 3306, name = 'icingadb', user = 'icingadb', password = '', timeout = DEFAULT_TIMEOUT):
+        self.db_type = db_type
+        self.host = host
+        self.port = port
+        self.name = name
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+
+    def connection(self):
+        """The connection to the database, shared by every IcingaDB for the same database in this process"""
+        key = (self.db_type, self.host, self.port, self.name, self.user)
+        with _connections_lock:
+            db = _connections.get(key)
+            if db is not None and self.db_type == 'mysql':
+                try:
+                    db.ping(reconnect=True)
+                except Exception as e:
+                    logger.debug(f"IcingaDB connection lost, reconnecting: {e}")
+                    db = None
+            if db is None:
+                db = self._connect()
+                _connections[key] = db
+            return db
+
+    def _connect(self):
+        if self.db_type == 'sqlite':
+            import sqlite3
+            db = sqlite3.connect(self.name, timeout=self.timeout, check_same_thread=False)
+            # Icinga match() is case sensitive
+            db.execute('PRAGMA case_sensitive_like = ON')
+            return db
+        import pymysql
+        return pymysql.connect(host=self.host, port=self.port, user=self.user, password=self.password, database=self.name,
+                               connect_timeout=min(self.timeout, 10), read_timeout=self.timeout, charset='utf8mb4')
+
+    def sqlFilter(self, obj_type, filter):
+        """Translate a filter, see SqlFilter
+
+        Raises:
+            FilterNotSupported: the filter can't be translated
+        """
+        return SqlFilter(filter, obj_type, self.db_type)
+
+    def _query(self, sql, params):
+        if self.db_type == 'mysql':
+            # pymysql uses format style placeholders, the SQL never has a literal % as values are parameters
+            sql = sql.replace('?', '%s')
+        start = time.monotonic()
+        try:
+            cursor = self.connection().cursor()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        except FilterNotSupported:
+            raise
+        except Exception as e:
+            raise IcingaDBError(f"IcingaDB query failed: {e}")
+        logger.debug(f"IcingaDB query returned {len(rows)} rows in {time.monotonic() - start:.3f}s")
+        return rows
+
+    @staticmethod
+    def _text(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _objectName(self, obj_type):
+        return "h.name, o.name" if obj_type == 'services' else "o.name, NULL"
+
+    def statusMetrics(self, obj_type, filter, buffer = 0, now = None):
+        """Count objects by state and acknowledgement, and the overdue objects, with the same rules as
+        lib.checkmetrics.checkMetrics
+
+        Raises:
+            FilterNotSupported: the filter can't be translated
+            IcingaDBError: the query failed
+
+        Returns:
+            dict: metrics, see lib.checkmetrics.emptyMetrics
+        """
+        now = time.time() if now is None else now
+        sqlFilter = self.sqlFilter(obj_type, filter)
+        rows = self._query(f"""
+            SELECT st.soft_state, {ACKNOWLEDGED}, COUNT(*), SUM(CASE WHEN {OVERDUE_SECONDS} > 0 THEN 1 ELSE 0 END)
+              FROM {TABLES[obj_type]}
+             WHERE {sqlFilter.where}
+             GROUP BY st.soft_state, {ACKNOWLEDGED}
+        """, [now, buffer] + sqlFilter.params)
+
+        metrics = emptyMetrics()
+        for state, is_acknowledged, count, overdue in rows:
+            label = STATE_LABELS[int(state)] if state is not None and 0 <= int(state) <= 2 else 'invalid'
+            count = int(count)
+            overdue = int(overdue or 0)
+            metrics[label]['total'] += count
+            metrics['total']['total'] += count
+            metrics['overdue']['total'] += overdue
+            if int(is_acknowledged):
+                metrics[label]['acknowledged_total'] += count
+                metrics['total']['acknowledged_total'] += count
+                metrics['overdue']['acknowledged_total'] += overdue
+        return metrics
+
+    def checkResults(self, obj_type, filter, state = None):
+        """Name, state and output of the objects that have a check result, in the shape of the API objects
+
+        Args:
+            obj_type (str): 'services' or 'hosts'
+            filter (str): Icinga filter
+            state (int, optional): only objects in this state. Defaults to None.
+
+        Raises:
+            FilterNotSupported: the filter can't be translated
+            IcingaDBError: the query failed
+
+        Returns:
+            list: [{"name", "attrs": {"last_check_result": {"state", "output"}}}]
+        """
+        sqlFilter = self.sqlFilter(obj_type, filter)
+        params = list(sqlFilter.params)
+        where = f"({sqlFilter.where}) AND st.soft_state IS NOT NULL AND st.soft_state <> {PENDING_STATE}"
+        if state is not None:
+            where += " AND st.soft_state = ?"
+            params.append(int(state))
+        rows = self._query(f"SELECT {self._objectName(obj_type)}, st.soft_state, st.output FROM {TABLES[obj_type]} WHERE {where}", params)
+        checks = []
+        for host, service, soft_state, output in rows:
+            name = f"{self._text(host)}!{self._text(service)}" if service is not None else self._text(host)
+            checks.append({"name": name, "attrs": {"last_check_result": {"state": int(soft_state), "output": self._text(output) or ''}}})
+        return checks
+
+    def names(self, obj_type, filter):
+        """Names of the objects, the name attribute so the service name without the host for services
+
+        Raises:
+            FilterNotSupported: the filter can't be translated
+            IcingaDBError: the query failed
+
+        Returns:
+            list: names
+        """
+        sqlFilter = self.sqlFilter(obj_type, filter)
+        rows = self._query(f"SELECT o.name FROM {TABLES[obj_type]} WHERE {sqlFilter.where}", sqlFilter.params)
+        return [self._text(name) for name, in rows]
+
+    def overdue(self, obj_type, filter, buffer = 0, limit = 20, now = None):
+        """Overdue objects counted by zone and endpoint, and the most overdue, as the overdue mode counts them
+
+        Args:
+            obj_type (str): 'services' or 'hosts'
+            filter (str): Icinga filter
+            buffer (float, optional): seconds past the next check before an object is overdue. Defaults to 0.
+            limit (int, optional): number of the most overdue objects to return, 0 for all. Defaults to 20.
+            now (float, optional): Defaults to None (now).
+
+        Raises:
+            FilterNotSupported: the filter can't be translated
+            IcingaDBError: the query failed
+
+        Returns:
+            tuple: (int, dict) objects matching the filter and {"total", "acknowledged_total", "zones",
+                "endpoints", "objects": [(seconds overdue, name)]}
+        """
+        now = time.time() if now is None else now
+        sqlFilter = self.sqlFilter(obj_type, filter)
+        zone = "COALESCE(NULLIF(o.zone_name, ''), 'none')"
+        endpoint = "COALESCE(NULLIF(st.check_source, ''), NULLIF(o.command_endpoint_name, ''), 'unknown')"
+        # Grouped on the columns of a derived table, MySQL doesn't see two expressions with placeholders as the same
+        rows = self._query(f"""
+            SELECT zone, endpoint, acknowledged, late, COUNT(*)
+              FROM (SELECT {zone} AS zone, {endpoint} AS endpoint, {ACKNOWLEDGED} AS acknowledged,
+                           CASE WHEN {OVERDUE_SECONDS} > 0 THEN 1 ELSE 0 END AS late
+                      FROM {TABLES[obj_type]}
+                     WHERE {sqlFilter.where}) objects
+             GROUP BY zone, endpoint, acknowledged, late
+        """, [now, buffer] + sqlFilter.params)
+
+        check_count = 0
+        overdue = {"total": 0, "acknowledged_total": 0, "zones": {}, "endpoints": {}, "objects": []}
+        for zone_name, endpoint_name, is_acknowledged, is_late, count in rows:
+            count = int(count)
+            check_count += count
+            if not int(is_late):
+                continue
+            zone_name = self._text(zone_name)
+            endpoint_name = self._text(endpoint_name)
+            overdue['total'] += count
+            if int(is_acknowledged):
+                overdue['acknowledged_total'] += count
+            overdue['zones'][zone_name] = overdue['zones'].get(zone_name, 0) + count
+            overdue['endpoints'][endpoint_name] = overdue['endpoints'].get(endpoint_name, 0) + count
+
+        if overdue['total']:
+            sql = f"SELECT {self._objectName(obj_type)}, {OVERDUE_SECONDS} AS late FROM {TABLES[obj_type]} WHERE ({sqlFilter.where}) AND {OVERDUE_SECONDS} > 0 ORDER BY late DESC, {NAME_ORDER[obj_type]}"
+            # The select list's placeholders come before the WHERE's
+            params = [now, buffer] + sqlFilter.params + [now, buffer]
+            if limit:
+                sql += " LIMIT ?"
+                params.append(int(limit))
+            for host, service, late in self._query(sql, params):
+                name = f"{self._text(host)}!{self._text(service)}" if service is not None else self._text(host)
+                overdue['objects'].append((float(late), name))
+        return (check_count, overdue)
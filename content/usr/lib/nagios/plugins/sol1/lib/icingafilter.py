@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Compile Icinga API filter expressions into python predicates
+#
+# Lets a check fetch a set of objects once and split it client side with the filters it would otherwise have
+# sent in separate requests. Only the common forms of the Icinga filter language are supported:
+# - host.name=="web1", service.name!="ping", host.vars.os=="Linux", service.vars.x.y==3, <, >, <=, >=
+# - match("web*", host.name), regex("^web[0-9]+$", host.name)
+# - "linux-servers" in host.groups
+# - &&, ||, !, ( ), true, false, null
+# Anything else raises FilterNotSupported, so the caller can send that filter to the API instead.
+#
+# The filter is compiled to a single python expression, and the field == "value" terms that every match must
+# have are kept in `equalities` so partition() can index the objects by that field first.
+#
+# To use:
+# - icingaFilter = compileFilter('match("web*", host.name) && service.name=="http"', 'services')
+# - getCheckResults('services', icingaFilter.filter, attrs=icingaFilter.attrs, joins=icingaFilter.joins)
+# - matching = [check for check in checks if icingaFilter(check)]
+
+import re
+
+TOKENS = re.compile(r'''\s*(?:
+      (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<op>&&|\|\||==|!=|<=|>=|<|>|!|\(|\)|,)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+    )''', re.VERBOSE)
+LITERALS = {'true': True, 'false': False, 'null': None}
+ORDERED = {'<': '_lt', '>': '_gt', '<=': '_le', '>=': '_ge'}
+_EMPTY = {}
+
+
+class FilterNotSupported(ValueError):
+    pass
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _sub(value, key):
+    return value.get(key) if isinstance(value, dict) else None
+
+
+def _contains(container, value):
+    return isinstance(container, (list, dict)) and value in container
+
+
+def _test(test, value):
+    return isinstance(value, str) and test(value) is not None
+
+
+# Functions the compiled expressions can use
+NAMESPACE = {
+    '_EMPTY': _EMPTY,
+    '_sub': _sub,
+    '_contains': _contains,
+    '_test': _test,
+    '_lt': lambda a, b: _number(a) and _number(b) and a < b,
+    '_gt': lambda a, b: _number(a) and _number(b) and a > b,
+    '_le': lambda a, b: _number(a) and _number(b) and a <= b,
+    '_ge': lambda a, b: _number(a) and _number(b) and a >= b
+}
+
+
+def _glob(pattern):
+    # Icinga match() only has * and ?
+    return re.compile('^' + re.escape(pattern).replace('\\*', '.*').replace('\\?', '.') + '$', re.DOTALL)
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKENS.match(text, pos)
+        if match is None or match.end() == pos:
+            raise FilterNotSupported(f"unable to parse filter at '{text[pos:pos + 20]}'")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = value[1:-1].encode('latin-1', 'backslashreplace').decode('unicode_escape')
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def fieldValue(obj, field):
+    """Value of a field of an object from the Icinga API
+
+    Args:
+        obj (dict): object from the Icinga API
+        field (tuple): ('attrs' or 'joins', (key, ...)) as in IcingaFilter.equalities
+
+    Returns:
+        any: the value, None if it is missing
+    """
+    source, keys = field
+    value = obj.get(source)
+    for key in keys:
+        value = _sub(value, key)
+    return value
+
+
+class IcingaFilter:
+    """A compiled filter, call it with an object from the Icinga API to test it
+
+    Args:
+        filter (str): Icinga filter expression
+        obj_type (str): object type the filter is for ['services', 'hosts']
+
+    Raises:
+        FilterNotSupported: the filter uses something that can't be compiled
+    """
+
+    def __init__(self, filter, obj_type = 'services'):
+        if obj_type not in ['services', 'hosts']:
+            raise FilterNotSupported(f"filters for {obj_type} can't be compiled")
+        self.filter = filter
+        self.obj_type = obj_type
+        self.attrs = set()      # object attributes the filter reads
+        self.joins = set()      # joined attributes the filter reads, eg host.vars for a service
+        self._namespace = dict(NAMESPACE)
+        self._tokens = _tokenize(filter)
+        self._pos = 0
+        expression, equalities = self._or()
+        if self._pos != len(self._tokens):
+            raise FilterNotSupported(f"unexpected '{self._tokens[self._pos][1]}' in filter")
+        del self._tokens
+        # field -> value that every matching object has, see fieldValue
+        self.equalities = dict(equalities)
+        self.expression = expression
+        self._predicate = eval(f"lambda obj: bool({expression})", self._namespace)
+
+    def __call__(self, obj):
+        return self._predicate(obj)
+
+    # Parser, the expression methods return (python expression, [(field, value), ...] equalities every match has)
+    # and _operand returns (python expression, ('field', field), ('literal', value), ('group', equalities) or None)
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _take(self, value = None):
+        kind, token = self._peek()
+        if kind is None:
+            raise FilterNotSupported("unexpected end of filter")
+        if value is not None and token != value:
+            raise FilterNotSupported(f"expected '{value}' in filter but found '{token}'")
+        self._pos += 1
+        return (kind, token)
+
+    def _or(self):
+        parts = [self._and()]
+        while self._peek() == ('op', '||'):
+            self._take()
+            parts.append(self._and())
+        if len(parts) == 1:
+            return parts[0]
+        return ('(' + ' or '.join(expression for expression, _ in parts) + ')', [])
+
+    def _and(self):
+        parts = [self._not()]
+        while self._peek() == ('op', '&&'):
+            self._take()
+            parts.append(self._not())
+        if len(parts) == 1:
+            return parts[0]
+        return ('(' + ' and '.join(expression for expression, _ in parts) + ')', [eq for _, eqs in parts for eq in eqs])
+
+    def _not(self):
+        if self._peek() == ('op', '!'):
+            self._take()
+            expression, _ = self._not()
+            return (f"(not {expression})", [])
+        return self._comparison()
+
+    def _comparison(self):
+        left, left_kind = self._operand()
+        kind, token = self._peek()
+        if kind == 'op' and token in ['==', '!=']:
+            self._take()
+            right, right_kind = self._operand()
+            equalities = []
+            if token == '==' and left_kind and right_kind:
+                kinds = dict([left_kind, right_kind])
+                if 'field' in kinds and 'literal' in kinds:
+                    equalities.append((kinds['field'], kinds['literal']))
+            return (f"({left} {token} {right})", equalities)
+        if kind == 'op' and token in ORDERED:
+            self._take()
+            right, _ = self._operand()
+            return (f"{ORDERED[token]}({left}, {right})", [])
+        if kind == 'name' and token == 'in':
+            self._take()
+            right, _ = self._operand()
+            return (f"_contains({right}, {left})", [])
+        return (left, left_kind[1] if left_kind and left_kind[0] == 'group' else [])
+
+    def _operand(self):
+        kind, token = self._take()
+        if kind in ['string', 'number']:
+            return (repr(token), ('literal', token))
+        if kind == 'op' and token == '(':
+            expression, equalities = self._or()
+            self._take(')')
+            return (expression, ('group', equalities))
+        if kind == 'name' and token in LITERALS:
+            return (repr(LITERALS[token]), ('literal', LITERALS[token]))
+        if kind == 'name' and token in ['match', 'regex']:
+            return (self._call(token), None)
+        if kind == 'name':
+            field = self._field(token)
+            return (self._fieldExpression(field), ('field', field))
+        raise FilterNotSupported(f"unexpected '{token}' in filter")
+
+    def _call(self, function):
+        self._take('(')
+        kind, pattern = self._take()
+        if kind != 'string':
+            raise FilterNotSupported(f"{function}() needs a string pattern")
+        self._take(',')
+        value, _ = self._operand()
+        self._take(')')
+        try:
+            compiled = _glob(pattern) if function == 'match' else re.compile(pattern)
+        except re.error as e:
+            raise FilterNotSupported(f"invalid {function}() pattern '{pattern}': {e}")
+        name = f"_re{len(self._namespace)}"
+        self._namespace[name] = compiled.match if function == 'match' else compiled.search
+        return f"_test({name}, {value})"
+
+    def _field(self, path):
+        scope, _, rest = path.partition('.')
+        keys = rest.split('.') if rest else []
+        if not keys:
+            raise FilterNotSupported(f"unsupported field '{path}'")
+        if self.obj_type == 'services' and scope == 'service':
+            self.attrs.add(keys[0])
+            return ('attrs', tuple(keys))
+        if self.obj_type == 'services' and scope == 'host' and keys == ['name']:
+            self.attrs.add('host_name')
+            return ('attrs', ('host_name',))
+        if self.obj_type == 'services' and scope == 'host':
+            self.joins.add(f"host.{keys[0]}")
+            return ('joins', tuple(['host'] + keys))
+        if self.obj_type == 'hosts' and scope == 'host':
+            self.attrs.add(keys[0])
+            return ('attrs', tuple(keys))
+        raise FilterNotSupported(f"unsupported field '{path}' for {self.obj_type}")
+
+    def _fieldExpression(self, field):
+        source, keys = field
+        expression = f"(obj.get({source!r}) or _EMPTY).get({keys[0]!r})"
+        for key in keys[1:]:
+            expression = f"_sub({expression}, {key!r})"
+        return expression
+
+
+def compileFilter(filter, obj_type = 'services'):
+    """Compile an Icinga filter expression, see IcingaFilter
+
+    Args:
+        filter (str): Icinga filter expression
+        obj_type (str, optional): object type the filter is for ['services', 'hosts']. Defaults to 'services'.
+
+    Raises:
+        FilterNotSupported: the filter uses something that can't be compiled
+
+    Returns:
+        IcingaFilter: callable filter
+    """
+    return IcingaFilter(filter, obj_type)
+
+
+def partition(objects, filters):
+    """Split objects between filters. Objects are indexed by the fields of the filters' equalities so each
+    filter is only tested against the objects that could match it.
+
+    Args:
+        objects (list): objects from the Icinga API
+        filters (list): IcingaFilter
+
+    Returns:
+        list: list of the matching objects for each filter, in the same order as filters
+    """
+    indexes = {}
+    results = []
+    for icingaFilter in filters:
+        candidates = objects
+        if icingaFilter.equalities:
+            # Prefer a field that has already been indexed
+            field = next((field for field in icingaFilter.equalities if field in indexes), next(iter(icingaFilter.equalities)))
+            if field not in indexes:
+                index = {}
+                for obj in objects:
+                    try:
+                        index.setdefault(fieldValue(obj, field), []).append(obj)
+                    except TypeError:
+                        # lists and dicts are never equal to a literal
+                        pass
+                indexes[field] = index
+            candidates = indexes[field].get(icingaFilter.equalities[field], [])
+        results.append([obj for obj in candidates if icingaFilter(obj)])
+    return results
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Read the live state of hosts and services from the IcingaDB Redis
+#
+# Icinga 2's icingadb feature keeps the config and the current state of every object in icingadb-redis (port
+# 6380 in this stack), as JSON in hashes keyed by the object id:
+# - icinga:host, icinga:service                                  name, host_id, zone_name, check_interval, ...
+# - icinga:host:state, icinga:service:state                      soft_state, output, performance_data, ...
+# - icinga:hostgroup, icinga:hostgroup:member (and servicegroup)  group names and members
+# - icinga:customvar, icinga:host:customvar, icinga:service:customvar
+#
+# getCheckResults() reads the config hashes in one pipelined round trip, matches the filter (lib.icingafilter)
+# against them and then reads the state of only the matching objects, so a lookup doesn't wait for Icinga to
+# evaluate the filter against every object. The objects are returned in the shape of the Icinga API.
+#
+# The == terms of the filter are tested against the raw JSON first, so most configs aren't decoded. Vars and
+# groups are only read when the filter or attrs use them.
+#
+# To use:
+# - redis = IcingaRedis('localhost', 6380)
+# - checks = redis.getCheckResults('services', 'host.name=="web1"', attrs=['name', 'host_name', 'last_check_result'])
+
+import json
+import re
+import threading
+
+from loguru import logger
+from lib.icingafilter import compileFilter
+
+DEFAULT_PORT = 6380
+DEFAULT_TIMEOUT = 5
+# Object ids per HMGET
+STATE_BATCH = 1000
+# Attributes that can be read, anything else has to come from the API
+REDIS_ATTRS = {
+    'services': ['name', 'host_name', 'display_name', 'groups', 'vars', 'state', 'state_type', 'last_check_result', 'acknowledgement', 'last_check',
+                 'last_state_change', 'next_check', 'check_interval', 'zone', 'command_endpoint', 'check_command'],
+    'hosts': ['name', 'display_name', 'address', 'groups', 'vars', 'state', 'state_type', 'last_check_result', 'acknowledgement', 'last_check',
+              'last_state_change', 'next_check', 'check_interval', 'zone', 'command_endpoint', 'check_command']
+}
+STATE_ATTRS = ['state', 'state_type', 'last_check_result', 'acknowledgement', 'last_check', 'last_state_change', 'next_check']
+TYPES = {'services': 'service', 'hosts': 'host'}
+# One perfdata value, a label is quoted if it has spaces
+PERFDATA_ITEM = re.compile(r"(?:'(?:[^']|'')*'|[^\s'=]+)=\S*")
+# Values that can be found in the raw JSON as they are encoded, others are always decoded
+PLAIN_VALUE = re.compile(r'^[A-Za-z0-9 _.:@-]*$')
+HOST_ID = re.compile(rb'"host_id"\s*:\s*"([^"]*)"')
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class IcingaRedisError(Exception):
+    pass
+
+
+def _seconds(milliseconds, default = None):
+    return milliseconds / 1000 if isinstance(milliseconds, (int, float)) and milliseconds else default
+
+
+def _acknowledgement(value):
+    # Older Icinga writes a bool, newer the acknowledgement type (0 none, 1 normal, 2 sticky)
+    if isinstance(value, bool):
+        return 1 if value else 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    return {'y': 1, 'sticky': 2}.get(value, 0)
+
+
+def _stateType(value):
+    if isinstance(value, str):
+        return 1 if value == 'hard' else 0
+    return value
+
+
+def decodeAll(values):
+    """Decode a list of JSON documents with one call to the decoder, much faster than a call per document
+
+    Args:
+        values (list): JSON documents as bytes or str, None for a missing value
+
+    Returns:
+        list: the decoded values, {} for a missing one
+    """
+    values = [value if isinstance(value, bytes) else (value or '{}').encode() for value in values]
+    return json.loads(b'[' + b','.join(values) + b']') if values else []
+
+
+def checkResult(state):
+    """The last_check_result of an object from its IcingaDB state, None if it hasn't been checked
+
+    Args:
+        state (dict): decoded icinga:<type>:state value
+
+    Returns:
+        dict: {"state", "output", "performance_data", "check_source", "execution_end"} as in the API
+    """
+    soft_state = state.get('soft_state')
+    if soft_state is None or soft_state == 99 or not state.get('last_update'):
+        return None
+    output = state.get('output') or ''
+    if state.get('long_output'):
+        output += '\n' + state['long_output']
+    return {
+        "state": soft_state,
+        "output": output,
+        "performance_data": PERFDATA_ITEM.findall(state.get('performance_data') or ''),
+        "check_source": state.get('check_source') or '',
+        "execution_end": _seconds(state.get('last_update'))
+    }
+
+
+class IcingaRedis:
+    """Object lookups from the IcingaDB Redis
+
+    Args:
+        host (str, optional): Defaults to 'localhost'.
+        port (int, optional): Defaults to DEFAULT_PORT.
+        password (str, optional): Defaults to None.
+        timeout (int, optional): seconds to wait for the connection and each reply. Defaults to DEFAULT_TIMEOUT.
+    """
+
+    def __init__(self, host = 'localhost', port = DEFAULT_PORT, password = None, timeout = DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+
+    def connection(self):
+        """The Redis client, shared by every IcingaRedis for the same server in this process"""
+        key = (self.host, self.port)
+        with _connections_lock:
+            client = _connections.get(key)
+            if client is None:
+                try:
+                    import redis
+                except ImportError:
+                    raise IcingaRedisError("python3-redis is needed to read IcingaDB Redis")
+                client = redis.Redis(host=self.host, port=self.port, password=self.password, socket_timeout=self.timeout,
+                                     socket_connect_timeout=self.timeout)
+                _connections[key] = client
+            return client
+
+    def _execute(self, commands):
+        """Send commands in one round trip
+
+        Args:
+            commands (list): (command, *args) tuples
+
+        Returns:
+            list: a reply per command
+        """
+        try:
+            pipe = self.connection().pipeline(transaction=False)
+            for command in commands:
+                pipe.execute_command(*command)
+            return pipe.execute()
+        except IcingaRedisError:
+            raise
+        except Exception as e:
+            raise IcingaRedisError(f"IcingaDB Redis {self.host}:{self.port} failed: {e}")
+
+    @staticmethod
+    def _hash(reply):
+        # HGETALL replies are a dict with redis-py, a flat list with raw RESP
+        if isinstance(reply, dict):
+            return reply
+        return dict(zip(reply[::2], reply[1::2]))
+
+    def getCheckResults(self, obj_type, filter = None, attrs = None, joins = None):
+        """Objects matching a filter, as lib.icinga.Icinga.getCheckResults returns them
+
+        Args:
+            obj_type (str): 'services' or 'hosts'
+            filter (str, optional): Icinga filter. Defaults to None (everything).
+            attrs (list, optional): attributes to return, see REDIS_ATTRS. Defaults to None (all of them).
+            joins (list, optional): host.<attr> joins for services. Defaults to None.
+
+        Raises:
+            FilterNotSupported: the filter can't be compiled
+            IcingaRedisError: an attribute isn't in Redis or Redis can't be read
+
+        Returns:
+            list: {"name", "type", "attrs", "joins"} objects
+        """
+        if obj_type not in TYPES:
+            raise IcingaRedisError(f"{obj_type} can't be read from IcingaDB Redis")
+        attrs = list(attrs) if attrs else list(REDIS_ATTRS[obj_type])
+        joined = [join.split('.', 1)[1] if '.' in join else None for join in (joins or [])]
+        if obj_type != 'services' and joined:
+            raise IcingaRedisError("only services can have joins")
+        unsupported = [attr for attr in attrs if attr not in REDIS_ATTRS[obj_type]]
+        unsupported += [join for join in joined if join not in REDIS_ATTRS['hosts']]
+        if unsupported:
+            raise IcingaRedisError(f"{', '.join(str(attr) for attr in unsupported)} can't be read from IcingaDB Redis")
+
+        icingaFilter = compileFilter(filter, obj_type) if filter else None
+        filter_attrs = icingaFilter.attrs if icingaFilter else set()
+        filter_joins = {join.split('.', 1)[1] for join in icingaFilter.joins} if icingaFilter else set()
+        for attr in filter_attrs:
+            if attr not in REDIS_ATTRS[obj_type]:
+                raise IcingaRedisError(f"the filter uses {attr}, which can't be read from IcingaDB Redis")
+        for attr in filter_joins:
+            if attr not in REDIS_ATTRS['hosts']:
+                raise IcingaRedisError(f"the filter uses host.{attr}, which can't be read from IcingaDB Redis")
+        # Attributes needed before and after filtering
+        need = set(attrs) | filter_attrs
+        host_need = set(joined) | filter_joins
+
+        type_name = TYPES[obj_type]
+        scopes = {'host': host_need if obj_type == 'services' else need, 'service': need if obj_type == 'services' else set()}
+        keys = ['icinga:host', 'icinga:service'] if obj_type == 'services' else ['icinga:host']
+        if any('vars' in scope_need for scope_need in scopes.values()):
+            keys.append('icinga:customvar')
+        for scope, scope_need in scopes.items():
+            if 'vars' in scope_need:
+                keys.append(f'icinga:{scope}:customvar')
+            if 'groups' in scope_need:
+                keys += [f'icinga:{scope}group', f'icinga:{scope}group:member']
+        hashes = dict(zip(keys, [self._hash(reply) for reply in self._execute([('HGETALL', key) for key in keys])]))
+        hosts = hashes['icinga:host']
+        if not hosts:
+            raise IcingaRedisError("IcingaDB Redis has no hosts, is the icingadb feature enabled?")
+        configs = hashes[f'icinga:{type_name}']
+        customvars = self._customvars(hashes.get('icinga:customvar'))
+        host_vars = self._objectVars(hashes.get('icinga:host:customvar'), 'host_id', customvars)
+        host_groups = self._objectGroups(hashes.get('icinga:hostgroup'), hashes.get('icinga:hostgroup:member'), 'host')
+        own_vars = self._objectVars(hashes.get('icinga:service:customvar'), 'service_id', customvars) if obj_type == 'services' else host_vars
+        own_groups = self._objectGroups(hashes.get('icinga:servicegroup'), hashes.get('icinga:servicegroup:member'), 'service') if obj_type == 'services' else host_groups
+
+        # Decode and match the configs, the state is only read for the objects that match
+        candidates = self._candidates(configs, hosts, icingaFilter, own_vars, host_vars)
+        host_configs = {}
+
+        state_first = bool(filter_attrs & set(STATE_ATTRS))
+        objects = []
+        for object_id, config in candidates:
+            obj = {"name": None, "type": type_name.capitalize(), "attrs": self._configAttrs(config, own_vars.get(object_id), own_groups.get(object_id)), "joins": {}}
+            if obj_type == 'services':
+                host_id = config.get('host_id')
+                host = host_configs.get(host_id)
+                if host is None:
+                    host_config = hosts.get(host_id if isinstance(host_id, bytes) else str(host_id).encode())
+                    host = host_configs[host_id] = self._configAttrs(json.loads(host_config), host_vars.get(host_id), host_groups.get(host_id)) if host_config else {}
+                obj['attrs']['host_name'] = host.get('name')
+                obj['name'] = f"{host.get('name')}!{obj['attrs']['name']}"
+                obj['joins']['host'] = host
+            else:
+                obj['name'] = obj['attrs']['name']
+            objects.append((object_id, obj))
+
+        if state_first:
+            self._addStates(type_name, objects)
+        if icingaFilter:
+            objects = [(object_id, obj) for object_id, obj in objects if icingaFilter(obj)]
+        if not state_first and need & set(STATE_ATTRS):
+            self._addStates(type_name, objects)
+
+        results = []
+        for _, obj in objects:
+            result = {"name": obj['name'], "type": obj['type'], "attrs": {attr: obj['attrs'].get(attr) for attr in attrs}, "joins": {}}
+            if joined:
+                result['joins']['host'] = {attr: obj['joins']['host'].get(attr) for attr in joined}
+            results.append(result)
+        logger.debug(f"Read {len(results)} of {len(configs)} {obj_type} from IcingaDB Redis")
+        return results
+
+    def _candidates(self, configs, hosts, icingaFilter, own_vars, host_vars):
+        # Objects that could match the filter's == terms. Names are tested on the raw JSON before it is decoded,
+        # vars against the object's vars, which have already been read
+        needles = []
+        allowed = None      # object ids with the == vars
+        host_ids = None     # ids of the hosts a service can be on
+        for (source, keys), value in (icingaFilter.equalities.items() if icingaFilter else []):
+            if source == 'attrs' and len(keys) == 2 and keys[0] == 'vars':
+                ids = {object_id for object_id, vars in own_vars.items() if keys[1] in vars and vars[keys[1]] == value}
+                allowed = ids if allowed is None else allowed & ids
+            elif source == 'joins' and len(keys) == 3 and keys[1] == 'vars':
+                ids = {host_id for host_id, vars in host_vars.items() if keys[2] in vars and vars[keys[2]] == value}
+                host_ids = ids if host_ids is None else host_ids & ids
+            elif not isinstance(value, str) or not value or not PLAIN_VALUE.match(value):
+                continue
+            elif source == 'attrs' and keys in [('name',), ('display_name',), ('zone',), ('check_command',)]:
+                needles.append(json.dumps(value).encode())
+            elif source == 'attrs' and keys == ('host_name',):
+                ids = {host_id.decode() for host_id, config in hosts.items() if json.dumps(value).encode() in config and json.loads(config).get('name') == value}
+                host_ids = ids if host_ids is None else host_ids & ids
+        host_ids = {host_id.encode() for host_id in host_ids} if host_ids is not None else None
+        ids = []
+        raw = []
+        for object_id, config in configs.items():
+            object_id = object_id.decode() if isinstance(object_id, bytes) else object_id
+            if allowed is not None and object_id not in allowed:
+                continue
+            if any(needle not in config for needle in needles):
+                continue
+            if host_ids is not None:
+                host_id = HOST_ID.search(config)
+                if host_id is None or host_id.group(1) not in host_ids:
+                    continue
+            ids.append(object_id)
+            raw.append(config)
+        return list(zip(ids, decodeAll(raw)))
+
+    @staticmethod
+    def _configAttrs(config, vars = None, groups = None):
+        return {
+            "name": config.get('name'),
+            "display_name": config.get('display_name'),
+            "address": config.get('address'),
+            "zone": config.get('zone_name') or '',
+            "command_endpoint": config.get('command_endpoint_name') or '',
+            "check_command": config.get('checkcommand_name'),
+            "check_interval": config.get('check_interval'),
+            "vars": vars or {},
+            "groups": sorted(groups or [])
+        }
+
+    @staticmethod
+    def _customvars(customvars):
+        # customvar id -> (name, value), the value is JSON in the JSON
+        if customvars is None:
+            return {}
+        values = {}
+        for customvar_id, customvar in zip(customvars, decodeAll(list(customvars.values()))):
+            value = customvar.get('value')
+            try:
+                value = json.loads(value) if isinstance(value, str) else value
+            except ValueError:
+                pass
+            values[customvar_id.decode() if isinstance(customvar_id, bytes) else customvar_id] = (customvar.get('name'), value)
+        return values
+
+    @staticmethod
+    def _objectVars(rows, id_key, customvars):
+        # object id -> {name: value} from the object to customvar links
+        if rows is None:
+            return {}
+        objects = {}
+        for row in decodeAll(list(rows.values())):
+            customvar = customvars.get(row.get('customvar_id'))
+            if customvar is not None:
+                objects.setdefault(row.get(id_key), {})[customvar[0]] = customvar[1]
+        return objects
+
+    @staticmethod
+    def _objectGroups(groups, members, scope):
+        # object id -> [group name] from the group and member hashes
+        if groups is None or members is None:
+            return {}
+        names = {(group_id.decode() if isinstance(group_id, bytes) else group_id): group.get('name') for group_id, group in zip(groups, decodeAll(list(groups.values())))}
+        objects = {}
+        for member in decodeAll(list(members.values())):
+            name = names.get(member.get(f'{scope}group_id'))
+            if name is not None:
+                objects.setdefault(member.get(f'{scope}_id'), []).append(name)
+        return objects
+
+    def _addStates(self, type_name, objects):
+        commands = [('HMGET', f'icinga:{type_name}:state') + tuple(object_id for object_id, _ in objects[start:start + STATE_BATCH])
+                    for start in range(0, len(objects), STATE_BATCH)]
+        states = decodeAll([state for reply in (self._execute(commands) if commands else []) for state in reply])
+        for (_, obj), state in zip(objects, states):
+            attrs = obj['attrs']
+            attrs['last_check_result'] = checkResult(state)
+            soft_state = state.get('soft_state')
+            attrs['state'] = soft_state if soft_state is not None and soft_state != 99 else 0
+            attrs['state_type'] = _stateType(state.get('state_type'))
+            attrs['acknowledgement'] = _acknowledgement(state.get('is_acknowledged'))
+            attrs['last_check'] = _seconds(state.get('last_update'), -1)
+            attrs['last_state_change'] = _seconds(state.get('last_state_change'), 0)
+            attrs['next_check'] = _seconds(state.get('next_check'), 0)
@@ -9,9 +9,22 @@
 # - subparsers (e.g. mode) must have a dest passed in
 #
 # Features:
-# - use of minimal argparse methods: add_argument, add_subparsers & add_parser, parse_args as normal
+# - use of minimal argparse methods: add_argument, add_argument_group, add_mutually_exclusive_group,
+#   add_subparsers & add_parser, parse_args as normal, anything else (error, print_usage, prog...) is passed through
 # - allow required arguments to be passed in JSON instead of the normal way
 # - build example JSON string help
+# - batch mode (--batch), many argument sets in one process, see run_batch
+#
+# Batch mode:
+# - opt in with ArgumentParser(..., batch=True), only plugins that call run_batch should offer --batch
+# - ArgumentParser(..., batch_shared=[dest, ...]) lists the arguments every set shares, eg the connection the plugin sets
+#   up once. With --batch they are required on the command line (UNKNOWN if missing) and a set that has one is rejected
+# - the argument sets are read from stdin as NDJSON (one JSON object per line) or a JSON array of objects
+# - each set is applied over the command line arguments like --json and checked for required fields on its own
+# - run_batch(parser, args, check) calls check(set_args) for each set and prints one JSON result per line:
+#   {"index": 0, "id": ..., "exit_code": 0, "output": "...", "perfdata": "..."}, "id" is the set's "_id" if it has one
+# - a set that is invalid, raises or exits only fails that set
+# - things set up once by the plugin (login, connection pool) are shared by all the sets
 #
 # Limitations/TODO:
 # - you cannot pass the head of a subparser (e.g. "mode") in the JSON, you need to pass this as an argument
@@ -20,11 +33,21 @@
 # - this is not a subclass of argparse, it's a wrapper, any extra argparse functions will need to be wrapped here
 
 import argparse
+import copy
+import io
 import json
+import sys
+import traceback
+
+from contextlib import redirect_stdout
+
+STATE_UNKNOWN = 3
 
 class ArgumentParser:
 
     def __init__(self, *args, **kwargs):
+        self._batch = kwargs.pop('batch', False) # offer --batch, the plugin must call run_batch when it is set
+        self._batch_shared = set(kwargs.pop('batch_shared', ())) # dests that only come from the command line in batch mode
         if '_real_parser' in kwargs:
             real_parser = kwargs['_real_parser']
             del kwargs['_real_parser']
@@ -39,8 +62,24 @@ class ArgumentParser:
         self._tree = {} # any subparsers created, key is dest, value is dict with value => argparser object
         self._example_json = {} # build a JSON example for the help output
         self._required = {} # check that required arguments are passed either in JSON or individual switches/flags
+        self._actions = {} # all arguments by dest, used to convert JSON values
+
+    def __getattr__(self, name):
+        # Anything not wrapped goes to the real parser, e.g. error, print_usage, prog
+        if name == '_real_parser':
+            raise AttributeError(name)
+        return getattr(self._real_parser, name)
 
     def add_argument(self, *args, **kwargs):
+        return self._add_argument(self._real_parser, *args, **kwargs)
+
+    def add_argument_group(self, *args, **kwargs):
+        return ArgumentGroup(self, self._real_parser.add_argument_group(*args, **kwargs))
+
+    def add_mutually_exclusive_group(self, **kwargs):
+        return ArgumentGroup(self, self._real_parser.add_mutually_exclusive_group(**kwargs))
+
+    def _add_argument(self, container, *args, **kwargs):
         # If this argument is required, we can't pass that through to the underlying argparse
         # but we also need to keep track of it so we can enforce it ourselves in parse_args
         required = False
@@ -52,7 +91,8 @@ class ArgumentParser:
                     kwargs['help'] += (" *Required here or in --json*")
                 else:
                     kwargs['help'] = "*Required here or in --json*"
-        real_arg = self._real_parser.add_argument(*args, **kwargs)
+        real_arg = container.add_argument(*args, **kwargs)
+        self._actions[real_arg.dest] = real_arg
         if required:
             # add to the required hash
             self._required[real_arg.dest] = real_arg
@@ -63,6 +103,7 @@ class ArgumentParser:
             type_desc = f" ({real_arg.type.__name__})"
         #TODO add help for nargs, boolean, required etc
         self._example_json[real_arg.dest] = f"<{real_arg.dest}{type_desc}>"
+        return real_arg
 
     def add_subparsers(self, *args, **kwargs):
         # we make our own SubParser object which intercepts the add_parser calls and makes our own ArgumentParser wrapper object
@@ -77,9 +118,10 @@ class ArgumentParser:
         # This is where the real magic happens
         #
         # parse args as normal but in addition:
-        # - add the -J/--json argument automatically with a nice example in the help
+        # - add the -J/--json argument automatically with a nice example in the help, and --batch if the plugin opted in
         # - parse out the JSON and fill in the extra arguments
-        # - enforce that the required arguments are passed in either via JSON or traditionally
+        # - enforce that the required arguments are passed in either via JSON or traditionally,
+        #   in batch mode this is done for each argument set instead
 
         #
         # build json help
@@ -94,8 +136,10 @@ class ArgumentParser:
                     example[field] = sub_options[value]._example_json[field]
         json_example = json.dumps(example, sort_keys=True)
 
-        # add JSON argument
+        # add JSON and batch arguments
         self._real_parser.add_argument('-J', '--json', required=False, type=str, help=f"It is possible to parse in arguments as a json blob in combination with the other arguments, {json_example}")
+        if self._batch:
+            self._real_parser.add_argument('--batch', action='store_true', default=False, help="Read argument sets from stdin as NDJSON or a JSON array (same format as --json), run the check for each and print one JSON result per line")
 
         # real parsing offloaded to real argparse
         raw_args = self._real_parser.parse_args(*args, **kwargs)
@@ -103,39 +147,214 @@ class ArgumentParser:
         # extract the JSON and add/overwrite values
         cooked_args = raw_args
         if cooked_args.json:
+            json_string = cooked_args.json
             try:
-                json_args = json.loads(cooked_args.json)
+                json_args = json.loads(json_string)
                 delattr(cooked_args,'json') # disallow backdoor args
-                for arg in vars(cooked_args):
-                    if json_args and arg in json_args:
-                        setattr(cooked_args, arg, str(json_args[arg]))
+                self._apply_json(cooked_args, json_args)
             except Exception as error:
-                self._real_parser.error(f"The given JSON '{cooked_args.json}' could not be parsed: {error}")
+                self._real_parser.error(f"The given JSON '{json_string}' could not be parsed: {error}")
 
+        # check required fields have been given, in batch mode only the shared ones, the others can come from each argument set
+        if getattr(cooked_args, 'batch', False):
+            missing = self._missing(cooked_args, self._batch_shared)
+            if missing:
+                # no set can run, fail the whole batch like a check
+                self._real_parser.print_usage(sys.stderr)
+                print(f"UNKNOWN: The following fields are required with --batch: {','.join(missing)}")
+                sys.exit(STATE_UNKNOWN)
+        else:
+            missing = self._missing(cooked_args)
+            if missing:
+                self._real_parser.error(f"The following fields are required: {','.join(missing)}")
 
-        # check required fields have been given
-        required = self._required
+        # give the people what they want
+        return cooked_args
+
+    def _all(self, attr):
+        # merge a dict attribute of the trunk and every subparser
+        merged = dict(getattr(self, attr))
+        for subparser in self._tree:
+            for value in self._tree[subparser]:
+                merged.update(getattr(self._tree[subparser][value], attr))
+        return merged
+
+    @staticmethod
+    def _convert(action, value):
+        # JSON values are converted as they would be on the command line
+        if action.nargs == 0:
+            if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+                return _bool(value)
+            return value
+        convert = action.type or str
+        if isinstance(value, list):
+            converted = [convert(str(v)) for v in value]
+        else:
+            converted = convert(str(value))
+        for v in (converted if isinstance(converted, list) else [converted]):
+            if action.choices is not None and v not in action.choices:
+                raise ValueError(f"invalid choice for {action.dest}: {v!r}")
+        return converted
+
+    def _apply_json(self, cooked_args, json_args):
+        if not json_args:
+            return
+        if not isinstance(json_args, dict):
+            raise ValueError("arguments are not a JSON object")
+        actions = self._all('_actions')
+        for arg in vars(cooked_args):
+            if arg in json_args:
+                action = actions.get(arg)
+                setattr(cooked_args, arg, self._convert(action, json_args[arg]) if action else str(json_args[arg]))
+
+    def _missing(self, cooked_args, only = None):
+        required = dict(self._required)
 
         # check also required for subparsers
         for subparser in self._tree:
             sub_options = self._tree[subparser]
             for value in sub_options:
                 if getattr(cooked_args, subparser) == value: # if this is the path we are going down, check the requireds
-                    for field in sub_options[value]._required:
-                        required[field] = sub_options[value]._required[field]
+                    required.update(sub_options[value]._required)
         missing = []
         for field in required:
-            if getattr(cooked_args, field) is None:
-                missing_arg = self._required[field]
+            if only is not None and field not in only:
+                continue
+            if getattr(cooked_args, field, None) is None:
+                missing_arg = required[field]
                 missing_flags = '/'.join(missing_arg.option_strings)
                 missing_dest = missing_arg.dest
                 missing.append(f"{missing_flags}({missing_dest})")
+        return missing
 
-        if missing:
-            self._real_parser.error(f"The following fields are required: {','.join(missing)}")
+    def batch_args(self, args, stream = None):
+        """Read the argument sets for batch mode, each is applied over a copy of args and validated on its own
 
-        # give the people what they want
-        return cooked_args
+        Args:
+            args (Namespace): arguments from parse_args
+            stream (file, optional): where to read the argument sets from. Defaults to stdin.
+
+        Yields:
+            tuple: (int, Namespace, dict, str) index, arguments, the set as given and an error message (None if valid)
+        """
+        if stream is None:
+            # the plugins' exit() (site.Quitter) closes sys.stdin, read from our own file on the same fd
+            stream = open(sys.stdin.fileno(), 'r', closefd=False)
+        for index, entry in enumerate(_read_sets(stream)):
+            set_args = copy.copy(args)
+            error = None
+            try:
+                if isinstance(entry, Exception):
+                    raise entry
+                if not isinstance(entry, dict):
+                    raise ValueError("argument set is not a JSON object")
+                shared = sorted(self._batch_shared.intersection(entry))
+                if shared:
+                    raise ValueError(f"{','.join(shared)} can only be given on the command line, every set shares them")
+                self._apply_json(set_args, entry)
+                missing = self._missing(set_args)
+                if missing:
+                    error = f"The following fields are required: {','.join(missing)}"
+            except Exception as e:
+                error = f"Invalid argument set: {e}"
+            yield (index, set_args, entry if isinstance(entry, dict) else {}, error)
+
+class ArgumentGroup:
+    # wraps an argparse argument group or mutually exclusive group so required and the JSON example are tracked by the parser
+    def __init__(self, parser, real_group):
+        self._parser = parser
+        self._real_group = real_group
+
+    def __getattr__(self, name):
+        if name == '_real_group':
+            raise AttributeError(name)
+        return getattr(self._real_group, name)
+
+    def add_argument(self, *args, **kwargs):
+        return self._parser._add_argument(self._real_group, *args, **kwargs)
+
+    def add_mutually_exclusive_group(self, **kwargs):
+        return ArgumentGroup(self._parser, self._real_group.add_mutually_exclusive_group(**kwargs))
+
+def _bool(value):
+    # JSON true/false, or a string or number as it would be written in a config, eg "false" or 0
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        if value.strip().lower() in ('true', 'yes', 'on', '1'):
+            return True
+        if value.strip().lower() in ('false', 'no', 'off', '0', ''):
+            return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+def _read_sets(stream):
+    # a JSON array is read whole, NDJSON is read a line at a time so sets can be run as they arrive
+    first = stream.read(1)
+    while first and first.isspace():
+        first = stream.read(1)
+    if not first:
+        return
+    if first == '[':
+        try:
+            sets = json.loads(first + stream.read())
+        except ValueError as e:
+            yield e
+            return
+        for entry in sets:
+            yield entry
+        return
+    line = first + stream.readline()
+    while line:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield e
+        line = stream.readline()
+
+def run_batch(parser, args, check, stream = None, output = None):
+    """Run a check for each argument set and write one JSON result per line
+
+    Args:
+        parser (ArgumentParser): the parser args came from
+        args (Namespace): arguments from parse_args, the base for each set
+        check (function): called with the arguments for each set, prints the plugin output and exits like a normal run
+        stream (file, optional): where to read the argument sets from. Defaults to stdin.
+        output (file, optional): where to write the results. Defaults to stdout.
+
+    Returns:
+        int: number of argument sets run
+    """
+    output = output or sys.stdout
+    count = 0
+    for index, set_args, entry, error in parser.batch_args(args, stream):
+        captured = io.StringIO()
+        exit_code = 0
+        if error:
+            captured.write(f"UNKNOWN: {error}\n")
+            exit_code = STATE_UNKNOWN
+        else:
+            try:
+                with redirect_stdout(captured):
+                    check(set_args)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else STATE_UNKNOWN)
+            except Exception as e:
+                captured.write(f"UNKNOWN: {e}\n{traceback.format_exc()}")
+                exit_code = STATE_UNKNOWN
+
+        message, seperator, perfdata = captured.getvalue().rstrip('\n').rpartition('|')
+        if not seperator:
+            message, perfdata = perfdata, ''
+        result = {"index": index, "exit_code": exit_code, "output": message, "perfdata": perfdata.strip()}
+        if '_id' in entry:
+            result["id"] = entry['_id']
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+        count += 1
+    return count
 
 class SubParser:
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Lazy imports for heavy dependencies that only some modes of a plugin use
+#
+# To use:
+# - replace 'import humanize' with 'humanize = lazyImport("humanize")'
+# - replace 'from dateutil.parser import parse' with 'dateutil_parser = lazyImport("dateutil.parser")' and call dateutil_parser.parse
+#
+# The module is found straight away so a missing dependency still fails at start up like a normal import,
+# it is only loaded the first time one of its attributes is used.
+
+import importlib.util
+import sys
+
+
+def lazyImport(name):
+    """Import a module that is only loaded when first used
+
+    Args:
+        name (str): full module name, e.g. 'dateutil.parser'
+
+    Raises:
+        ImportError: the module can't be found
+
+    Returns:
+        module: the module, loaded on first attribute access
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Parse monitoring plugin performance data and aggregate it in one pass
+#
+# Perfdata is 'label'=value[UOM];[warn];[crit];[min];[max], labels with spaces are quoted and a quote in a
+# quoted label is doubled. A single string can hold several space seperated values, and the Icinga API can also
+# return PerfdataValue objects instead of strings, both are parsed to Perfdata tuples. Parsed strings are cached,
+# the same perfdata is often returned by many checks.
+#
+# PerfdataAggregate keeps the count, sum, min, max and a QuantileSketch per label, so the sum, mean and
+# percentiles of a label across any number of checks are found in one pass with memory bounded by the number
+# of labels.
+#
+# To use:
+# - for perfdata in parsePerfdata(check['attrs']['last_check_result']['performance_data']): ...
+# - aggregate = PerfdataAggregate(); aggregate.addAll(parsePerfdata(...)); aggregate.stats('load1')['p95']
+# - parseRange('10:20').alert(25) is True, Nagios range semantics
+# - f"{formatLabel('my disk')}=5MB" is 'my disk'=5MB, labels are quoted for output when they need it
+
+from collections import namedtuple
+from functools import lru_cache
+import math
+import re
+
+PARSE_CACHE_SIZE = 4096
+NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+PERFDATA = re.compile(r"""\s*(?:'(?P<quoted>(?:[^']|'')*)'|(?P<label>[^'=\s][^=\s]*))
+    =(?P<value>""" + NUMBER + r"""|U)(?P<uom>[^;\s]*)
+    (?:;(?P<warn>[^;\s]*))?(?:;(?P<crit>[^;\s]*))?(?:;(?P<min>[^;\s]*))?(?:;(?P<max>[^;\s]*))?;*""", re.VERBOSE)
+VALUE = re.compile(r'(?P<value>' + NUMBER + r'|U)(?P<uom>[^;\s]*)$')
+RANGE = re.compile(r'^(?P<inside>@)?(?:(?P<start>~|' + NUMBER + r')?:)?(?P<end>' + NUMBER + r')?$')
+AGGREGATES = ['sum', 'count', 'min', 'max', 'mean', 'p50', 'p95']
+
+Perfdata = namedtuple('Perfdata', ['label', 'value', 'uom', 'warn', 'crit', 'min', 'max'])
+
+
+def _number(text):
+    if not text or text == 'U':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _parseSingle(text):
+    # Most perfdata from the API is a single unquoted value, split it without the full expression
+    label, seperator, rest = text.partition('=')
+    if not seperator or not label:
+        raise ValueError(f"unable to parse perfdata '{text[:40]}'")
+    fields = rest.split(';')
+    try:
+        value = int(fields[0])
+        uom = ''
+    except ValueError:
+        match = VALUE.match(fields[0])
+        if match is None:
+            raise ValueError(f"unable to parse perfdata value '{text[:40]}'")
+        value = _number(match.group('value'))
+        uom = match.group('uom')
+    count = len(fields)
+    return (Perfdata(label, value, uom, (fields[1] or None) if count > 1 else None, (fields[2] or None) if count > 2 else None,
+                     _number(fields[3]) if count > 3 else None, _number(fields[4]) if count > 4 else None),)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parseString(text):
+    text = text.strip()
+    if "'" not in text and ' ' not in text:
+        return _parseSingle(text)
+    values = []
+    pos = 0
+    while pos < len(text):
+        match = PERFDATA.match(text, pos)
+        if match is None:
+            raise ValueError(f"unable to parse perfdata at '{text[pos:pos + 40]}'")
+        label = match.group('label')
+        if label is None:
+            label = match.group('quoted').replace("''", "'")
+        values.append(Perfdata(label, _number(match.group('value')), match.group('uom'), match.group('warn') or None, match.group('crit') or None,
+                               _number(match.group('min')), _number(match.group('max'))))
+        pos = match.end()
+    return tuple(values)
+
+
+def formatLabel(label):
+    """Quote a label for perfdata output if it has a space, quote or =, a quote in it is doubled
+
+    Args:
+        label (str): perfdata label
+
+    Returns:
+        str: the label as it is written in perfdata
+    """
+    label = str(label)
+    if any(c in label for c in " '="):
+        return "'" + label.replace("'", "''") + "'"
+    return label
+
+
+def _fromObject(value):
+    # PerfdataValue from the Icinga API
+    return (Perfdata(value.get('label'), value.get('value'), value.get('unit') or '',
+                     None if value.get('warn') is None else str(value.get('warn')), None if value.get('crit') is None else str(value.get('crit')),
+                     value.get('min'), value.get('max')),)
+
+
+def parsePerfdata(performance_data):
+    """Parse perfdata
+
+    Args:
+        performance_data (str|list): a perfdata string or a list of perfdata strings or PerfdataValue objects as
+            in last_check_result.performance_data
+
+    Raises:
+        ValueError: the perfdata isn't valid
+
+    Returns:
+        list: Perfdata tuples (label, value, uom, warn, crit, min, max), value is None for 'U', warn and crit are
+            range strings, see parseRange
+    """
+    if performance_data is None:
+        return []
+    if isinstance(performance_data, str):
+        return list(_parseString(performance_data))
+    values = []
+    for item in performance_data:
+        values.extend(_fromObject(item) if isinstance(item, dict) else _parseString(item))
+    return values
+
+
+class PerfdataRange:
+    """A Nagios threshold range, [@][start:][end]. A value alerts when outside start-end, or inside it with @.
+
+    Args:
+        start (float): lower bound, -inf for ~
+        end (float): upper bound, inf if not given
+        inside (bool): alert inside the range instead of outside it
+    """
+
+    def __init__(self, start = 0, end = math.inf, inside = False):
+        self.start = start
+        self.end = end
+        self.inside = inside
+
+    def alert(self, value):
+        outside = value < self.start or value > self.end
+        return not outside if self.inside else outside
+
+    def __repr__(self):
+        start = '~' if self.start == -math.inf else self.start
+        end = '' if self.end == math.inf else self.end
+        return f"{'@' if self.inside else ''}{start}:{end}"
+
+
+@lru_cache(maxsize=256)
+def parseRange(text):
+    """Parse a Nagios threshold range, eg 10 (alert outside 0-10), 10: (below 10), ~:10 (above 10), 10:20, @10:20
+
+    Args:
+        text (str): range
+
+    Raises:
+        ValueError: the range isn't valid
+
+    Returns:
+        PerfdataRange: the range
+    """
+    match = RANGE.match(str(text).strip())
+    if match is None or (match.group('start') is None and match.group('end') is None):
+        raise ValueError(f"invalid threshold range '{text}'")
+    start = match.group('start')
+    start = -math.inf if start == '~' else float(start) if start is not None else 0
+    end = float(match.group('end')) if match.group('end') is not None else math.inf
+    return PerfdataRange(start, end, match.group('inside') is not None)
+
+
+class QuantileSketch:
+    """Approximate quantiles in bounded memory. The first exact_limit values are kept as they are and give exact
+    quantiles, after that values are counted in logarithmic buckets so a quantile is within relative_accuracy
+    of the true value. When there are more than max_buckets buckets the smallest are merged (only the low
+    quantiles lose accuracy).
+
+    Args:
+        relative_accuracy (float, optional): Defaults to 0.01.
+        max_buckets (int, optional): Defaults to 2048.
+        exact_limit (int, optional): Defaults to 1024.
+    """
+
+    def __init__(self, relative_accuracy = 0.01, max_buckets = 2048, exact_limit = 1024):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.exact_limit = exact_limit
+        self.count = 0
+        self.zeros = 0
+        self._exact = []
+        self._positive = {}
+        self._negative = {}
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        self.count += 1
+        if self._exact is not None:
+            self._exact.append(value)
+            if len(self._exact) <= self.exact_limit:
+                return
+            exact, self._exact = self._exact, None
+            for value in exact:
+                self._bucket(value)
+            return
+        self._bucket(value)
+
+    def _bucket(self, value):
+        if value > 0:
+            buckets = self._positive
+        elif value < 0:
+            buckets = self._negative
+            value = -value
+        else:
+            self.zeros += 1
+            return
+        key = self._key(value)
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(buckets) > self.max_buckets:
+            # Merge the two smallest magnitude buckets
+            low, high = sorted(buckets)[:2]
+            buckets[high] += buckets.pop(low)
+
+    def quantile(self, q):
+        """Value at quantile q (0-1) by nearest rank, None if nothing has been added"""
+        if not self.count:
+            return None
+        rank = max(math.ceil(q * self.count) - 1, 0)
+        if self._exact is not None:
+            return sorted(self._exact)[rank]
+        seen = 0
+        for key in sorted(self._negative, reverse=True):
+            seen += self._negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for key in sorted(self._positive):
+            seen += self._positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self._positive))
+
+
+class _LabelStats:
+    __slots__ = ['count', 'sum', 'min', 'max', 'uom', 'uoms', 'integers', 'sketch']
+
+    def __init__(self, uom, sketch):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.uom = uom
+        self.uoms = {uom}                       # every unit seen, the aggregates of different units are meaningless
+        self.integers = True
+        self.sketch = sketch
+
+
+class PerfdataAggregate:
+    """Aggregates of perfdata values by label, added one at a time
+
+    Args:
+        percentiles (bool, optional): keep a QuantileSketch per label for p50 and p95. Defaults to True.
+        relative_accuracy (float, optional): accuracy of the percentiles. Defaults to 0.01.
+    """
+
+    def __init__(self, percentiles = True, relative_accuracy = 0.01):
+        self.percentiles = percentiles
+        self.relative_accuracy = relative_accuracy
+        self._labels = {}
+
+    def add(self, perfdata):
+        """Add a value, values of 'U' are skipped
+
+        Args:
+            perfdata (Perfdata): parsed perfdata
+        """
+        value = perfdata.value
+        if value is None:
+            return
+        stats = self._labels.get(perfdata.label)
+        if stats is None:
+            stats = self._labels[perfdata.label] = _LabelStats(perfdata.uom, QuantileSketch(self.relative_accuracy) if self.percentiles else None)
+        if perfdata.uom != stats.uom:
+            stats.uoms.add(perfdata.uom)
+        stats.count += 1
+        stats.sum += value
+        if stats.min is None or value < stats.min:
+            stats.min = value
+        if stats.max is None or value > stats.max:
+            stats.max = value
+        if stats.sketch is not None:
+            stats.sketch.add(value)
+            if stats.integers and not isinstance(value, int):
+                stats.integers = False
+
+    def addAll(self, values):
+        for perfdata in values:
+            self.add(perfdata)
+
+    def labels(self):
+        return list(self._labels)
+
+    def stats(self, label):
+        """Aggregates of a label
+
+        Args:
+            label (str): perfdata label
+
+        Returns:
+            dict: sum, count, min, max, mean, p50, p95 (None without percentiles), uom (of the first value) and
+                uoms (every unit seen, sorted), None if the label hasn't been seen
+        """
+        stats = self._labels.get(label)
+        if stats is None:
+            return None
+        p50 = p95 = None
+        if stats.sketch is not None:
+            p50 = self._estimate(stats, stats.sketch.quantile(0.5))
+            p95 = self._estimate(stats, stats.sketch.quantile(0.95))
+        return {
+            "sum": stats.sum,
+            "count": stats.count,
+            "min": stats.min,
+            "max": stats.max,
+            "mean": stats.sum / stats.count,
+            "p50": p50,
+            "p95": p95,
+            "uom": stats.uom,
+            "uoms": sorted(stats.uoms)
+        }
+
+    @staticmethod
+    def _estimate(stats, value):
+        # The sketch's estimate can be just outside the values seen, or between integers when every value is one
+        value = min(max(value, stats.min), stats.max)
+        return round(value) if stats.integers else value
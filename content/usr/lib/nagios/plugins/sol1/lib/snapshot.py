@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Snapshot of a cluster's resource list shared by every check process, indexed by vmid and name
+#
+# Checks of one VM (check_pve.py --mode vm) only need one entry of a list the API returns for the whole cluster.
+# ResourceSnapshot fetches the list once per ttl per cluster and stores one row per resource in a SQLite (WAL)
+# file, so every other check in the window looks its resource up by vmid or name without an API call.
+#
+# - only one process refreshes a stale snapshot, the others wait on the lock file and then read what it stored.
+#   A process that can't get the lock within lockTimeout fetches the list for itself.
+# - a refresh replaces all the rows of the cluster in one transaction, readers see the old or the new snapshot.
+# - rows are JSON, the file may be in a directory other users can write to.
+# - if the cache file can't be used the list is fetched and scanned, as without the snapshot.
+#
+# To use:
+# - snapshot = ResourceSnapshot('/tmp/check_pve_resources.sqlite', 'pve1:8006:icinga@pve', ttl=30)
+# - resource = snapshot.lookup(100, lambda: api.get('cluster/resources', params={'type': 'vm'}))
+
+import hashlib
+import json
+import time
+
+from loguru import logger
+from lib.util import fileLock
+
+DEFAULT_TTL = 30
+DEFAULT_LOCK_TIMEOUT = 30
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS snapshot (
+        cluster TEXT PRIMARY KEY,
+        fetched REAL NOT NULL,
+        count INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS resource (
+        cluster TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        vmid INTEGER,
+        name TEXT,
+        payload TEXT NOT NULL,
+        PRIMARY KEY (cluster, position)
+    )""",
+    "CREATE INDEX IF NOT EXISTS resource_vmid ON resource (cluster, vmid)",
+    "CREATE INDEX IF NOT EXISTS resource_name ON resource (cluster, name)",
+]
+
+
+def findResource(resources, idx):
+    """The first resource with a name or vmid of idx, how the checks matched before the snapshot
+
+    Args:
+        resources (list): resource dicts as returned by the API
+        idx (str|int): name (str) or vmid (int)
+
+    Returns:
+        dict: the resource, None if there isn't one
+    """
+    for resource in resources:
+        if idx in (resource.get('name', None), resource.get('vmid', None)):
+            return resource
+    return None
+
+
+class ResourceSnapshot:
+    """Resource list of a cluster cached for ttl seconds in a SQLite file shared across processes
+
+    Args:
+        cacheFile (str): full path to the SQLite file
+        cluster (str): identifies the cluster and the view of it, e.g. endpoint, port and user
+        ttl (int, optional): seconds a snapshot is used for. Defaults to 30.
+        lockTimeout (int, optional): seconds to wait for another process refreshing the snapshot. Defaults to 30.
+    """
+
+    def __init__(self, cacheFile, cluster, ttl = DEFAULT_TTL, lockTimeout = DEFAULT_LOCK_TIMEOUT):
+        self._cacheFile = cacheFile
+        self._cluster = str(cluster)
+        self._ttl = ttl
+        self._lockTimeout = lockTimeout
+        self._db = None
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            # Autocommit, the refresh starts its transaction explicitly so the write lock is taken up front
+            db = sqlite3.connect(self._cacheFile, timeout=self._lockTimeout, isolation_level=None)
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                for statement in SCHEMA:
+                    db.execute(statement)
+            except sqlite3.Error:
+                db.close()
+                raise
+            self._db = db
+        return self._db
+
+    def _lockFile(self):
+        digest = hashlib.sha256(self._cluster.encode()).hexdigest()[:16]
+        return f"{self._cacheFile}.{digest}.lock"
+
+    def age(self):
+        """Seconds since the snapshot was fetched, None if there isn't one"""
+        row = self.db.execute("SELECT fetched FROM snapshot WHERE cluster = ?", (self._cluster,)).fetchone()
+        return None if row is None else time.time() - row[0]
+
+    def _fresh(self):
+        age = self.age()
+        return age is not None and 0 <= age < self._ttl
+
+    def _get(self, idx):
+        if isinstance(idx, int):
+            query = "SELECT payload FROM resource WHERE cluster = ? AND vmid = ? ORDER BY position LIMIT 1"
+        else:
+            query = "SELECT payload FROM resource WHERE cluster = ? AND name = ? ORDER BY position LIMIT 1"
+        row = self.db.execute(query, (self._cluster, idx)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def store(self, resources):
+        """Replace the snapshot of the cluster
+
+        Args:
+            resources (list): resource dicts as returned by the API
+        """
+        rows = [(self._cluster, position, r.get('vmid'), r.get('name'), json.dumps(r, separators=(',', ':')))
+                for position, r in enumerate(resources)]
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM resource WHERE cluster = ?", (self._cluster,))
+            db.executemany("INSERT INTO resource (cluster, position, vmid, name, payload) VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute("INSERT OR REPLACE INTO snapshot (cluster, fetched, count) VALUES (?, ?, ?)",
+                       (self._cluster, time.time(), len(rows)))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        logger.debug(f"Stored {len(rows)} resources for {self._cluster} in {self._cacheFile}")
+
+    def lookup(self, idx, fetch):
+        """Find a resource by vmid or name, refreshing the snapshot first if it's older than ttl
+
+        Args:
+            idx (str|int): name (str) or vmid (int)
+            fetch (callable): returns the resource list from the API, only called when the snapshot is stale
+
+        Returns:
+            dict: the resource, None if there isn't one
+        """
+        import sqlite3
+        resources = None
+        try:
+            if self._fresh():
+                logger.debug(f"Looking up {idx} in snapshot of {self._cluster}")
+                return self._get(idx)
+            with fileLock(self._lockFile(), timeout=self._lockTimeout):
+                # Another process may have refreshed it while we waited for the lock
+                if not self._fresh():
+                    resources = fetch()
+                    self.store(resources)
+                return self._get(idx)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.warning(f"Unable to use resource snapshot {self._cacheFile}: {e}")
+            self.close()
+            if resources is None:
+                resources = fetch()
+            return findResource(resources, idx)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# In-memory index of Icinga object state kept current from the event stream
+#
+# Meta checks (check_icinga2_checks.py) normally fetch every matching object from /v1/objects for every check.
+# The index is seeded once from a full dump of the objects, then kept current from the /v1/events stream
+# (CheckResult, StateChange, AcknowledgementSet and AcknowledgementCleared) and answers object queries over a
+# unix socket in the same shape as the API, so the checks don't need to know where the objects came from.
+#
+# The stream is opened before the dump so nothing is missed between them. Events are applied in order, a check
+# result older than the one the object has is skipped, by Icinga's own times so the daemon's clock doesn't
+# matter. The index is reseeded when the stream drops or goes quiet for longer than stale_after (events
+# may have been missed), when events arrive for objects it doesn't know (new config) and every resync_interval.
+#
+# Filters are compiled with lib.icingafilter, the objects matching each filter are cached and kept current as
+# events arrive so a repeated query only copies the matching objects. The JSON of each object is also cached
+# (per set of attrs) until the object changes, most of the cost of a large answer is encoding it.
+#
+# Protocol (one request per connection, both sides are a single line of JSON):
+# - request:  {"type": "services", "filter": "...", "attrs": ["last_check_result", ...]}
+# - response: {"results": [...], "age": seconds since the last event, "seeded": seconds since the last seed}
+# - request:  {"status": true}
+# - response: {"objects": {...}, "events": 123, "resyncs": 1, "filters": 10, "age": ..., "seeded": ...}
+# - any error: {"error": "..."}, the client should query the API instead
+
+from collections import OrderedDict
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+from loguru import logger
+from lib.icingafilter import compileFilter, FilterNotSupported
+
+DEFAULT_SOCKET = '/run/icinga2/state_index.sock'
+DEFAULT_STALE_AFTER = 120           # seconds without an event before the stream is reconnected and reseeded
+DEFAULT_RESYNC_INTERVAL = 3600      # seconds between full reseeds
+DEFAULT_QUERY_TIMEOUT = 5
+EVENT_TYPES = ['CheckResult', 'StateChange', 'AcknowledgementSet', 'AcknowledgementCleared']
+# Attributes kept for each object, queries and filters can only use these
+INDEX_ATTRS = {
+    'services': ['name', 'host_name', 'display_name', 'groups', 'vars', 'state', 'last_check_result', 'acknowledgement', 'last_check', 'check_interval', 'zone', 'command_endpoint'],
+    'hosts': ['name', 'display_name', 'groups', 'vars', 'state', 'last_check_result', 'acknowledgement', 'last_check', 'check_interval', 'zone', 'command_endpoint']
+}
+# Parts of the check result that are kept
+RESULT_KEYS = ['state', 'exit_status', 'output', 'performance_data', 'execution_start', 'execution_end', 'check_source']
+MAX_FILTERS = 1000
+MIN_RESEED_INTERVAL = 60            # seconds, limits reseeds for events about unknown objects
+
+
+class StateIndexError(Exception):
+    pass
+
+
+def _checkResult(check_result):
+    if not isinstance(check_result, dict):
+        return check_result
+    return {key: check_result[key] for key in RESULT_KEYS if key in check_result}
+
+
+class StateIndex:
+    """Objects by type and name in the Icinga API shape, {"name", "type", "attrs"}
+
+    Args:
+        types (list, optional): object types to index. Defaults to ['services'].
+    """
+
+    def __init__(self, types = None):
+        self.types = list(types or ['services'])
+        self._lock = threading.Lock()
+        self._objects = {obj_type: {} for obj_type in self.types}
+        self._updated = {}              # (type, name) -> Icinga's time of the check result the object has
+        self._filters = OrderedDict()   # (type, filter) -> (IcingaFilter, set of matching names), least recently used first
+        self.events = 0
+        self.unknown = 0                # events for objects that aren't indexed since the last seed
+        self.resyncs = 0
+        self.lastEvent = None
+        self.lastSeed = None
+
+    def seed(self, obj_type, objects):
+        """Replace the objects of a type
+
+        Args:
+            obj_type (str): object type
+            objects (iterable): objects from the API with INDEX_ATTRS, check result events older than an
+                object's last_check are skipped
+        """
+        seeded = {}
+        for obj in objects:
+            attrs = obj.get('attrs', {})
+            attrs['last_check_result'] = _checkResult(attrs.get('last_check_result'))
+            seeded[obj['name']] = {"name": obj['name'], "type": obj.get('type'), "attrs": attrs, "json": {}}
+        with self._lock:
+            self._objects[obj_type] = seeded
+            self._updated = {key: value for key, value in self._updated.items() if key[0] != obj_type}
+            for name, obj in seeded.items():
+                self._updated[(obj_type, name)] = self._resultTime(obj['attrs'].get('last_check'))
+            for key in [key for key in self._filters if key[0] == obj_type]:
+                del self._filters[key]
+            self.unknown = 0
+            self.lastSeed = time.time()
+        logger.info(f"State index seeded with {len(seeded)} {obj_type}")
+
+    @staticmethod
+    def _resultTime(value):
+        # last_check is -1 for an object that has never been checked
+        return value if isinstance(value, (int, float)) and value > 0 else 0
+
+    def apply(self, event):
+        """Update the index from an event
+
+        Args:
+            event (dict): event from the Icinga event stream
+
+        Returns:
+            bool: the event changed the index
+        """
+        host = event.get('host')
+        service = event.get('service')
+        obj_type, name = ('services', f"{host}!{service}") if service is not None else ('hosts', host)
+        if obj_type not in self._objects:
+            return False
+        timestamp = event.get('timestamp') or time.time()
+        kind = event.get('type')
+        with self._lock:
+            self.events += 1
+            self.lastEvent = time.time()
+            obj = self._objects[obj_type].get(name)
+            if obj is None:
+                self.unknown += 1
+                return False
+            attrs = dict(obj['attrs'])
+            if kind in ['CheckResult', 'StateChange']:
+                check_result = event.get('check_result') or {}
+                # Compared with the dumped last_check, both are from the endpoint that ran the check
+                result_time = self._resultTime(check_result.get('execution_end')) or timestamp
+                if result_time < self._updated.get((obj_type, name), 0):
+                    return False
+                self._updated[(obj_type, name)] = result_time
+                attrs['last_check_result'] = _checkResult(check_result)
+                attrs['state'] = event.get('state', check_result.get('state', attrs.get('state')))
+                attrs['last_check'] = check_result.get('execution_end', timestamp)
+            elif kind == 'AcknowledgementSet':
+                attrs['acknowledgement'] = event.get('acknowledgement_type', 1)
+            elif kind == 'AcknowledgementCleared':
+                attrs['acknowledgement'] = 0
+            else:
+                return False
+            # Replaced rather than changed so a query copying the old attrs isn't affected
+            obj['attrs'] = attrs
+            obj['json'] = {}
+            for (filter_type, _), (icingaFilter, names) in self._filters.items():
+                if filter_type == obj_type:
+                    if icingaFilter(obj):
+                        names.add(name)
+                    else:
+                        names.discard(name)
+        return True
+
+    def query(self, obj_type, filter = None, attrs = None):
+        """Objects matching a filter
+
+        Args:
+            obj_type (str): object type
+            filter (str, optional): Icinga filter, see lib.icingafilter. Defaults to None (every object).
+            attrs (list, optional): attributes to return. Defaults to None (every indexed attribute).
+
+        Raises:
+            StateIndexError: the type isn't indexed or the filter or attrs use something that isn't indexed
+
+        Returns:
+            list: objects in the Icinga API shape
+        """
+        with self._lock:
+            return [self._project(obj, attrs) for obj in self._match(obj_type, filter, attrs)]
+
+    def queryJson(self, obj_type, filter = None, attrs = None):
+        """Objects matching a filter as JSON, see query
+
+        Returns:
+            str: JSON list of the objects in the Icinga API shape
+        """
+        key = tuple(attrs) if attrs is not None else None
+        fragments = []
+        with self._lock:
+            for obj in self._match(obj_type, filter, attrs):
+                fragment = obj['json'].get(key)
+                if fragment is None:
+                    fragment = obj['json'][key] = json.dumps(self._project(obj, attrs))
+                fragments.append(fragment)
+        return '[' + ','.join(fragments) + ']'
+
+    @staticmethod
+    def _project(obj, attrs):
+        if attrs is None:
+            return {"name": obj['name'], "type": obj['type'], "attrs": obj['attrs']}
+        return {"name": obj['name'], "type": obj['type'], "attrs": {attr: obj['attrs'].get(attr) for attr in attrs}}
+
+    def _match(self, obj_type, filter, attrs):
+        # Called with the lock held
+        if obj_type not in self._objects:
+            raise StateIndexError(f"{obj_type} aren't indexed")
+        if attrs is not None and set(attrs) - set(INDEX_ATTRS[obj_type]):
+            raise StateIndexError(f"attributes {', '.join(sorted(set(attrs) - set(INDEX_ATTRS[obj_type])))} aren't indexed")
+        if self.lastSeed is None:
+            raise StateIndexError("the index hasn't been seeded")
+        objects = self._objects[obj_type]
+        if filter is None:
+            return list(objects.values())
+        cached = self._filters.get((obj_type, filter))
+        if cached is None:
+            cached = (self._compile(obj_type, filter), set())
+            cached[1].update(name for name, obj in objects.items() if cached[0](obj))
+            self._filters[(obj_type, filter)] = cached
+            if len(self._filters) > MAX_FILTERS:
+                self._filters.popitem(last=False)
+        else:
+            self._filters.move_to_end((obj_type, filter))
+        return [objects[name] for name in cached[1]]
+
+    def _compile(self, obj_type, filter):
+        try:
+            icingaFilter = compileFilter(filter, obj_type)
+        except FilterNotSupported as e:
+            raise StateIndexError(f"filter can't be compiled: {e}")
+        if icingaFilter.joins:
+            raise StateIndexError(f"joins aren't indexed: {', '.join(sorted(icingaFilter.joins))}")
+        if icingaFilter.attrs - set(INDEX_ATTRS[obj_type]):
+            raise StateIndexError(f"attributes {', '.join(sorted(icingaFilter.attrs - set(INDEX_ATTRS[obj_type])))} aren't indexed")
+        return icingaFilter
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "objects": {obj_type: len(objects) for obj_type, objects in self._objects.items()},
+                "events": self.events,
+                "resyncs": self.resyncs,
+                "filters": len(self._filters),
+                "age": now - self.lastEvent if self.lastEvent else None,
+                "seeded": now - self.lastSeed if self.lastSeed else None
+            }
+
+
+class EventFeeder:
+    """Seeds the index from the API and keeps it current from the event stream, run() until stop()
+
+    Args:
+        icinga (lib.icinga.Icinga): API client
+        index (StateIndex): index to keep current
+        stale_after (float, optional): seconds without an event before reconnecting and reseeding. Defaults to DEFAULT_STALE_AFTER.
+        resync_interval (float, optional): seconds between full reseeds. Defaults to DEFAULT_RESYNC_INTERVAL.
+        retry (float, optional): seconds to wait before reconnecting after an error. Defaults to 5.
+    """
+
+    def __init__(self, icinga, index, stale_after = DEFAULT_STALE_AFTER, resync_interval = DEFAULT_RESYNC_INTERVAL, retry = 5):
+        self.icinga = icinga
+        self.index = index
+        self.stale_after = stale_after
+        self.resync_interval = resync_interval
+        self.retry = retry
+        self.queue = f"state-index-{uuid.uuid4()}"
+        self._stop = threading.Event()
+        self._response = None
+
+    def stop(self):
+        self._stop.set()
+        if self._response is not None:
+            self._response.close()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self._follow()
+            except Exception as e:
+                if not self._stop.is_set():
+                    logger.warning(f"State index event stream ended, reconnecting and reseeding: {e}")
+            self._stop.wait(self.retry)
+
+    def seed(self):
+        for obj_type in self.index.types:
+            self.index.seed(obj_type, self.icinga.iterCheckResults(obj_type, None, INDEX_ATTRS[obj_type], raise_errors=True))
+        self.index.resyncs += 1
+
+    def _read(self, events, received):
+        try:
+            for event in events:
+                received.put(event)
+            received.put(EOFError("the event stream closed"))
+        except Exception as e:
+            received.put(e)
+
+    def _follow(self):
+        # The stream is opened first so events during the dump are buffered, not lost
+        self._response, events = self.icinga.eventStream(EVENT_TYPES, self.queue, timeout=(10, self.stale_after))
+        received = queue.Queue()
+        reader = threading.Thread(target=self._read, args=(events, received), daemon=True)
+        reader.start()
+        try:
+            self.seed()
+            while not self._stop.is_set():
+                try:
+                    event = received.get(timeout=1)
+                except queue.Empty:
+                    event = None
+                if isinstance(event, Exception):
+                    raise event
+                if event is not None:
+                    self.index.apply(event)
+                since_seed = time.time() - self.index.lastSeed
+                if since_seed > self.resync_interval or (self.index.unknown and since_seed > MIN_RESEED_INTERVAL):
+                    logger.info(f"State index reseeding, {since_seed:.0f}s since the last seed and {self.index.unknown} events for unknown objects")
+                    self.seed()
+        finally:
+            self._response.close()
+
+
+class IndexRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict):
+                raise StateIndexError("request is not a JSON object")
+            if request.get('status'):
+                response = self.server.index.status()
+            else:
+                # The results are already JSON
+                results = self.server.index.queryJson(request.get('type', 'services'), request.get('filter'), request.get('attrs'))
+                status = self.server.index.status()
+                self.wfile.write(f'{{"age": {json.dumps(status["age"])}, "seeded": {json.dumps(status["seeded"])}, "results": {results}}}\n'.encode())
+                return
+        except Exception as e:
+            logger.debug(f"State index request failed: {e}")
+            response = {"error": str(e)}
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class StateIndexServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server answering queries from the index"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, index: StateIndex, socket_mode = 0o660):
+        self.index = index
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, IndexRequestHandler)
+        os.chmod(socket_path, socket_mode)
+        logger.info(f"State index listening on {socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def queryIndex(socket_path, obj_type, filter = None, attrs = None, max_age = None, timeout = DEFAULT_QUERY_TIMEOUT):
+    """Query the state index daemon
+
+    Args:
+        socket_path (str): unix socket of the daemon
+        obj_type (str): object type
+        filter (str, optional): Icinga filter. Defaults to None (every object).
+        attrs (list, optional): attributes to return. Defaults to None (every indexed attribute).
+        max_age (float, optional): seconds since the last event after which the answer is refused. Defaults to None.
+        timeout (float, optional): seconds to wait for the answer. Defaults to DEFAULT_QUERY_TIMEOUT.
+
+    Raises:
+        StateIndexError: the daemon couldn't answer, query the API instead
+
+    Returns:
+        list: objects in the Icinga API shape
+    """
+    request = {"type": obj_type, "filter": filter, "attrs": list(attrs) if attrs is not None else None}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall((json.dumps(request) + "\n").encode())
+            client.shutdown(socket.SHUT_WR)
+            data = bytearray()
+            while True:
+                chunk = client.recv(262144)
+                if not chunk:
+                    break
+                data += chunk
+        response = json.loads(data)
+    except (OSError, ValueError) as e:
+        raise StateIndexError(f"state index {socket_path} unavailable: {e}")
+    if 'error' in response:
+        raise StateIndexError(response['error'])
+    if max_age is not None and (response.get('age') is None or response['age'] > max_age):
+        raise StateIndexError(f"state index has had no events for {response.get('age')}s")
+    return response['results']
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Rolling store of a cluster's tasks of one type, kept up to date from a cursor per node
+#
+# The task list the API returns is mostly the same from one check to the next. TaskStore keeps the outcome of the
+# tasks of the last retention seconds (upid, node, guest id, start and end time and status) in a SQLite (WAL) file
+# and a cursor per node, so each run only asks a node for the tasks that started since the cursor.
+#
+# - the cursor is the start time of the newest task seen, or of the oldest one still running when it was fetched,
+#   so a long task is fetched again until it has its status. Fetches start overlap seconds before the cursor for a
+#   task that was listed just after its start time. Tasks are keyed by upid, fetching one twice is harmless.
+# - only one process updates a cluster at a time, the others wait on the lock file and then fetch what is left.
+#   The tasks of all the nodes are stored in one transaction, readers see all of an update or none of it.
+# - tasks that started before the retention window are dropped.
+# - if the cache file can't be used the caller gets the sqlite3.Error or OSError and can fetch the tasks as before.
+#
+# To use:
+# - store = TaskStore('/tmp/check_pve_tasks.sqlite', 'pve1:8006:icinga@pve', taskType='vzdump', retention=7 * 86400)
+# - store.update(['pve1'], lambda cursors: {node: api.get(f'nodes/{node}/tasks', params={'since': since})
+#                                            for node, since in cursors.items()})
+# - tasks = store.tasks(node='pve1')
+
+import hashlib
+import time
+
+from loguru import logger
+from lib.util import fileLock
+
+DEFAULT_RETENTION = 7 * 86400           # seconds of tasks kept
+DEFAULT_OVERLAP = 60                    # seconds before the cursor a fetch starts from
+DEFAULT_LOCK_TIMEOUT = 30
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS cursor (
+        cluster TEXT NOT NULL,
+        node TEXT NOT NULL,
+        since INTEGER NOT NULL,
+        upid TEXT,
+        fetched REAL NOT NULL,
+        PRIMARY KEY (cluster, node)
+    )""",
+    """CREATE TABLE IF NOT EXISTS task (
+        cluster TEXT NOT NULL,
+        upid TEXT NOT NULL,
+        node TEXT NOT NULL,
+        type TEXT NOT NULL,
+        id TEXT,
+        starttime INTEGER NOT NULL,
+        endtime INTEGER,
+        status TEXT,
+        PRIMARY KEY (cluster, upid)
+    )""",
+    "CREATE INDEX IF NOT EXISTS task_start ON task (cluster, type, starttime)",
+    "CREATE INDEX IF NOT EXISTS task_node ON task (cluster, node, starttime)",
+]
+COLUMNS = ['upid', 'node', 'type', 'id', 'starttime', 'endtime', 'status']
+
+
+class TaskStore:
+    """Tasks of one type of a cluster for the last retention seconds in a SQLite file shared across processes
+
+    Args:
+        cacheFile (str): full path to the SQLite file
+        cluster (str): identifies the cluster and the view of it, e.g. endpoint, port and user
+        taskType (str, optional): task type to keep. Defaults to 'vzdump'.
+        retention (int, optional): seconds of tasks to keep, by start time. Defaults to 7 days.
+        overlap (int, optional): seconds before the cursor a fetch starts from. Defaults to 60.
+        lockTimeout (int, optional): seconds to wait for another process updating the store. Defaults to 30.
+    """
+
+    def __init__(self, cacheFile, cluster, taskType = 'vzdump', retention = DEFAULT_RETENTION, overlap = DEFAULT_OVERLAP,
+                 lockTimeout = DEFAULT_LOCK_TIMEOUT):
+        self._cacheFile = cacheFile
+        self._cluster = str(cluster)
+        self._taskType = taskType
+        self._retention = retention
+        self._overlap = overlap
+        self._lockTimeout = lockTimeout
+        self._db = None
+
+    @property
+    def retention(self):
+        return self._retention
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            # Autocommit, updates start their transaction explicitly so the write lock is taken up front
+            db = sqlite3.connect(self._cacheFile, timeout=self._lockTimeout, isolation_level=None)
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                for statement in SCHEMA:
+                    db.execute(statement)
+            except sqlite3.Error:
+                db.close()
+                raise
+            self._db = db
+        return self._db
+
+    def _lockFile(self):
+        digest = hashlib.sha256(self._cluster.encode()).hexdigest()[:16]
+        return f"{self._cacheFile}.{digest}.lock"
+
+    def _cursor(self, node):
+        row = self.db.execute("SELECT since FROM cursor WHERE cluster = ? AND node = ?", (self._cluster, node)).fetchone()
+        return None if row is None else row[0]
+
+    def since(self, node):
+        """Start time the next fetch of a node's tasks starts from
+
+        Args:
+            node (str): node name
+
+        Returns:
+            int: overlap seconds before the node's cursor, or the start of the retention window if it has no cursor
+                or it is older
+        """
+        cursor = self._cursor(node)
+        oldest = int(time.time() - self._retention)
+        return oldest if cursor is None else max(cursor - self._overlap, oldest)
+
+    def update(self, nodes, fetch):
+        """Fetch the tasks the nodes started since their cursors and move the cursors on
+
+        Args:
+            nodes (list): node names
+            fetch (callable): fetch(cursors) gets {node: since} and returns {node: tasks}, the node's tasks, finished
+                and running, that started at or after since (epoch seconds) as returned by the API
+
+        Returns:
+            int: number of tasks fetched
+        """
+        with fileLock(self._lockFile(), timeout=self._lockTimeout):
+            previous = {node: self._cursor(node) for node in nodes}
+            cursors = {node: self.since(node) for node in nodes}
+            fetched = fetch(cursors)
+            rows = [(self._cluster, t['upid'], t.get('node', node), t['type'], str(t.get('id') or ''),
+                     int(t['starttime']), t.get('endtime'), t.get('status'))
+                    for node, tasks in fetched.items() for t in tasks if t.get('type') == self._taskType and 'upid' in t]
+            oldest = int(time.time() - self._retention)
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR REPLACE INTO task (cluster, upid, node, type, id, starttime, endtime, status) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                db.execute("DELETE FROM task WHERE cluster = ? AND starttime < ?", (self._cluster, oldest))
+                for node, since in cursors.items():
+                    # A task still running is fetched again until it has finished
+                    running, newest = db.execute(
+                        "SELECT MIN(CASE WHEN status IS NULL THEN starttime END), MAX(starttime) FROM task "
+                        "WHERE cluster = ? AND node = ? AND type = ?", (self._cluster, node, self._taskType)).fetchone()
+                    cursor = running if running is not None else (newest if newest is not None else previous[node] or since)
+                    upid = db.execute("SELECT upid FROM task WHERE cluster = ? AND node = ? AND starttime = ? ORDER BY upid DESC LIMIT 1",
+                                      (self._cluster, node, cursor)).fetchone()
+                    db.execute("INSERT OR REPLACE INTO cursor (cluster, node, since, upid, fetched) VALUES (?, ?, ?, ?, ?)",
+                               (self._cluster, node, cursor, upid[0] if upid else None, time.time()))
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        logger.debug(f"Fetched {len(rows)} {self._taskType} tasks of {len(cursors)} nodes")
+        return len(rows)
+
+    def tasks(self, node = None, since = None):
+        """Stored tasks, newest first
+
+        Args:
+            node (str, optional): only the tasks of this node. Defaults to None, every node.
+            since (int, optional): only the tasks that started at or after this (epoch seconds). Defaults to None.
+
+        Returns:
+            list: task dicts with the API's keys, running tasks have no 'status' or 'endtime'
+        """
+        query = f"SELECT {', '.join(COLUMNS)} FROM task WHERE cluster = ? AND type = ?"
+        params = [self._cluster, self._taskType]
+        if node is not None:
+            query += " AND node = ?"
+            params.append(node)
+        if since is not None:
+            query += " AND starttime >= ?"
+            params.append(since)
+        query += " ORDER BY starttime DESC"
+        tasks = []
+        for row in self.db.execute(query, params):
+            tasks.append({key: value for key, value in zip(COLUMNS, row) if value is not None})
+        return tasks
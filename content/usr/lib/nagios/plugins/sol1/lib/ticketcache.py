@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Login tickets shared by every check process logged in as the same user
+#
+# Logging in with a password makes the server authenticate the user (PAM, LDAP, password hashing) every run.
+# TicketCache keeps the ticket of one (endpoint, user) in a file so checks run in the same window share it:
+#
+# - the file is only readable by its owner (0600) and a file owned by someone else or readable by others is
+#   ignored, the ticket is as good as the password until it expires.
+# - it's replaced atomically, readers see the old or the new ticket.
+# - only one process logs in when the ticket is missing or due for a refresh, the others wait on the lock file
+#   and then read the ticket it stored. A process that can't get the lock within lockTimeout logs in itself.
+# - a ticket is refreshed refreshBefore seconds before it expires. The login callback gets the old ticket so it
+#   can renew it (PVE accepts a valid ticket as the password) instead of logging in with the password again.
+# - the ticket is only used by checks with the same password (a salted hash of it is stored with the ticket), a
+#   wrong password isn't hidden by another check's ticket.
+# - invalidate drops a ticket the server rejected so the next get logs in again.
+#
+# To use:
+# - cache = TicketCache(ticketFile('check_pve', endpoint, port, user), secret=password)
+# - entry = cache.get(lambda ticket: api.login(ticket)); entry['ticket'], entry['CSRFPreventionToken']
+
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from loguru import logger
+from lib.util import fileLock
+
+DEFAULT_LIFETIME = 7200                 # seconds a PVE ticket is valid for
+DEFAULT_REFRESH_BEFORE = 600            # seconds before it expires that a ticket is refreshed
+DEFAULT_LOCK_TIMEOUT = 30
+ENTRY_KEYS = ['ticket', 'CSRFPreventionToken']
+
+
+def ticketFile(name, *parts, cacheDir = '/tmp'):
+    """Ticket cache file for a user of an endpoint
+
+    Args:
+        name (str): prefix for the file, usually the plugin name
+        parts (str): values that identify the endpoint and user
+        cacheDir (str, optional): directory for the file. Defaults to '/tmp'.
+
+    Returns:
+        str: full path to the ticket file
+    """
+    digest = hashlib.sha256("\0".join(str(p) for p in parts).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, f"{name}_ticket_{digest}.json")
+
+
+class TicketCache:
+    """Login ticket of one user kept in a file only the user can read
+
+    Args:
+        cacheFile (str): full path to the ticket file, use ticketFile to build one
+        secret (str, optional): password the ticket is for, a ticket stored with another password isn't used. Defaults to None.
+        lifetime (int, optional): seconds a ticket is valid for. Defaults to 7200.
+        refreshBefore (int, optional): seconds before it expires that a ticket is refreshed. Defaults to 600.
+        lockTimeout (int, optional): seconds to wait for another process logging in. Defaults to 30.
+    """
+
+    def __init__(self, cacheFile, secret = None, lifetime = DEFAULT_LIFETIME, refreshBefore = DEFAULT_REFRESH_BEFORE, lockTimeout = DEFAULT_LOCK_TIMEOUT):
+        self._cacheFile = cacheFile
+        self._secret = secret
+        self._lifetime = lifetime
+        self._refreshBefore = refreshBefore
+        self._lockTimeout = lockTimeout
+
+    @property
+    def cacheFile(self):
+        return self._cacheFile
+
+    def _digest(self, salt):
+        return hashlib.sha256(bytes.fromhex(salt) + str(self._secret or '').encode()).hexdigest()
+
+    def _age(self, entry):
+        return time.time() - entry['issued']
+
+    def _valid(self, entry):
+        return entry is not None and 0 <= self._age(entry) < self._lifetime
+
+    def _fresh(self, entry):
+        return entry is not None and 0 <= self._age(entry) < self._lifetime - self._refreshBefore
+
+    def _read(self):
+        try:
+            fd = os.open(self._cacheFile, os.O_RDONLY | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Unable to read ticket cache {self._cacheFile}: {e}")
+            return None
+        with os.fdopen(fd) as fh:
+            stat = os.fstat(fh.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                logger.warning(f"Ignoring ticket cache {self._cacheFile}, it must be owned by uid {os.getuid()} with mode 0600")
+                return None
+            try:
+                entry = json.load(fh)
+            except ValueError as e:
+                logger.warning(f"Ignoring ticket cache {self._cacheFile}: {e}")
+                return None
+        if not isinstance(entry, dict) or not isinstance(entry.get('ticket'), str) or not isinstance(entry.get('issued'), (int, float)):
+            return None
+        try:
+            if not hmac.compare_digest(self._digest(entry.get('salt', '')), str(entry.get('secret', ''))):
+                logger.debug(f"Ticket in {self._cacheFile} is for another password")
+                return None
+        except ValueError:
+            return None
+        return entry
+
+    def _write(self, entry):
+        # Written to a file only we can read and moved over the old one, never opened through a symlink
+        tmp = f"{self._cacheFile}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(entry, fh)
+            os.replace(tmp, self._cacheFile)
+        except OSError as e:
+            logger.warning(f"Unable to write ticket cache {self._cacheFile}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def get(self, login):
+        """Get a ticket, logging in when there isn't a fresh one
+
+        Args:
+            login (callable): login(ticket) returns the API's login data (a dict with 'ticket' and, for PVE,
+                'CSRFPreventionToken'). ticket is the old ticket if it's still valid so it can be renewed, else None.
+
+        Returns:
+            dict: 'ticket', 'CSRFPreventionToken', 'issued' (epoch seconds) and the salted hash of the secret
+        """
+        entry = self._read()
+        if self._fresh(entry):
+            logger.debug(f"Using cached ticket from {self._cacheFile}")
+            return entry
+        with fileLock(f"{self._cacheFile}.lock", timeout=self._lockTimeout):
+            # Another process may have logged in while we waited for the lock
+            entry = self._read()
+            if self._fresh(entry):
+                return entry
+            data = login(entry['ticket'] if self._valid(entry) else None)
+            entry = {key: data.get(key) for key in ENTRY_KEYS}
+            entry['issued'] = time.time()
+            entry['salt'] = os.urandom(16).hex()
+            entry['secret'] = self._digest(entry['salt'])
+            self._write(entry)
+            logger.debug(f"Stored new ticket in {self._cacheFile}")
+            return entry
+
+    def invalidate(self, ticket):
+        """Drop a ticket the server rejected, unless another process has already replaced it
+
+        Args:
+            ticket (str): the rejected ticket
+        """
+        with fileLock(f"{self._cacheFile}.lock", timeout=self._lockTimeout):
+            entry = self._read()
+            if entry is not None and entry['ticket'] == ticket:
+                try:
+                    os.unlink(self._cacheFile)
+                except OSError as e:
+                    logger.warning(f"Unable to remove ticket cache {self._cacheFile}: {e}")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Keep samples of a metric between check runs and work out how fast it is moving
+#
+# A check only sees one value per run, so a queue that grows steadily stays under a static threshold until it is
+# too late to do anything about it. RingBuffer keeps the last samples of a metric in a small fixed size file, a
+# header (magic, version, slots, next slot, count) followed by one (timestamp, value) slot of two doubles per sample.
+# A new sample overwrites the oldest slot, so the file never grows and an update is one locked read and two small
+# writes. A file with a different number of slots, from another version or that is damaged is started again.
+#
+# Trend works out from the samples:
+# - rate, the least squares slope over the window in units per second, None until the samples cover minSpan
+# - ewma, the exponentially weighted moving average, weighted by time so irregular runs don't skew it
+# - timeTo(threshold), the seconds until the metric reaches the threshold if it keeps growing at rate
+#
+# To use:
+# - samples = RingBuffer(ringFile('check_icinga2_api', 'query_queue', url)).add(value)
+# - trend = Trend(samples, window=900); trend.rate * 60, trend.ewma, trend.timeTo(200)
+
+from collections import namedtuple
+import fcntl
+import hashlib
+import os
+import struct
+import time
+
+MAGIC = b'RING'
+VERSION = 1
+HEADER = struct.Struct('<4sHIII')       # magic, version, slots, next slot, count
+SLOT = struct.Struct('<dd')             # timestamp, value
+DEFAULT_SLOTS = 60
+DEFAULT_WINDOW = 900                    # seconds of samples used for the rate
+DEFAULT_HALF_LIFE = 300                 # seconds for the weight of a sample in the ewma to halve
+DEFAULT_MIN_SPAN = 60                   # seconds the samples in the window must cover before there is a rate
+
+Sample = namedtuple('Sample', ['timestamp', 'value'])
+
+
+def ringFile(name, *parts, cacheDir = '/tmp'):
+    """Ring buffer file for a metric, unique to the upstream it was read from
+
+    Args:
+        name (str): prefix for the file, usually the plugin name
+        parts (str): metric name and the values that identify the upstream, e.g. the server url
+        cacheDir (str, optional): directory for the file. Defaults to '/tmp'.
+
+    Returns:
+        str: full path to the ring buffer file
+    """
+    digest = hashlib.sha256("\0".join(str(p) for p in parts).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, f"{name}_{digest}.ring")
+
+
+class RingBuffer:
+    """Fixed number of (timestamp, value) samples of one metric in a binary file shared across processes"""
+
+    def __init__(self, path, slots = DEFAULT_SLOTS):
+        if slots < 2:
+            raise ValueError(f"A ring buffer needs at least 2 slots, not {slots}")
+        self._path = path
+        self._slots = int(slots)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _size(self):
+        return HEADER.size + self._slots * SLOT.size
+
+    def _parse(self, data):
+        # (next slot, count, samples oldest first), an empty ring when the file isn't one of ours with this many slots
+        if len(data) != self._size():
+            return (0, 0, [])
+        magic, version, slots, head, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or slots != self._slots or head >= slots or count > slots:
+            return (0, 0, [])
+        values = list(SLOT.iter_unpack(memoryview(data)[HEADER.size:]))
+        start = (head - count) % slots
+        samples = [Sample(*values[(start + i) % slots]) for i in range(count)]
+        return (head, count, samples)
+
+    def samples(self):
+        """Read the samples without adding one
+
+        Returns:
+            list: Sample tuples oldest first, empty when there is no file yet
+        """
+        try:
+            with open(self._path, 'rb') as fh:
+                fcntl.flock(fh, fcntl.LOCK_SH)
+                return self._parse(fh.read())[2]
+        except FileNotFoundError:
+            return []
+
+    def add(self, value, timestamp = None):
+        """Add a sample, overwriting the oldest once the ring is full
+
+        A sample older than the newest one in the ring means the clock went back, the ring is started again.
+
+        Args:
+            value (float): metric value
+            timestamp (float, optional): epoch seconds of the sample. Defaults to now.
+
+        Returns:
+            list: Sample tuples oldest first, including the one added
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        sample = Sample(float(timestamp), float(value))
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            data = fh.read()
+            head, count, samples = self._parse(data)
+            if samples and sample.timestamp < samples[-1].timestamp:
+                head, count, samples = (0, 0, [])
+            if count == 0 and len(data) != self._size():
+                # New or unusable file, lay out every slot so later updates only write in place
+                fh.seek(0)
+                fh.truncate()
+                fh.write(bytes(self._size()))
+            fh.seek(HEADER.size + head * SLOT.size)
+            fh.write(SLOT.pack(*sample))
+            count = min(count + 1, self._slots)
+            fh.seek(0)
+            fh.write(HEADER.pack(MAGIC, VERSION, self._slots, (head + 1) % self._slots, count))
+        samples.append(sample)
+        return samples[-self._slots:]
+
+
+class Trend:
+    """Rate, EWMA and time to threshold of a metric from its samples
+
+    Args:
+        samples (list): (timestamp, value) tuples oldest first, as returned by RingBuffer.add
+        window (int, optional): seconds of samples, back from the newest, used for the rate. Defaults to 900.
+        halfLife (int, optional): seconds for the weight of a sample in the ewma to halve. Defaults to 300.
+        minSpan (int, optional): seconds the samples in the window must cover before there is a rate. Defaults to 60.
+    """
+
+    def __init__(self, samples, window = DEFAULT_WINDOW, halfLife = DEFAULT_HALF_LIFE, minSpan = DEFAULT_MIN_SPAN):
+        self._samples = [Sample(*s) for s in samples]
+        self._window = window
+        self._halfLife = halfLife
+        self._minSpan = minSpan
+        self.rate = self._rate()
+        self.ewma = self._ewma()
+
+    @property
+    def value(self):
+        return self._samples[-1].value if self._samples else None
+
+    @property
+    def span(self):
+        """Seconds between the oldest and newest sample used for the rate"""
+        recent = self._recent()
+        return recent[-1].timestamp - recent[0].timestamp if recent else 0
+
+    def _recent(self):
+        if not self._samples:
+            return []
+        since = self._samples[-1].timestamp - self._window
+        return [s for s in self._samples if s.timestamp >= since]
+
+    def _rate(self):
+        # Least squares slope, one noisy sample at either end doesn't swing it like last - first would
+        recent = self._recent()
+        if len(recent) < 2 or recent[-1].timestamp - recent[0].timestamp < self._minSpan:
+            return None
+        t0 = recent[0].timestamp
+        n = len(recent)
+        mean_t = sum(s.timestamp - t0 for s in recent) / n
+        mean_v = sum(s.value for s in recent) / n
+        var_t = sum((s.timestamp - t0 - mean_t) ** 2 for s in recent)
+        if var_t == 0:
+            return None
+        return sum((s.timestamp - t0 - mean_t) * (s.value - mean_v) for s in recent) / var_t
+
+    def _ewma(self):
+        if not self._samples:
+            return None
+        ewma = self._samples[0].value
+        for previous, sample in zip(self._samples, self._samples[1:]):
+            alpha = 1 - 0.5 ** ((sample.timestamp - previous.timestamp) / self._halfLife)
+            ewma += alpha * (sample.value - ewma)
+        return ewma
+
+    def timeTo(self, threshold):
+        """Forecast when the metric reaches a threshold if it keeps moving at the current rate
+
+        Args:
+            threshold (float): value to reach
+
+        Returns:
+            float: seconds from the newest sample, 0 when already there, None when it isn't growing towards it
+        """
+        if self.value is None:
+            return None
+        if self.value >= threshold:
+            return 0
+        if not self.rate or self.rate <= 0:
+            return None
+        return (threshold - self.value) / self.rate
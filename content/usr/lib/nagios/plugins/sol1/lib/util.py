@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
+import fcntl
+import hashlib
+import json
 import os
-import pickle
+import re
 import sys
 import time
+from contextlib import contextmanager
 from loguru import logger
 
 def logError(message):
@@ -12,6 +17,23 @@ def logError(message):
   return (message)
 
 DEFAULT_LOG_LEVELS = ['TRACE', 'DEBUG', 'INFO', 'SUCCESS', 'WARNING', 'ERROR', 'CRITICAL' ]
+LOG_MODES = ['inline', 'queued']
+LOCK_STRIPES = 64               # lock files per requests cache, the urls being fetched are hashed to one of them
+
+def _compressInBackground(path):
+    """loguru compression callback, gzip the rotated log in a detached process so the check that
+    happened to cross the rotation boundary doesn't have to wait for it.
+
+    Args:
+        path (str): rotated log file
+    """
+    import subprocess
+    try:
+        subprocess.Popen(['gzip', '-f', path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        # Leave the rotated log uncompressed, retention still cleans it up
+        print("Unable to compress rotated log file ({}): {}".format(path, e), file=sys.stderr)
 
 def init_logging(**kwargs):
     debug = kwargs.get('debug', False)                                          # Legacy var, now sets the log level to DEBUG if true
@@ -22,12 +44,25 @@ def init_logging(**kwargs):
     logRetention = kwargs.get('logRetention', '3 days')
     logLevel = str(kwargs.get('logLevel', 'WARNING')).upper()
     availableLogLevels = kwargs.get('availableLogLevels', DEFAULT_LOG_LEVELS)
+    # inline: rotate and retain in the check process, compression is done by a detached gzip
+    # queued: records are queued and written by a background thread to <log>.queued.log, rotation, retention and
+    #         compression are left to logrotate (/etc/logrotate.d/icinga2-checks), which only rotates *.queued.log
+    logMode = str(kwargs.get('logMode', os.environ.get('CHECK_LOG_MODE', 'inline'))).lower()
 
     if debug:
         logLevel = 'DEBUG'
 
     if logLevel not in availableLogLevels:
         logLevel = 'INFO'
+
+    if logMode not in LOG_MODES:
+        logMode = 'inline'
+
+    # The logs loguru rotates itself, and its rotated files, must not match the logrotate rule
+    if logMode == 'queued':
+        root, ext = os.path.splitext(logFile)
+        if not root.endswith('.queued'):
+            logFile = f"{root}.queued{ext or '.log'}"
  
     if os.path.isfile(logFile):
         if not os.access(logFile, os.W_OK):
@@ -47,21 +82,91 @@ def init_logging(**kwargs):
         
     # Add file logging if required
     if enableLogFile:
-        logger.add(logFile, colorize=True,
-                   format="<blue>{time:YYYY-MM-DD HH:mm:ss.SSS}</blue> <yellow>({process.id})</yellow> <level>{level}</level>: {message}",
-                   level=logLevel, 
-                   rotation=logRotate, 
-                   retention=logRetention, 
-                   compression="gz"
-                   )
-    logger.debug(f"Log initalized with level: {logLevel}, enable screen debug: {enableScreenDebug}, enable Log File: {enableLogFile}, File: {logFile}, Rotate: {logRotate}, Retention: {logRetention}")
+        fileFormat = "<blue>{time:YYYY-MM-DD HH:mm:ss.SSS}</blue> <yellow>({process.id})</yellow> <level>{level}</level>: {message}"
+        if logMode == 'queued':
+            # Queued records are only written once logger.complete() runs. MonitoringPlugin.exit and the check executor's
+            # workers call it, the workers leave with os._exit so loguru's exit handler never runs there
+            logger.add(logFile, colorize=True,
+                       format=fileFormat,
+                       level=logLevel,
+                       enqueue=True
+                       )
+        else:
+            logger.add(logFile, colorize=True,
+                       format=fileFormat,
+                       level=logLevel, 
+                       rotation=logRotate, 
+                       retention=logRetention, 
+                       compression=_compressInBackground
+                       )
+    logger.debug(f"Log initalized with level: {logLevel}, mode: {logMode}, enable screen debug: {enableScreenDebug}, enable Log File: {enableLogFile}, File: {logFile}, Rotate: {logRotate}, Retention: {logRetention}")
+
+def requestsCacheFile(name, *parts, cacheDir = '/tmp'):
+    """Build a requests cache file path that is the same for every run with the same parts.
+    Don't use hash() for this, it is salted per interpreter so every run would get a new cache file.
+
+    Args:
+        name (str): prefix for the cache file, usually the plugin name
+        parts (str): values that identify the upstream, e.g. the server url
+        cacheDir (str, optional): directory for the cache file. Defaults to '/tmp'.
+
+    Returns:
+        str: full path to cache file
+    """
+    digest = hashlib.sha256("\0".join(str(p) for p in parts).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, f"{name}_{digest}.cache")
 
-def initRequestsCache(cache_file, expire_after = 30):
-    """_summary_
+@contextmanager
+def fileLock(lock_file, timeout = 60):
+    """Exclusive lock shared across processes, if the lock isn't available within the timeout carry on without it
 
     Args:
-        cache_file (str): full path to cache file
+        lock_file (str): full path to lock file
+        timeout (int, optional): seconds to wait for the lock. Defaults to 60.
+    """
+    fh = open(lock_file, 'a')
+    locked = False
+    try:
+        deadline = time.monotonic() + timeout
+        wait = 0.001
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Timed out waiting for lock {lock_file}, continuing without it")
+                    break
+                time.sleep(wait)
+                wait = min(wait * 2, 0.05)
+        yield locked
+    finally:
+        if locked:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+def _sweepDue(stamp_file, interval):
+    # The stamp file mtime is the last sweep time, only the process that wins the lock and finds it old does the sweep
+    with fileLock(f"{stamp_file}.lock", timeout=0) as locked:
+        if not locked:
+            return False
+        if os.path.isfile(stamp_file) and (time.time() - os.stat(stamp_file).st_mtime) < interval:
+            return False
+        with open(stamp_file, 'a'):
+            os.utime(stamp_file)
+        return True
+
+def initRequestsCache(cache_file, expire_after = 30, sweep_interval = 600, single_flight = True, lock_timeout = 60):
+    """Install a shared requests cache for all requests sessions
+
+    Args:
+        cache_file (str): full path to cache file, use requestsCacheFile to build one
         expire_after (int, optional): seconds till the cache expires. Defaults to 30.
+        sweep_interval (int, optional): minimum seconds between removing expired responses from the cache file. Defaults to 600.
+        single_flight (bool, optional): only let one process at a time fetch the same GET url, the others wait and read it from the cache.
+            The urls share LOCK_STRIPES lock files, so two urls can wait on each other but the lock files don't grow with the urls. Defaults to True.
+        lock_timeout (int, optional): seconds to wait for another process fetching the same url. Defaults to 60.
 
     Returns:
         tuple: (bool, str) the boolan value is success/failure, the string is the message
@@ -72,13 +177,196 @@ def initRequestsCache(cache_file, expire_after = 30):
             if not os.access(cache_file, os.W_OK):
                 return (False, f"Permissions error, unable to write to requests cache file ({cache_file})")
 
-        backend = requests_cache.SQLiteCache(cache_file, check_same_thread=False)
-        requests_cache.install_cache(cache_file, backend=backend, expire_after=expire_after)
-        requests_cache.patcher.remove_expired_responses()
+        class SingleFlightSession(requests_cache.CachedSession):
+            def request(self, method, url, *args, **kwargs):
+                if not single_flight or str(method).upper() != 'GET':
+                    return super().request(method, url, *args, **kwargs)
+                stripe = int(hashlib.sha256(f"{url}\0{kwargs.get('params', '')}".encode()).hexdigest()[:8], 16) % LOCK_STRIPES
+                with fileLock(f"{cache_file}.{stripe:02d}.lock", timeout=lock_timeout):
+                    return super().request(method, url, *args, **kwargs)
+
+        backend = requests_cache.SQLiteCache(cache_file, check_same_thread=False, wal=True)
+        requests_cache.install_cache(cache_file, backend=backend, expire_after=expire_after, session_factory=SingleFlightSession)
+        if _sweepDue(f"{cache_file}.swept", sweep_interval):
+            logger.debug(f"Removing expired responses from requests cache file ({cache_file})")
+            remove_expired_responses = getattr(requests_cache.patcher, 'remove_expired_responses', None)
+            if remove_expired_responses is not None:
+                remove_expired_responses()
+            else:
+                # requests_cache 1.x
+                requests_cache.get_cache().delete(expired=True)
         return (True, f'Successfully initalized requests cache file ({cache_file}) with age ({expire_after})')
     except Exception as e:
         return (False, f'Error initalizing requests cache file ({cache_file}): {e}')
 
+class MonitoringResult:
+    """Accumulates the message lines and perfdata records for a check, they are only joined when rendered
+    so building a large output stays linear in the number of lines
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.perfdata = []
+
+    def addMessage(self, msg):
+        self.lines.append(msg)
+
+    def addPerfdata(self, label, value, unit_of_measurement = "", warn = "", crit = "", minimum = "", maximum = ""):
+        self.perfdata.append((label, value, unit_of_measurement, warn, crit, minimum, maximum))
+
+    def addRawPerfdata(self, data):
+        # Preformatted perfdata string, kept as is
+        self.perfdata.append(data)
+
+    def clearMessage(self):
+        self.lines = []
+
+    def clearPerfdata(self):
+        self.perfdata = []
+
+    @staticmethod
+    def formatPerfdata(record):
+        if isinstance(record, str):
+            return record
+        label, value, uom, warn, crit, minimum, maximum = record
+        return "{label}={value}{uom};{warn};{crit};{min};{max}".format(label=label, value=value, uom=uom, warn=warn, crit=crit, min=minimum, max=maximum)
+
+    @property
+    def message(self):
+        return "".join(self.lines)
+
+    @property
+    def perfdataList(self):
+        """Perfdata as a list of strings, one per record, as used by the Icinga process-check-result api"""
+        return [self.formatPerfdata(record).strip() for record in self.perfdata if str(record).strip()]
+
+    @property
+    def perfdataString(self):
+        return "".join(record if isinstance(record, str) else self.formatPerfdata(record) + " " for record in self.perfdata)
+
+class PhaseTimer:
+    """Times the phases of a check run, eg auth, fetch, parse and evaluate.
+
+    Phases can be nested, time spent in a nested phase is only counted against the nested phase so the
+    phase times add up. A phase entered more than once accumulates.
+    """
+
+    def __init__(self, name = None, perfdata = False, traceFile = None):
+        self.name = name
+        self.timing = perfdata                  # Add the phase times as perfdata (time_<phase>=..s) and log the trace line
+        self.enablePerfdata = perfdata          # Cleared once the perfdata has been added
+        self.traceFile = traceFile              # Append the JSON trace line here instead of logging it
+        self.phases = {}
+        self._open = []                         # [name, start, time in finished nested phases] of running phases
+        self._start = time.perf_counter()
+        self._started = time.time()
+        self._profile = None
+        self._profileFile = None
+        self._finished = False
+
+    @contextmanager
+    def phase(self, name):
+        self._open.append([name, time.perf_counter(), 0.0])
+        try:
+            yield
+        finally:
+            name, start, nested = self._open.pop()
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+            if self._open:
+                self._open[-1][2] += elapsed
+
+    def snapshot(self):
+        """Phase times so far, including the phases still running (eg when the plugin exits inside one)
+
+        Returns:
+            dict: phase name to seconds
+        """
+        phases = dict(self.phases)
+        now = time.perf_counter()
+        inner = 0.0
+        for name, start, nested in reversed(self._open):
+            elapsed = now - start
+            phases[name] = phases.get(name, 0.0) + elapsed - nested - inner
+            inner = elapsed
+        return phases
+
+    @property
+    def total(self):
+        return time.perf_counter() - self._start
+
+    def perfdata(self):
+        """
+        Returns:
+            list: [(label, seconds)] for each phase
+        """
+        return [(f"time_{name}", round(seconds, 4)) for name, seconds in self.snapshot().items()]
+
+    def trace(self):
+        """
+        Returns:
+            str: single line JSON with the check name, pid, start time, total and phase times in seconds
+        """
+        return json.dumps({
+            "check": self.name,
+            "pid": os.getpid(),
+            "start": round(self._started, 3),
+            "total": round(self.total, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.snapshot().items()}
+        })
+
+    def addPerfdata(self, plugin):
+        """Add the phase times to a plugin's perfdata, works with this library's MonitoringPlugin and
+        sol1_monitoring_plugins_lib's
+        """
+        for label, value in self.perfdata():
+            if hasattr(plugin, 'setPerformanceData'):
+                plugin.setPerformanceData(label=label, value=value, unit_of_measurement='s')
+            else:
+                plugin.setPerfdata(label, value, 's')
+
+    def attach(self, plugin):
+        """Add the phase times to the perfdata of a plugin that doesn't know about the timer when it exits"""
+        pluginExit = plugin.exit
+
+        def exit(*args, **kwargs):
+            if self.enablePerfdata:
+                self.addPerfdata(plugin)
+                self.enablePerfdata = False
+            try:
+                return pluginExit(*args, **kwargs)
+            finally:
+                self.finish()
+        plugin.exit = exit
+
+    def startProfile(self, profileDir):
+        import cProfile
+        name = re.sub(r'[^0-9a-zA-Z_.-]+', '_', self.name or 'check')
+        self._profileFile = os.path.join(profileDir, f"{name}-{os.getpid()}-{int(self._started)}.pstats")
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def finish(self):
+        """Write the trace line and the profile, run when the plugin exits and at exit by initTiming"""
+        if self._finished:
+            return
+        self._finished = True
+        if self._profile is not None:
+            self._profile.disable()
+            try:
+                self._profile.dump_stats(self._profileFile)
+                logger.debug(f"Wrote profile to {self._profileFile}")
+            except OSError as e:
+                logger.warning(f"Unable to write profile ({self._profileFile}): {e}")
+        if self.traceFile:
+            try:
+                with open(self.traceFile, 'a') as fh:
+                    fh.write(self.trace() + "\n")
+            except OSError as e:
+                logger.warning(f"Unable to write phase trace ({self.traceFile}): {e}")
+        elif self.timing:
+            logger.info(self.trace())
+
 class MonitoringPlugin:
 
     def __init__(self, logger, checktype = None):
@@ -88,10 +376,10 @@ class MonitoringPlugin:
         self.STATE_CRITICAL = 2      # We know it is CRIT
         self.STATE_UNKNOWN = 3       # We don't know anything yet
         self._current_state = self.STATE_UNKNOWN
-        self._message = ""
-        self._perfdata = ""
+        self._result = MonitoringResult()
         self._type = checktype
         self._logger = logger
+        self.timer = PhaseTimer(checktype)
 
     def getStateLabel(self, state):
         label = "INVALID ({})".format(state)
@@ -130,28 +418,54 @@ class MonitoringPlugin:
             self.state = state
         return self.state
 
-    def exit(self, exit_state = None, force_state = False):
+    def _render(self):
+        message = self._result.message
+        # Add the check type to the top of the message        
+        if self._type:
+            message = self._type + " check\n" + message
+
+        # Set the prefix for the message
+        return "{}: {}".format(self.getStateLabel(self.state), message)
+
+    def result(self):
+        """Get the check result without printing or exiting
+
+        Returns:
+            tuple: (int, str, list) state, output with the state prefix and a list of perfdata strings
+        """
+        return (self.state, self._render(), self._result.perfdataList)
+
+    def exit(self, exit_state = None, force_state = False, do_exit = True):
         # If we pass in a new exit state then only change to it if we at a lower state
         if exit_state is not None:
             if self.state < exit_state or self.state == self.STATE_UNKNOWN or force_state:
                 self.state = exit_state
 
-        # Add the check type to the top of the message        
-        if self._type:
-            self._message = self._type + " check\n" + self._message
+        if self.timer.enablePerfdata:
+            self.timer.addPerfdata(self)
+            self.timer.enablePerfdata = False
+
+        # Hand the results back instead of exiting, used when the check runs inside a longer lived process
+        if not do_exit:
+            self._logger.info("Returning run with state {}".format(self._current_state))
+            return self.result()
 
-        # Set the prefix for the message
-        self._message = "{}: {}".format(self.getStateLabel(self.state), self._message)
-        
         # Add the pipe '|' before perfdata if we have any
-        if self._perfdata != "":
-            self._perfdata = "|" + self._perfdata
+        perfdata = self._result.perfdataString
+        if perfdata != "":
+            perfdata = "|" + perfdata
 
         # Print the message and perfdata, log the exit and exit with error code
-        print(self._message + self._perfdata)
+        print(self._render() + perfdata)
         self._logger.info("Exiting run with state {}".format(self._current_state))
+        self.timer.finish()
+        logger.complete()
         exit(self._current_state)
 
+    def phase(self, name):
+        """Time a phase of the check, eg `with plugin.phase('fetch'):`"""
+        return self.timer.phase(name)
+
     @property
     def state(self):
         return self._current_state
@@ -163,16 +477,16 @@ class MonitoringPlugin:
     
     @property
     def message(self):
-        return self._message
+        return self._result.message
 
     @message.setter
     def message(self, msg):
         # message only
-        self._message += msg
+        self._result.addMessage(msg)
 
     @message.deleter
     def message(self):
-        self._message = ""
+        self._result.clearMessage()
 
     def setMessage(self, msg, state = None, set_state = False, no_prefix = False):
         # If state isn't set then use the current state
@@ -183,21 +497,21 @@ class MonitoringPlugin:
             self.setState(state)
         # message only
         if no_prefix:
-            self._message += msg
+            self._result.addMessage(msg)
         else:
-            self._message += "{}: {}".format(self.getStateLabel(state).title(), msg)
+            self._result.addMessage("{}: {}".format(self.getStateLabel(state).title(), msg))
             
     @property
     def performancedata(self):
-        return self._perfdata
+        return self._result.perfdataString
     
     @performancedata.setter
     def performancedata(self, data):
-        self._perfdata += data
+        self._result.addRawPerfdata(data)
 
     @performancedata.deleter
     def performancedata(self):
-        self._perfdata = ""
+        self._result.clearPerfdata()
 
     # UOM's 
     # no unit specified - assume a number (int or float) of things (eg, users, processes, load averages)
@@ -206,44 +520,163 @@ class MonitoringPlugin:
     # B - bytes (also KB, MB, TB)
     # c - a continous counter (such as bytes transmitted on an interface)
     def perfdata(self, label, value, unit_of_measurement = "", warn = "", crit = "", minimum = "", maximum = ""):
-        self.setPerfdata(label, value, unit_of_measurement = "", warn = "", crit = "", minimum = "", maximum = "")
+        self.setPerfdata(label, value, unit_of_measurement, warn, crit, minimum, maximum)
         
     def setPerfdata(self, label, value, unit_of_measurement = "", warn = "", crit = "", minimum = "", maximum = ""):
-        self._perfdata += "{label}={value}{uom};{warn};{crit};{min};{max} ".format(label=label, value=value, uom=unit_of_measurement, warn=warn, crit=crit, min=minimum, max=maximum)
+        self._result.addPerfdata(label, value, unit_of_measurement, warn, crit, minimum, maximum)
 
     def clearPerfdata(self):
-        self._perfdata = ""
+        self._result.clearPerfdata()
+
+_timers = []        # PhaseTimers set up by initTiming in this process
+
+def addTimingArgs(parser):
+    """Add the phase timing and profiling arguments used by initTiming to an argparse parser or group"""
+    parser.add_argument('--timing', action='store_true', help='Add the time of each check phase as perfdata (time_<phase>)', default=False)
+    parser.add_argument('--timing-trace', type=str, help='Append a JSON line with the phase times to this file, with --timing and no file it is logged at INFO', default=None)
+    parser.add_argument('--profile', type=str, nargs='?', const='/tmp', help='Write a cProfile dump of the run to this directory (default /tmp)', default=None)
+
+def initTiming(args, name = None, plugin = None):
+    """Set up phase timing and profiling from the addTimingArgs arguments, the trace line and
+    profile are written when the plugin exits, or at exit or by finishTiming if it never does.
+
+    Args:
+        args (Namespace): parsed arguments
+        name (str, optional): check name for the trace line and profile file
+        plugin (MonitoringPlugin, optional): plugin to add the phase perfdata to when it exits. Defaults to None.
+
+    Returns:
+        PhaseTimer: the timer, for this library's MonitoringPlugin it is the plugin's own timer
+    """
+    if isinstance(plugin, MonitoringPlugin):
+        timer = plugin.timer
+    else:
+        timer = PhaseTimer()
+        if plugin is not None:
+            timer.attach(plugin)
+    timer.name = name or timer.name
+    timer.timing = timer.enablePerfdata = getattr(args, 'timing', False)
+    timer.traceFile = getattr(args, 'timing_trace', None)
+    if getattr(args, 'profile', None):
+        timer.startProfile(args.profile)
+    _timers.append(timer)
+    atexit.register(timer.finish)
+    return timer
+
+def finishTiming():
+    """Write the trace line and profile of every timer initTiming set up that hasn't written them yet.
+    The atexit handlers don't run in a process that leaves with os._exit, like the check executor's workers,
+    so it calls this after the plugin.
+    """
+    while _timers:
+        _timers.pop().finish()
 
 class AgeCache:
+    """Key/value cache shared by all checks of a user, stored in a single SQLite (WAL) file
+
+    Payloads are stored as JSON, so a value read back is what json.loads gives (a tuple comes back as a list).
+    The default cacheDir is a directory only the user can use under /tmp, a cache file owned by another user isn't
+    opened.
+
+    Entries are fresh while they are younger than the age passed to read and, if they were written with a ttl,
+    until the ttl runs out. Writes are atomic and locked across processes by SQLite, old entries are evicted
+    least recently used first once the cache has more than maxEntries entries or maxBytes of payload.
+
+    Reads don't take the write lock, an entry's accessed time is only updated once per ACCESS_RESOLUTION seconds. Every
+    write gets the next version of a counter for the whole file, so a version is never reused by a later write of the
+    same key, even after the entry was deleted, evicted or expired.
+    """
+    ACCESS_RESOLUTION = 60                  # seconds, the least recently used order is only this precise
+    SCHEMA = """CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        payload BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        expires REAL,
+        version INTEGER NOT NULL DEFAULT 1
+    )"""
+    SEQUENCE_SCHEMA = """CREATE TABLE IF NOT EXISTS cache_sequence (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        version INTEGER NOT NULL
+    )"""
+
     def __init__(self, **kwargs):
         self._age = kwargs.get('age', 0)
-        self._cacheDir = str(kwargs.get('cacheDir', '/tmp/'))
+        self._cacheDir = str(kwargs['cacheDir']) if 'cacheDir' in kwargs else self._userDir('/tmp')
+        self._cacheFile = kwargs.get('cacheFile', os.path.join(self._cacheDir, 'check_age_cache.sqlite'))
+        self._maxEntries = int(kwargs.get('maxEntries', 1000))
+        self._maxBytes = int(kwargs.get('maxBytes', 64 * 1024 * 1024))
+        self._timeout = kwargs.get('timeout', 30)                                 # Seconds to wait for another process holding the lock
+        self._db = None
+
+        if not self._has_dir(os.path.dirname(self._cacheFile) or '.'):
+            raise OSError
+        if os.path.isfile(self._cacheFile) and not os.access(self._cacheFile, os.W_OK):
+            self._log_error(f"Permissions error, unable to write to cache file ({self._cacheFile})")
+            raise OSError
+        if os.path.lexists(self._cacheFile) and os.lstat(self._cacheFile).st_uid != os.getuid():
+            self._log_error(f"Permissions error, cache file ({self._cacheFile}) must be owned by uid {os.getuid()}")
+            raise OSError
 
-        if not self._has_dir(self._cacheDir):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _log_error(message):
+        try:
+            logger.error(message)
+        except:
+            print(message)
+
+    @classmethod
+    def _userDir(cls, base):
+        # check_age_cache_<uid> under base, created 0700 and not used if someone else could have put entries in it
+        dir = os.path.join(base, f"check_age_cache_{os.getuid()}")
+        try:
+            os.mkdir(dir, 0o700)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            cls._log_error(f"Unable to create cache dir ({dir}): {e}")
             raise OSError
-        
+        stat = os.lstat(dir)
+        if not os.path.isdir(dir) or os.path.islink(dir) or stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            cls._log_error(f"Permissions error, cache dir ({dir}) must be a directory owned by uid {os.getuid()} with mode 0700")
+            raise OSError
+        return dir
+
     def _has_dir(self, dir):
         if not os.path.isdir(dir) or not os.access(dir, os.W_OK):
-            try:
-                logger.error(f"Permissions error, unable to write to cache dir ({dir})")
-            except:
-                print(f"Permissions error, unable to write to cache dir ({dir})")
+            self._log_error(f"Permissions error, unable to write to cache dir ({dir})")
             return False
         return True
-        
-    def _has_file(self, file):
-        if not os.path.isfile(file):
-            return False
-        if not os.access(file, os.R_OK):
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
             try:
-                logger.error(f"Permissions error, unable to read from cache file ({file})")
-            except:
-                print(f"Permissions error, unable to read from cache file ({file})")
-            return False
-        return True
+                # Autocommit, transactions are started explicitly so the lock is taken up front
+                self._db = sqlite3.connect(self._cacheFile, timeout=self._timeout, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(self.SCHEMA)
+                self._db.execute(self.SEQUENCE_SCHEMA)
+                self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            except sqlite3.Error as e:
+                self._log_error(f"Unable to open cache file ({self._cacheFile}): {e}")
+                self._db = None
+                raise OSError
+        return self._db
 
-    def _get_cache_path(self, key):
-        return self._cacheDir + str(key) + '.cache'
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
     @property
     def age(self):
@@ -253,28 +686,147 @@ class AgeCache:
     def age(self, age):
         self._age = age
 
-    def read(self, key, age = None):
-        response = None
+    def _transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock before anything is read so the read and write can't be split by another process
+        db = self.db
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(db)
+                db.execute("COMMIT")
+                return result
+            except:
+                db.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            self._log_error(f"Cache error for {self._cacheFile}: {e}")
+            raise OSError
+
+    def readWithVersion(self, key, age = None):
+        """Read a fresh entry and its version for use with compareAndSet
+
+        Args:
+            key (str): cache key
+            age (int, optional): max age of the entry in seconds. Defaults to the cache age.
+
+        Returns:
+            tuple: (payload, int) payload and version, (None, version) when stale and (None, 0) when missing
+        """
+        import sqlite3
         if age is None:
             age = self._age
-        file = self._get_cache_path(key)
-        # File exist and the file modify time in relation to the current time is less than the cache age time (all in seconds)
-        if self._has_file(file) and (time.time()-os.stat(file).st_mtime) < age:
-            try:
-                logger.info(f"Read from cache {file}")
-                fh = open(file, 'rb')
-                response = pickle.load(fh)
-            except Exception as e:
-                raise OSError
-        logger.debug(f"Return from cache {file}: {response}")
-        return response
-
-    def write(self, key, payload):
-        file = self._get_cache_path(key)
-        try: 
-            fh = open(file, 'wb')
-            pickle.dump(payload, fh)
-            logger.debug(f"Write to cache {file}: {payload}")
+        now = time.time()
+
+        # A plain read, WAL readers see the last commit without waiting for a writer
+        try:
+            row = self.db.execute("SELECT payload, created, accessed, expires, version FROM cache WHERE key = ?", (str(key),)).fetchone()
+        except sqlite3.Error as e:
+            self._log_error(f"Cache error for {self._cacheFile}: {e}")
+            raise OSError
+        payload, version = (None, 0)
+        if row is not None:
+            payload, created, accessed, expires, version = row
+            if (now - created) >= age or (expires is not None and expires <= now):
+                payload = None
+            elif now - accessed >= self.ACCESS_RESOLUTION:
+                self._touch(key, now)
+        if payload is None:
+            logger.debug(f"Cache miss for {key} in {self._cacheFile}")
+            return (None, version)
+        try:
+            response = json.loads(payload)
         except Exception as e:
+            self._log_error(f"Unable to load cache entry {key} from {self._cacheFile}: {e}")
+            raise OSError
+        logger.info(f"Read {key} from cache {self._cacheFile}")
+        logger.opt(lazy=True).debug("Return from cache {}: {}", lambda: key, lambda: response)
+        return (response, version)
+
+    def read(self, key, age = None):
+        return self.readWithVersion(key, age)[0]
+
+    def _touch(self, key, now):
+        # Best effort, a busy cache shouldn't fail or hold up the read
+        import sqlite3
+        try:
+            self.db.execute("UPDATE cache SET accessed = ? WHERE key = ? AND accessed < ?", (now, str(key), now))
+        except sqlite3.Error as e:
+            logger.debug(f"Unable to update the accessed time of {key} in cache {self._cacheFile}: {e}")
+
+    def _nextVersion(self, db, now):
+        # Starts from the time in ms so a version from a cache file that was since removed isn't reused either
+        db.execute("""INSERT INTO cache_sequence (id, version) VALUES (0, ?)
+                      ON CONFLICT(id) DO UPDATE SET version = cache_sequence.version + 1""", (int(now * 1000),))
+        return db.execute("SELECT version FROM cache_sequence WHERE id = 0").fetchone()[0]
+
+    def _store(self, db, key, payload, ttl, now):
+        expires = now + ttl if ttl else None
+        db.execute("""INSERT INTO cache (key, payload, size, created, accessed, expires, version) VALUES (?, ?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, size = excluded.size, created = excluded.created,
+                      accessed = excluded.accessed, expires = excluded.expires, version = excluded.version""",
+                   (str(key), payload, len(payload), now, now, expires, self._nextVersion(db, now)))
+        self._evict(db, now)
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        if count <= self._maxEntries and size <= self._maxBytes:
+            return
+        # Least recently used first until we are back under both limits
+        evicted = 0
+        for key, entry_size in db.execute("SELECT key, size FROM cache ORDER BY accessed ASC").fetchall():
+            if count <= self._maxEntries and size <= self._maxBytes:
+                break
+            db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            count -= 1
+            size -= entry_size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} entries from cache {self._cacheFile}")
+
+    def _encode(self, key, payload):
+        try:
+            return json.dumps(payload, separators=(',', ':')).encode()
+        except (TypeError, ValueError) as e:
+            self._log_error(f"Unable to write cache entry {key} to {self._cacheFile}: {e}")
             raise OSError
 
+    def write(self, key, payload, ttl = None):
+        """Write an entry, replacing any existing entry
+
+        Args:
+            key (str): cache key
+            payload (any): JSON serialisable value to cache
+            ttl (int, optional): seconds until the entry expires regardless of the age used to read it. Defaults to None.
+        """
+        data = self._encode(key, payload)
+        self._transaction(lambda db: self._store(db, key, data, ttl, time.time()))
+        logger.opt(lazy=True).debug("Write to cache {}: {}", lambda: key, lambda: payload)
+
+    def compareAndSet(self, key, payload, version, ttl = None):
+        """Write an entry only if it hasn't changed since it was read
+
+        Args:
+            key (str): cache key
+            payload (any): JSON serialisable value to cache
+            version (int): version from readWithVersion, 0 if the entry is expected to not exist
+            ttl (int, optional): seconds until the entry expires. Defaults to None.
+
+        Returns:
+            bool: True if the entry was written
+        """
+        data = self._encode(key, payload)
+
+        def _cas(db):
+            row = db.execute("SELECT version FROM cache WHERE key = ?", (str(key),)).fetchone()
+            current = row[0] if row is not None else 0
+            if current != version:
+                return False
+            self._store(db, key, data, ttl, time.time())
+            return True
+
+        written = self._transaction(_cas)
+        logger.debug(f"Compare and set cache {key} version {version}: {'written' if written else 'changed, not written'}")
+        return written
+
+    def delete(self, key):
+        self._transaction(lambda db: db.execute("DELETE FROM cache WHERE key = ?", (str(key),)))